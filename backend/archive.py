@@ -0,0 +1,270 @@
+from config import app, db
+from models import ChatModel, MessageModel, UserModel
+from collections import namedtuple
+import argparse
+import mmap
+import msgpack
+import os
+import search
+import struct
+import time
+import zlib
+
+"""
+This module moves old messages out of the message table into per-room archive files and reads them back.
+Archiving keeps the table, and every index on it, limited to the recent messages that make up nearly all reads.
+Each room has two append-only files in ARCHIVE_DIR:
+    <chat_id>.seg: zlib-compressed blocks of up to ARCHIVE_BLOCK_MESSAGES messages, each a MessagePack list
+        of [id, created_at, username, text] in id order.
+    <chat_id>.tidx: one fixed-size record per block (first id, last id, oldest and newest created_at, offset
+        and length in the segment), binary searched through mmap. Time-bounded reads skip the blocks outside
+        the range without decompressing them, and stop at the first block past it: message ids follow
+        creation time, so the blocks are in time order too.
+    Archives written before the time bounds were added have a <chat_id>.idx index without them; it is
+    converted, reading every block once, the first time the room's archive is opened.
+A room's archive always holds a prefix of its history: every message with an id up to the last archived one.
+The table holds the rest, so a page that runs out of table rows continues in the archive (see get_page).
+Blocks are written and fsynced before their index records, and rows are deleted only after both, so an
+interrupted run leaves at worst unused bytes at the end of a segment, and the next run finishes its work.
+Archived messages are removed from the full-text search index.
+Classes:
+    RoomArchive: The archive files of one room, memory-mapped for reading.
+Functions:
+    open_archive(chat_id): Returns the RoomArchive of a room, or None if it has none.
+    get_page(chat_id, before_id, after_id, since, until, limit): MessageModel.get_page reading through to the archive.
+    archive_room(chat_id, cutoff): Archives the messages of a room created before cutoff.
+    archive_all(older_than_days): Archives the old messages of every room.
+Usage:
+    python archive.py --older-than-days 90
+"""
+
+INDEX_RECORD = struct.Struct('<qqqqQI')
+OLD_INDEX_RECORD = struct.Struct('<qqQI')
+
+ArchivedMessage = namedtuple('ArchivedMessage', ['id', 'created_at', 'username', 'message'])
+
+def _paths(chat_id):
+    directory = app.config['ARCHIVE_DIR']
+    return os.path.join(directory, f'{chat_id}.seg'), os.path.join(directory, f'{chat_id}.tidx')
+
+class RoomArchive():
+
+    def __init__(self, chat_id):
+        segment_path, index_path = _paths(chat_id)
+        with open(index_path, 'rb') as index_file, open(segment_path, 'rb') as segment_file:
+            self.index_size = os.fstat(index_file.fileno()).st_size
+            self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.segment = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.blocks = self.index_size // INDEX_RECORD.size
+        self.last_id = self._record(self.blocks - 1)[1]
+
+    def _record(self, block):
+        return INDEX_RECORD.unpack_from(self.index, block * INDEX_RECORD.size)
+
+    def _messages(self, block):
+        _, _, _, _, offset, length = self._record(block)
+        return [ArchivedMessage(*item) for item in msgpack.unpackb(zlib.decompress(self.segment[offset:offset + length]))]
+
+    def _first_block_ending_after(self, message_id):
+        low, high = 0, self.blocks
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[1] <= message_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _skips(self, block, since, until):
+        _, _, oldest, newest, _, _ = self._record(block)
+        return (since is not None and newest < since) or (until is not None and oldest >= until)
+
+    def read_before(self, before_id=None, since=None, until=None, limit=50):
+        """
+        Returns up to limit archived messages older than before_id, newest first.
+        """
+        block = self.blocks - 1 if before_id is None else min(self._first_block_ending_after(before_id - 1), self.blocks - 1)
+        found = []
+        while block >= 0 and len(found) < limit:
+            if self._skips(block, since, until):
+                if since is not None and self._record(block)[3] < since:
+                    break
+                block -= 1
+                continue
+            for message in reversed(self._messages(block)):
+                if (before_id is None or message.id < before_id) and _in_range(message, since, until):
+                    found.append(message)
+                    if len(found) == limit:
+                        break
+            block -= 1
+        return found
+
+    def read_after(self, after_id, since=None, until=None, limit=50):
+        """
+        Returns up to limit archived messages newer than after_id, oldest first.
+        """
+        block = self._first_block_ending_after(after_id)
+        found = []
+        while block < self.blocks and len(found) < limit:
+            if self._skips(block, since, until):
+                if until is not None and self._record(block)[2] >= until:
+                    break
+                block += 1
+                continue
+            for message in self._messages(block):
+                if message.id > after_id and _in_range(message, since, until):
+                    found.append(message)
+                    if len(found) == limit:
+                        break
+            block += 1
+        return found
+
+def _in_range(message, since, until):
+    return (since is None or message.created_at >= since) and (until is None or message.created_at < until)
+
+_open_archives = {}
+
+def _convert_index(chat_id):
+    """
+    Writes the index of an archive made before the time bounds were added, from its old index and its blocks.
+    """
+    segment_path, index_path = _paths(chat_id)
+    old_index_path = os.path.join(app.config['ARCHIVE_DIR'], f'{chat_id}.idx')
+    if os.path.exists(index_path) or not os.path.exists(old_index_path):
+        return
+
+    with open(old_index_path, 'rb') as old_index_file, open(segment_path, 'rb') as segment_file:
+        old_index = old_index_file.read()
+        records = []
+        for start in range(0, len(old_index) // OLD_INDEX_RECORD.size * OLD_INDEX_RECORD.size, OLD_INDEX_RECORD.size):
+            first_id, last_id, offset, length = OLD_INDEX_RECORD.unpack_from(old_index, start)
+            segment_file.seek(offset)
+            created = [item[1] for item in msgpack.unpackb(zlib.decompress(segment_file.read(length)))]
+            records.append(INDEX_RECORD.pack(first_id, last_id, min(created), max(created), offset, length))
+
+    with open(f'{index_path}.tmp', 'wb') as index_file:
+        index_file.write(b''.join(records))
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.replace(f'{index_path}.tmp', index_path)
+    os.unlink(old_index_path)
+
+def open_archive(chat_id):
+    """
+    Returns the RoomArchive of a room, reopened when another process appended to it, or None if the room has no archive.
+    """
+    if chat_id not in _open_archives:
+        _convert_index(chat_id)
+    try:
+        index_size = os.stat(_paths(chat_id)[1]).st_size
+    except FileNotFoundError:
+        return None
+    if index_size < INDEX_RECORD.size:
+        return None
+
+    archive = _open_archives.get(chat_id)
+    if archive is None or archive.index_size != index_size:
+        archive = _open_archives[chat_id] = RoomArchive(chat_id)
+    return archive
+
+def get_page(chat_id, before_id=None, after_id=None, since=None, until=None, limit=50):
+    """
+    Returns a page of messages like MessageModel.get_page, continuing in the room's archive when the
+    table runs out of matching rows. Every archived message is older than every message left in the table.
+    Returns:
+        list: Rows with id, message, created_at and username, newest first, or oldest first with after_id.
+    """
+    messages = MessageModel.get_page(chat_id, before_id=before_id, after_id=after_id,
+                                     since=since, until=until, limit=limit)
+    if len(messages) >= limit and after_id is None:
+        return messages
+
+    archive = open_archive(chat_id)
+    if archive is None:
+        return messages
+
+    if after_id is None:
+        return messages + archive.read_before(before_id, since, until, limit - len(messages))
+    if after_id >= archive.last_id:
+        return messages
+    return (archive.read_after(after_id, since, until, limit) + messages)[:limit]
+
+def _append(chat_id, messages):
+    segment_path, index_path = _paths(chat_id)
+    block_size = app.config['ARCHIVE_BLOCK_MESSAGES']
+    records = []
+    with open(segment_path, 'ab') as segment_file:
+        offset = segment_file.seek(0, os.SEEK_END)
+        for start in range(0, len(messages), block_size):
+            block = messages[start:start + block_size]
+            data = zlib.compress(msgpack.packb([list(message) for message in block]), 9)
+            segment_file.write(data)
+            created = [message.created_at for message in block]
+            records.append(INDEX_RECORD.pack(block[0].id, block[-1].id, min(created), max(created), offset, len(data)))
+            offset += len(data)
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+
+    with open(index_path, 'ab') as index_file:
+        # drop a record left half-written by an interrupted run
+        index_file.truncate(index_file.seek(0, os.SEEK_END) // INDEX_RECORD.size * INDEX_RECORD.size)
+        index_file.write(b''.join(records))
+        index_file.flush()
+        os.fsync(index_file.fileno())
+
+def archive_room(chat_id, cutoff):
+    """
+    Moves the messages of a room created before cutoff, and every older message by id, to the room's archive.
+    Args:
+        chat_id (int): The id of the room.
+        cutoff (int): Epoch milliseconds; messages created earlier are archived.
+    Returns:
+        int: The number of messages moved.
+    """
+    archive = open_archive(chat_id)
+    archived_until = archive.last_id if archive is not None else 0
+
+    last_old_id = db.session.query(db.func.max(MessageModel.id)) \
+        .filter(MessageModel.chat_id == chat_id, MessageModel.created_at < cutoff) \
+        .scalar()
+
+    messages = []
+    if last_old_id is not None and last_old_id > archived_until:
+        messages = db.session.query(MessageModel.id, MessageModel.created_at, UserModel.username, MessageModel.message) \
+            .outerjoin(UserModel, UserModel.id == MessageModel.user_id) \
+            .filter(MessageModel.chat_id == chat_id, MessageModel.id > archived_until, MessageModel.id <= last_old_id) \
+            .order_by(MessageModel.id.asc()) \
+            .all()
+        if messages:
+            _append(chat_id, [ArchivedMessage(*message) for message in messages])
+            archived_until = messages[-1].id
+
+    # also removes the rows of a run interrupted after writing its files
+    ids = [id for id, in db.session.query(MessageModel.id)
+           .filter(MessageModel.chat_id == chat_id, MessageModel.id <= archived_until)]
+    search.unindex_many(ids, MessageModel)
+    MessageModel.query.filter(MessageModel.chat_id == chat_id, MessageModel.id <= archived_until) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return len(messages)
+
+def archive_all(older_than_days):
+    """
+    Archives the messages older than a number of days in every room.
+    Returns:
+        int: The number of messages moved.
+    """
+    os.makedirs(app.config['ARCHIVE_DIR'], exist_ok=True)
+    cutoff = MessageModel.timestamp() - older_than_days * 86_400_000
+    return sum(archive_room(chat_id, cutoff) for chat_id, in db.session.query(ChatModel.id).all())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Move old messages from the database to the per-room archive files.')
+    parser.add_argument('--older-than-days', type=float, default=app.config['ARCHIVE_AFTER_DAYS'],
+                        help='Archive the messages older than this many days.')
+    args = parser.parse_args()
+
+    with app.app_context():
+        start = time.monotonic()
+        moved = archive_all(args.older_than_days)
+        print(f'Archived {moved} messages in {time.monotonic() - start:.1f}s')
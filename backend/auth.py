@@ -1,6 +1,7 @@
 from config import app, db
 from flask import request, jsonify
 from models import UserModel
+from presence import presence_registry
 from flask_jwt_extended import create_access_token, create_refresh_token, get_jwt_identity, jwt_required
 
 """
@@ -10,6 +11,7 @@ Routes:
     /signup (POST): Handles user signup by creating a new user account.
     /signin (POST): Authenticates a user and generates access and refresh tokens.
     /jwt_refresh (POST): Refreshes the JWT token for the current user.
+    /logout (PATCH): Marks the current user offline.
 Functions:
     signup_user(): Handles user signup by creating a new user account.
     signin_user(): Authenticates a user and generates access and refresh tokens.
@@ -29,7 +31,7 @@ def signup_user():
     """
     data = request.get_json()
 
-    user = UserModel.get_user_by_username(data.get('username'))
+    user = UserModel.get_user_ref(data.get('username'))
 
     if user is not None:
         return jsonify({"message": "User already exist!"}), 401
@@ -48,7 +50,8 @@ def signin_user():
     Authenticates a user and generates access and refresh tokens.
     This function retrieves user credentials from the request, verifies the 
     username and password, and if valid, generates JWT access and refresh tokens. 
-    It also updates the user's status to 'online' in the database.
+    The user's status turns 'online' once the client opens its Socket.IO connection.
+    A password hashed with an outdated method or cost is rehashed with the configured one.
     Returns:
         Response: A JSON response containing a success message and the tokens 
         if authentication is successful, or an error message if authentication fails.
@@ -58,12 +61,13 @@ def signin_user():
     user = UserModel.get_user_by_username(data.get('username'))
 
     if user and (user.check_password(data.get('password'))):
+        if user.password_needs_rehash():
+            user.set_password(data.get('password'))
+            user.save()
+
         access_token = create_access_token(identity=user.username)
         refresh_token = create_refresh_token(identity=user.username)
 
-        user.status = 'online'
-        db.session.commit()
-
         return jsonify({
             "message":"Logged In!",
             "tokens": {
@@ -90,24 +94,22 @@ def jwt_refresh():
     return jsonify({"access":access_token}), 200
 
 @app.route('/logout', methods=['PATCH'])
+@jwt_required()
 def user_logout():
     """
-    Logs out a user by setting their status to 'offline'.
-    This function retrieves the user's data from the request, checks if the user exists,
-    updates their status to 'offline', commits the change to the database, and returns
-    a success message. If the user is not found, it returns an error message.
+    Logs out the current user, the one of the access token, by setting their status to 'offline'.
+    This function checks if the user exists and marks them offline in the presence registry,
+    which writes the change with its next batch, and returns a success message.
+    If the user is not found, it returns an error message.
     Returns:
         Response: A JSON response with a success message and HTTP status 200 if the user
         is logged out successfully, or a JSON response with an error message and HTTP status
         404 if the user is not found.
     """
-    data = request.get_json()
-
-    user = UserModel.get_user_by_username(data.get('username'))
+    user = UserModel.get_user_ref(get_jwt_identity())
 
     if user:
-        user.status = 'offline'
-        db.session.commit()
+        presence_registry.logout(user.id, user.username)
         return jsonify({"msg": "Logged out successfully!"}), 200
     else:
         return jsonify({"msg": "User not found!"}), 404 
\ No newline at end of file
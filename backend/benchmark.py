@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+import socketio
+
+"""
+This module load-tests the backend with simulated users and reports latencies as JSON.
+Unless --url points at a running server, it migrates a scratch SQLite database and serves it with
+`main.py serve`. Every simulated user then goes through signup, signin, create_room (the first user of
+each room) or add_user_to_chat (the others), opens a python-socketio connection, joins its room,
+sends messages and exits the room.
+The report holds the fan-out latency of chat messages (from emit by the sender to receipt by each
+room member, p50/p99), the messages delivered per second, and the latency of every REST route.
+Reports saved with --output can be checked against a baseline with --compare, which exits with
+status 1 when a latency grows or the throughput drops by more than --tolerance.
+Functions:
+    percentiles(samples): Summarizes a list of latencies in milliseconds.
+    start_server(port, database): Starts `main.py serve` in its own process group.
+    run(args): Runs the benchmark and returns the report.
+    compare(report, baseline, tolerance): Prints the differences with a baseline and returns the regressions.
+Usage:
+    python benchmark.py --clients 1000 --room-size 10 --messages 10 --output run.json
+    python benchmark.py --clients 1000 --compare run.json
+"""
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+MESSAGE_PREFIX = 'bench'
+
+def percentiles(samples):
+    """
+    Summarizes a list of latencies in milliseconds.
+    Returns:
+        dict: The number of samples and their p50, p99, mean and max, or only the count when empty.
+    """
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    rank = lambda p: samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+    return {
+        "count": len(samples),
+        "p50_ms": round(rank(50), 3),
+        "p99_ms": round(rank(99), 3),
+        "mean_ms": round(sum(samples) / len(samples), 3),
+        "max_ms": round(samples[-1], 3),
+    }
+
+def start_server(port, database):
+    """
+    Migrates a scratch database and starts `main.py serve` on a port with it, in a new process
+    group so that every process it starts is stopped with it.
+    Returns:
+        subprocess.Popen: The server process.
+    """
+    env = dict(os.environ, CHAT_PORT=str(port), CHAT_DATABASE_URL=f'sqlite:///{database}',
+               CHAT_SECRET_KEY=secrets.token_hex(16), CHAT_JWT_SECRET_KEY=secrets.token_hex(16))
+    subprocess.run([sys.executable, 'main.py', 'migrate'], cwd=BACKEND_DIR, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return subprocess.Popen([sys.executable, 'main.py', 'serve', '--host', '127.0.0.1'], cwd=BACKEND_DIR, env=env,
+                            start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+async def wait_for_server(url, timeout):
+    async with aiohttp.ClientSession() as http:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                async with http.get(f'{url}/socket.io/?EIO=4&transport=polling'):
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f'The server at {url} did not start within {timeout} seconds')
+
+class Benchmark():
+
+    def __init__(self, args):
+        self.args = args
+        self.rest = {}
+        self.rest_errors = {}
+        self.fanout = []
+        self.delivered = 0
+        self.sent = 0
+        self.all_delivered = asyncio.Event()
+        self.expected = 0
+        self.limit = asyncio.Semaphore(args.concurrency)
+
+    async def call(self, http, method, route, token=None, **kwargs):
+        headers = {"Authorization": f'Bearer {token}'} if token else {}
+        async with self.limit:
+            start = time.perf_counter()
+            async with http.request(method, f'{self.args.url}{route}', headers=headers, **kwargs) as response:
+                body = await response.json(content_type=None)
+                elapsed_ms = (time.perf_counter() - start) * 1000
+        self.rest.setdefault(route, []).append(elapsed_ms)
+        if response.status >= 400:
+            self.rest_errors[route] = self.rest_errors.get(route, 0) + 1
+        return body
+
+    async def setup_user(self, http, index, username, room):
+        await self.call(http, 'POST', '/signup', json={"username": username, "email": f'{username}@bench.local',
+                                                       "password": username})
+        tokens = (await self.call(http, 'PATCH', '/signin', json={"username": username, "password": username}))['tokens']
+        if index % self.args.room_size == 0:
+            await self.call(http, 'POST', '/chat/create_room', tokens['access'],
+                            json={"room": room, "type": "group", "username": username})
+        return tokens['access']
+
+    async def add_members(self, http, users):
+        for index, (username, room, token) in enumerate(users):
+            if index % self.args.room_size != 0:
+                await self.call(http, 'POST', '/chat/add_user_to_chat', token, json={"username": username, "room": room})
+
+    async def connect(self, username, room, token):
+        client = socketio.AsyncClient(reconnection=False)
+
+        @client.on('message')
+        def on_message(data):
+            parts = str(data.get('text', '')).split(' ')
+            if len(parts) == 3 and parts[0] == MESSAGE_PREFIX:
+                self.fanout.append((time.perf_counter_ns() - int(parts[2])) / 1_000_000)
+                self.delivered += 1
+                if self.delivered >= self.expected:
+                    self.all_delivered.set()
+
+        async with self.limit:
+            await client.connect(self.args.url, auth={"token": token}, transports=self.args.transports,
+                                 wait_timeout=30)
+            start = time.perf_counter()
+            await client.call('join', {"room": room}, timeout=30)
+            self.rest.setdefault('join (socket.io)', []).append((time.perf_counter() - start) * 1000)
+        return client
+
+    async def chat(self, client, index):
+        for seq in range(self.args.messages):
+            await client.emit('message', {"message": f'{MESSAGE_PREFIX} {index}-{seq} {time.perf_counter_ns()}'})
+            self.sent += 1
+            await asyncio.sleep(self.args.interval)
+
+    async def exit(self, http, client, username, room, token):
+        saved = await self.call(http, 'POST', '/chat/save_message', token,
+                                json={"username": username, "room": room, "text": f'{username} has left the room'})
+        await client.emit('exit', {"id": saved.get('id'), "room": room})
+        await client.disconnect()
+
+    async def run(self):
+        args = self.args
+        run_id = int(time.time())
+        names = [(f'bench{run_id}u{i}', f'bench{run_id}#{i // args.room_size}') for i in range(args.clients)]
+        self.expected = sum(min(args.room_size, args.clients - start) ** 2 * args.messages
+                            for start in range(0, args.clients, args.room_size))
+
+        async with aiohttp.ClientSession() as http:
+            tokens = await asyncio.gather(*(self.setup_user(http, i, *names[i]) for i in range(args.clients)))
+            users = [(username, room, token) for (username, room), token in zip(names, tokens)]
+            await asyncio.gather(*(self.add_members(http, users[start:start + args.room_size])
+                                   for start in range(0, args.clients, args.room_size)))
+
+            clients = await asyncio.gather(*(self.connect(username, room, token) for username, room, token in users))
+
+            start = time.perf_counter()
+            await asyncio.gather(*(self.chat(client, i) for i, client in enumerate(clients)))
+            try:
+                await asyncio.wait_for(self.all_delivered.wait(), args.drain_timeout)
+            except asyncio.TimeoutError:
+                pass
+            duration = time.perf_counter() - start
+
+            await asyncio.gather(*(self.exit(http, client, username, room, token)
+                                   for client, (username, room, token) in zip(clients, users)))
+
+            for username, room, token in users[:args.clients:args.room_size]:
+                await self.call(http, 'GET', '/chat/get_rooms', token)
+                await self.call(http, 'GET', '/chat/get_messages', token, params={"room": room})
+
+        return {
+            "config": {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            "finished_at": datetime.datetime.now().isoformat(timespec='seconds'),
+            "fanout": percentiles(self.fanout),
+            "messages": {
+                "sent": self.sent,
+                "expected_deliveries": self.expected,
+                "delivered": self.delivered,
+                "duration_s": round(duration, 3),
+                "delivered_per_second": round(self.delivered / duration, 1),
+            },
+            "rest": {route: dict(percentiles(samples), errors=self.rest_errors.get(route, 0))
+                     for route, samples in sorted(self.rest.items())},
+        }
+
+def run(args):
+    """
+    Runs the benchmark, starting a server with a scratch database unless args.url is set.
+    Returns:
+        dict: The report.
+    """
+    if args.url is not None:
+        return asyncio.run(Benchmark(args).run())
+
+    with tempfile.TemporaryDirectory() as scratch:
+        server = start_server(args.port, os.path.join(scratch, 'bench.db'))
+        args.url = f'http://127.0.0.1:{args.port}'
+        try:
+            asyncio.run(wait_for_server(args.url, 30))
+            return asyncio.run(Benchmark(args).run())
+        finally:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+            args.url = None
+
+def compare(report, baseline, tolerance):
+    """
+    Prints the change of every latency and of the throughput against a baseline report.
+    Returns:
+        list: The names of the metrics that regressed by more than tolerance (a fraction).
+    """
+    metrics = [('fanout p50', ('fanout', 'p50_ms'), False), ('fanout p99', ('fanout', 'p99_ms'), False),
+               ('delivered/s', ('messages', 'delivered_per_second'), True)]
+    for route in report['rest']:
+        metrics.append((f'{route} p99', ('rest', route, 'p99_ms'), False))
+
+    regressions = []
+    for name, path, higher_is_better in metrics:
+        current, previous = report, baseline
+        for key in path:
+            current = current.get(key, {}) if isinstance(current, dict) else {}
+            previous = previous.get(key, {}) if isinstance(previous, dict) else {}
+        if not isinstance(current, (int, float)) or not isinstance(previous, (int, float)) or not previous:
+            continue
+
+        change = (current - previous) / previous
+        regressed = -change > tolerance if higher_is_better else change > tolerance
+        print(f'{name:40} {previous:12.3f} -> {current:12.3f} {change:+8.1%}{"  REGRESSION" if regressed else ""}')
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load-test the chat backend with simulated Socket.IO clients.')
+    parser.add_argument('--url', help='Benchmark a running server instead of starting main.py.')
+    parser.add_argument('--port', type=int, default=5050, help='Port of the server started by the benchmark.')
+    parser.add_argument('--clients', type=int, default=1000, help='Number of simulated users.')
+    parser.add_argument('--room-size', type=int, default=10, help='Number of users per room.')
+    parser.add_argument('--messages', type=int, default=10, help='Messages sent by every user.')
+    parser.add_argument('--interval', type=float, default=0.1, help='Seconds between the messages of a user.')
+    parser.add_argument('--concurrency', type=int, default=100, help='Maximum concurrent REST calls and connects.')
+    parser.add_argument('--transports', nargs='+', default=['polling', 'websocket'], help='Socket.IO transports.')
+    parser.add_argument('--drain-timeout', type=float, default=30, help='Seconds to wait for the last deliveries.')
+    parser.add_argument('--output', help='Save the report to this JSON file.')
+    parser.add_argument('--compare', help='Compare with the report saved in this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed regression, as a fraction.')
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(report, json.load(baseline), args.tolerance)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,177 @@
+import argparse
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+import time
+from socketio import PubSubManager
+
+"""
+This module lets several backend processes share Socket.IO rooms and broadcasts without an outside service.
+A small broker process listens on a local Unix socket and relays every frame it receives to all the other
+connected workers. Each worker uses UnixSocketManager as its Socket.IO client manager, so join/leave,
+emits and disconnects made on one worker reach the clients connected to every other worker.
+A connection opens with one role byte: SUBSCRIBER connections publish and receive, PUBLISHER connections
+only publish. Frames are a 4-byte big-endian length followed by a pickled pub/sub message. The socket file
+is created with 0600 permissions, so only processes of the same user can publish.
+Classes:
+    UnixSocketManager: Socket.IO pub/sub client manager talking to the broker.
+    BrokerServer: The relay server.
+Functions:
+    run_broker(path): Runs the broker on a Unix socket path until interrupted.
+Usage:
+    python broker.py --path /tmp/chat-broker.sock
+"""
+
+HEADER = struct.Struct('>I')
+SUBSCRIBER = b'S'
+PUBLISHER = b'P'
+
+def read_frame(connection):
+    """
+    Reads one frame from a socket.
+    Returns:
+        bytes: The frame payload, or None if the peer closed the connection.
+    """
+    header = _read_exactly(connection, HEADER.size)
+    if header is None:
+        return None
+    return _read_exactly(connection, HEADER.unpack(header)[0])
+
+def _read_exactly(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+class UnixSocketManager(PubSubManager):
+    """
+    Socket.IO client manager that publishes through the broker listening on a Unix socket.
+    Args:
+        url (str): The broker address, e.g. unix:///tmp/chat-broker.sock.
+        channel (str): Kept for compatibility with the other pub/sub managers; unused.
+        write_only (bool): Only publish, for emitting from processes without a Socket.IO server.
+    """
+    name = 'unix'
+
+    def __init__(self, url='unix:///tmp/chat-broker.sock', channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len('unix://'):] if url.startswith('unix://') else url
+        self.publisher = None
+        self.publish_lock = threading.Lock()
+
+    def _connect(self, role):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.path)
+        connection.sendall(role)
+        return connection
+
+    def _publish(self, data):
+        frame = pickle.dumps(data)
+        with self.publish_lock:
+            for retries_left in range(1, -1, -1):
+                try:
+                    if self.publisher is None:
+                        self.publisher = self._connect(PUBLISHER)
+                    self.publisher.sendall(HEADER.pack(len(frame)) + frame)
+                    return
+                except OSError:
+                    self.publisher = None
+                    if not retries_left:
+                        self._get_logger().error('Cannot publish to the broker at %s, giving up', self.path)
+
+    def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                connection = self._connect(SUBSCRIBER)
+            except OSError:
+                self._get_logger().error('Cannot reach the broker at %s, retrying in %d secs', self.path, retry_sleep)
+                time.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 60)
+                continue
+
+            retry_sleep = 1
+            with connection:
+                while True:
+                    try:
+                        frame = read_frame(connection)
+                    except OSError:
+                        frame = None
+                    if frame is None:
+                        break
+                    yield pickle.loads(frame)
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Relays every frame received from one worker to all the other connected workers.
+    """
+    daemon_threads = True
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.subscribers = {}
+        self.subscribers_lock = threading.Lock()
+        super().__init__(path, BrokerHandler)
+        os.chmod(path, 0o600)
+
+    def relay(self, sender, frame):
+        with self.subscribers_lock:
+            subscribers = [(c, lock) for c, lock in self.subscribers.items() if c is not sender]
+        for connection, lock in subscribers:
+            try:
+                with lock:
+                    connection.sendall(frame)
+            except OSError:
+                self.remove(connection)
+
+    def add(self, connection):
+        with self.subscribers_lock:
+            self.subscribers[connection] = threading.Lock()
+
+    def remove(self, connection):
+        with self.subscribers_lock:
+            self.subscribers.pop(connection, None)
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        role = _read_exactly(self.request, 1)
+        if role == SUBSCRIBER:
+            self.server.add(self.request)
+        elif role != PUBLISHER:
+            return
+        try:
+            while True:
+                payload = read_frame(self.request)
+                if payload is None:
+                    break
+                self.server.relay(self.request, HEADER.pack(len(payload)) + payload)
+        except OSError:
+            pass
+        finally:
+            self.server.remove(self.request)
+
+def run_broker(path):
+    """
+    Runs the broker on a Unix socket path until interrupted.
+    """
+    with BrokerServer(path) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Socket.IO broker for running several backend workers.')
+    parser.add_argument('--path', default='/tmp/chat-broker.sock', help='Unix socket path to listen on.')
+    run_broker(parser.parse_args().path)
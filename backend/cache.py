@@ -0,0 +1,94 @@
+from config import app
+from collections import OrderedDict
+from sqlalchemy import inspect
+import threading
+import time
+
+"""
+This module provides the per-process identity cache that turns usernames and room names into ids.
+Entries hold only the id and immutable fields of a row, so they can be shared between requests.
+The cache is bounded (least recently used entries are evicted first) and every entry expires after
+IDENTITY_CACHE_TTL_S seconds, which bounds how long another worker's changes can go unnoticed.
+MyModels.save/delete invalidate the entries of the rows they write.
+It also provides the cache of verified JWT claims used by tokens.py, whose entries expire with their token.
+Classes:
+    LRUCache: A thread-safe LRU cache with a time-to-live and hit/miss counters.
+Functions:
+    identity_keys(obj): Returns the cache keys under which a model instance may be cached.
+Objects:
+    identity_cache: The process-wide LRUCache for user and room identities.
+    token_cache: The process-wide LRUCache of verified JWT claims, keyed by token digest.
+"""
+
+KEYS = {
+    'user_model': 'username',
+    'chat_model': 'name',
+}
+
+class LRUCache():
+
+    def __init__(self, maxsize, ttl_s):
+        self.maxsize = maxsize
+        self.ttl = ttl_s
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the cached value of a key, or None if it is missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl_s=None):
+        """
+        Stores a value, evicting the least recently used entry when the cache is full.
+        ttl_s shortens the time-to-live of this entry; it never extends it past the cache's own.
+        """
+        ttl = self.ttl if ttl_s is None else min(ttl_s, self.ttl)
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """
+        Removes the entries of the given keys.
+        """
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        """
+        Returns the hit and miss counters and the current size of the cache.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+def identity_keys(obj):
+    """
+    Returns the cache keys under which a model instance may be cached, including the key
+    of a name that is being changed. Instances of models that are not cached have none.
+    """
+    field = KEYS.get(obj.__tablename__)
+    if field is None:
+        return []
+
+    history = inspect(obj).attrs[field].history
+    values = {getattr(obj, field), *history.deleted}
+    return [(obj.__tablename__, value) for value in values]
+
+identity_cache = LRUCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL_S'])
+token_cache = LRUCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL_S'])
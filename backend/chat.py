@@ -1,316 +1,887 @@
 from flask import request, jsonify, session
 from config import app, socketio, db
 from models import ChatModel, UserModel, UserChatModel, MessageModel
-from flask_jwt_extended import jwt_required
-from flask_socketio import join_room, leave_room, send, emit
-import datetime
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from flask_socketio import ConnectionRefusedError, join_room, leave_room, send
+from tokens import verify_access_token
+from querycount import max_queries
+from metrics import observe_event
+from writebehind import message_writer
+from presence import presence_registry, user_channel
+from history import room_history, serialize_message
+import wire
+import archive
+from sqlalchemy.orm import aliased
+import search
 
 """
 This module provides the backend functionality for a real-time chat application using Flask and Flask-SocketIO.
 Routes:
     - /chat/create_room (POST): Creates a new chat room.
-    - /chat/get_rooms (GET): Retrieves all chat rooms associated with a user.
+    - /chat/bulk_create_rooms (POST): Creates many chat rooms for the current user in one transaction.
+    - /chat/bulk_add_users (POST): Adds many users to many of the current user's chat rooms in one transaction.
+    - /chat/bulk_remove_users (DELETE): Removes many users from many of the current user's chat rooms in one transaction.
+    - /chat/get_rooms (GET): Retrieves all chat rooms associated with a user, with last message previews and unread counts.
+    - /chat/mark_read (POST): Moves a user's read cursor in a chat room to its latest message.
     - /chat/find_chats (GET): Searches for users and chat rooms based on a search item.
     - /chat/add_user_to_chat (POST): Adds a user to a chat room.
     - /chat/remove_user_from_chat (DELETE): Removes a user from a chat room.
     - /chat/save_message (POST): Saves a message to a chat room.
-    - /chat/get_messages (GET): Retrieves all messages from a chat room.
+    - /chat/search_messages (GET): Searches message bodies in the user's rooms, best match first.
+    - /chat/get_messages (GET): Retrieves a page of messages from a chat room, newest first, or the messages
+      newer than a given id for reconnecting clients. Unchanged rooms are answered with 304 via ETag
+      and large pages are compressed.
 SocketIO Events:
-    - join: Joins a user to a chat room.
-    - leave: Removes a user from a chat room and clears the session.
-    - message: Handles sending messages to a chat room.
-    - exit: Handles user exit from a chat room and sends a message to the room.
-    - connect_room: Connects a user to a chat room, sends a message, and then leaves the room.
+    - connect: Authenticates the connection with the access token of its auth payload, registers it with the
+      presence registry, records its wire format and subscribes it to the user's private channel and to
+      every room of the user.
+    - disconnect: Removes the connection from the presence registry.
+    - heartbeat: Keeps the connection's user online in the presence registry.
+    - subscribe: Subscribes the connection to rooms the user was added to.
+    - unsubscribe: Unsubscribes the connection from rooms the user was removed from.
+    - join: Opens a chat room on the connection and acknowledges with the room's latest messages.
+    - leave: Closes the open chat room; the connection stays subscribed to it.
+    - message: Saves a message through the write-behind queue, which broadcasts it to the chat room.
+    - exit: Handles user exit from a chat room, sends a message to the room and unsubscribes from it.
+    - connect_room: Sends a message to a chat room the user just joined.
+Connections are authenticated once, at the handshake; the events act as the user stored in the
+connection's session and ignore any username they carry.
+A connection receives the messages of every room it is subscribed to, each tagged with its room name.
+Membership changes are pushed on the users' private channels as 'invited' and 'removed' events
+({"rooms": [names]}), which clients answer with subscribe and unsubscribe.
 Dependencies:
     - Flask
     - Flask-JWT-Extended
     - Flask-SocketIO
-    - datetime
     - config (app, socketio, db)
+    - querycount (max_queries)
+    - metrics (observe_event)
+    - writebehind (message_writer)
+    - presence (presence_registry, user_channel)
+    - history (room_history, serialize_message)
+    - wire
+    - archive
+    - search
+    - tokens (verify_access_token)
     - models (ChatModel, UserModel, UserChatModel, MessageModel)
 """
 
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+BULK_MAX_ITEMS = 5000
+
+def notify_memberships(event, memberships):
+    """
+    Pushes membership changes to the private channel of every affected user, so that the user's
+    connections subscribe to, or unsubscribe from, the rooms.
+    Args:
+        event (str): 'invited' or 'removed'.
+        memberships (iterable): (user_id, room name) pairs.
+    """
+    rooms_by_user = {}
+    for user_id, room in memberships:
+        rooms_by_user.setdefault(user_id, []).append(room)
+    for user_id, rooms in rooms_by_user.items():
+        wire.broadcast(event, {"rooms": rooms}, user_channel(user_id))
+
+def member_rooms(user_id, names=None):
+    """
+    Returns the chat rooms a user is a member of, read in one query.
+    Args:
+        user_id (int): The id of the user.
+        names (list, optional): Only look at the rooms with these names.
+    Returns:
+        dict: Room names mapped to their chat ids.
+    """
+    query = db.session.query(ChatModel.name, ChatModel.id) \
+        .join(UserChatModel, UserChatModel.chat_id == ChatModel.id) \
+        .filter(UserChatModel.user_id == user_id)
+    if names is not None:
+        query = query.filter(ChatModel.name.in_(names))
+    return dict(query.all())
+
+def subscribe(rooms):
+    """
+    Subscribes the current connection to chat rooms and records them in its session.
+    Args:
+        rooms (dict): Room names mapped to their chat ids.
+    """
+    for room in rooms:
+        join_room(wire.room_for(request.sid, wire.room_channel(room)))
+    session.setdefault('rooms', {}).update(rooms)
+
+def unsubscribe(rooms):
+    """
+    Unsubscribes the current connection from chat rooms, closing the open room if it is one of them.
+    Args:
+        rooms (list): Room names.
+    """
+    subscribed = session.setdefault('rooms', {})
+    for room in rooms:
+        if subscribed.pop(room, None) is not None:
+            leave_room(wire.room_for(request.sid, wire.room_channel(room)))
+        if session.get('room') == room:
+            session.pop('room')
+            session.pop('chat_id', None)
+
+def broadcast_saved_message(message_id, room, chat_id):
+    """
+    Broadcasts a message of the connection's user, saved through /chat/save_message, to its room.
+    Clients only name the message by id; its id, text and time are read back from the database,
+    so a client cannot broadcast a message that was not saved or push forged ids to other clients.
+    Args:
+        message_id (int): The id the message was saved under.
+        room (str): The name of the chat room.
+        chat_id (int): The id of the chat room.
+    Returns:
+        bool: True if the message was broadcast, False if the user has no such message in the room.
+    """
+    if not isinstance(message_id, int):
+        return False
+    message = db.session.query(MessageModel.id, MessageModel.message, MessageModel.created_at) \
+        .filter(MessageModel.id == message_id, MessageModel.chat_id == chat_id,
+                MessageModel.user_id == session['user_id']) \
+        .first()
+    if message is None:
+        return False
+
+    payload = serialize_message(message.id, session['username'], message.message, message.created_at)
+    wire.broadcast('message', dict(payload, room=room), wire.room_channel(room))
+    return True
+
+def bulk_pairs(data):
+    """
+    Returns the distinct (username, room) pairs of a bulk membership request, in request order.
+    Args:
+        data (dict): The request body, with the 'usernames' and 'rooms' lists; every user is paired with every room.
+    Returns:
+        list: The pairs, or None if the body is malformed or has more than BULK_MAX_ITEMS pairs.
+    """
+    usernames = data.get('usernames') if isinstance(data, dict) else None
+    rooms = data.get('rooms') if isinstance(data, dict) else None
+    if not isinstance(usernames, list) or not isinstance(rooms, list) \
+            or not all(isinstance(x, str) for x in usernames + rooms):
+        return None
+    usernames = list(dict.fromkeys(usernames))
+    rooms = list(dict.fromkeys(rooms))
+    if len(usernames) * len(rooms) > BULK_MAX_ITEMS:
+        return None
+    return [(username, room) for room in rooms for username in usernames]
+
+def bulk_resolve(pairs, actor_id):
+    """
+    Resolves the users and rooms of bulk membership pairs in one query each, and checks in one more
+    query that the acting user is a member of every room.
+    Args:
+        pairs (list): (username, room) pairs, from bulk_pairs().
+        actor_id (int): The id of the user making the request.
+    Returns:
+        list: A (username, room, (user_id, chat_id), error) tuple per pair, where the ids are None and
+        error is 'user_not_found' or 'room_not_found' when the user or the room does not exist, and
+        'forbidden' when the acting user is not a member of the room.
+    """
+    users = UserModel.get_user_refs(list(dict.fromkeys(username for username, _ in pairs)))
+    rooms = ChatModel.get_room_refs(list(dict.fromkeys(room for _, room in pairs)))
+    allowed = member_rooms(actor_id, list(rooms))
+
+    resolved = []
+    for username, room in pairs:
+        if username not in users:
+            resolved.append((username, room, None, 'user_not_found'))
+        elif room not in rooms:
+            resolved.append((username, room, None, 'room_not_found'))
+        elif room not in allowed:
+            resolved.append((username, room, None, 'forbidden'))
+        else:
+            resolved.append((username, room, (users[username].id, rooms[room].id), None))
+    return resolved
+
 @app.route('/chat/create_room', methods=['POST'])
+@max_queries(6)
 @jwt_required()
 def create_room():
     """
-    Creates a new chat room and adds a user to it.
+    Creates a new chat room and adds the current user to it.
     This function retrieves JSON data from the request, checks if a chat room with the given name already exists,
-    and if not, creates a new chat room and adds the specified user to it.
+    and if not, creates a new chat room and adds the current user, the one of the access token, to it
+    in the same transaction.
+    The user's connections are told to subscribe to the room with an 'invited' event.
     Returns:
         Response: A JSON response indicating the success or failure of the room creation.
         - 201: Room created successfully.
         - 401: Room already exists.
+        - 404: User not found.
     """
     data = request.get_json()
 
-    room = ChatModel.get_room_by_name(data.get('room'))
+    user = UserModel.get_user_ref(get_jwt_identity())
+    if user is None:
+        return jsonify({"msg": "User not found!"}), 404
+    room = ChatModel.get_room_ref(data.get('room'))
     if room is not None:
         return jsonify({"msg": "Room already exist!"}), 401
     new_room = ChatModel(name=data.get('room'), type=data.get('type'))
-    new_room.save()
-    
-    user = UserModel.get_user_by_username(data.get('username'))
+    new_room.save(commit=False)
 
     user_chat = UserChatModel(user_id=user.id, chat_id=new_room.id)
     user_chat.save()
+    notify_memberships('invited', [(user.id, new_room.name)])
 
     return jsonify({"msg": "Room created!"}), 201
 
 
+@app.route('/chat/bulk_create_rooms', methods=['POST'])
+@max_queries(4)
+@jwt_required()
+def bulk_create_rooms():
+    """
+    Creates many chat rooms and adds the current user, the one of the access token, to each of them,
+    in one transaction.
+    Rooms that already exist are left untouched, so repeating a request is harmless.
+    The user's connections are told to subscribe to the created rooms with one 'invited' event.
+    Request JSON format:
+    {
+        "rooms": [{"room": "string", "type": "string"}, ...]
+    }
+    Returns:
+        Response: A JSON response with one result per room: 'created' or 'exists'.
+        - 200: Request processed.
+        - 400: Malformed request or more than BULK_MAX_ITEMS rooms.
+        - 404: User not found.
+    """
+    data = request.get_json()
+
+    rooms = data.get('rooms') if isinstance(data, dict) else None
+    if not isinstance(rooms, list) or len(rooms) > BULK_MAX_ITEMS \
+            or not all(isinstance(x, dict) and isinstance(x.get('room'), str) and isinstance(x.get('type'), str)
+                       for x in rooms):
+        return jsonify({"msg": "Invalid rooms!"}), 400
+
+    user = UserModel.get_user_ref(get_jwt_identity())
+    if user is None:
+        return jsonify({"msg": "User not found!"}), 404
+
+    rooms = list({x['room']: x['type'] for x in rooms}.items())
+    created = ChatModel.create_many(rooms)
+    UserChatModel.add_many([(user.id, room.id) for room in created.values()])
+    db.session.commit()
+    notify_memberships('invited', [(user.id, name) for name in created])
+
+    return jsonify({"results": [
+        {"room": name, "result": "created" if name in created else "exists"} for name, _ in rooms
+    ]}), 200
+
+@app.route('/chat/bulk_add_users', methods=['POST'])
+@max_queries(5)
+@jwt_required()
+def bulk_add_users():
+    """
+    Adds every listed user to every listed chat room, in one transaction.
+    The current user, the one of the access token, must be a member of each room; the pairs of the
+    other rooms are left untouched and reported as 'forbidden'.
+    Users and rooms are resolved with one query each and the memberships are inserted in one
+    statement; memberships that already exist are skipped, so repeating a request is harmless.
+    Every added user gets one 'invited' event listing the rooms they were added to.
+    Request JSON format:
+    {
+        "usernames": ["string", ...],
+        "rooms": ["string", ...]
+    }
+    Returns:
+        Response: A JSON response with one result per (username, room) pair: 'added',
+        'already_member', 'user_not_found', 'room_not_found' or 'forbidden'.
+        - 200: Request processed.
+        - 400: Malformed request or more than BULK_MAX_ITEMS pairs.
+        - 404: User not found.
+    """
+    pairs = bulk_pairs(request.get_json())
+    if pairs is None:
+        return jsonify({"msg": "Invalid usernames or rooms!"}), 400
+    actor = UserModel.get_user_ref(get_jwt_identity())
+    if actor is None:
+        return jsonify({"msg": "User not found!"}), 404
+
+    resolved = bulk_resolve(pairs, actor.id)
+    added = UserChatModel.add_many([ids for _, _, ids, _ in resolved if ids is not None])
+    db.session.commit()
+    notify_memberships('invited', [(ids[0], room) for _, room, ids, _ in resolved if ids in added])
+
+    return jsonify({"results": [
+        {"username": username, "room": room, "result": error or ("added" if ids in added else "already_member")}
+        for username, room, ids, error in resolved
+    ]}), 200
+
+@app.route('/chat/bulk_remove_users', methods=['DELETE'])
+@max_queries(5)
+@jwt_required()
+def bulk_remove_users():
+    """
+    Removes every listed user from every listed chat room, in one transaction.
+    The current user, the one of the access token, must be a member of each room; the pairs of the
+    other rooms are left untouched and reported as 'forbidden'.
+    Users and rooms are resolved with one query each and the memberships are deleted in one statement.
+    Every removed user gets one 'removed' event listing the rooms they were removed from.
+    Request JSON format:
+    {
+        "usernames": ["string", ...],
+        "rooms": ["string", ...]
+    }
+    Returns:
+        Response: A JSON response with one result per (username, room) pair: 'removed',
+        'not_member', 'user_not_found', 'room_not_found' or 'forbidden'.
+        - 200: Request processed.
+        - 400: Malformed request or more than BULK_MAX_ITEMS pairs.
+        - 404: User not found.
+    """
+    pairs = bulk_pairs(request.get_json())
+    if pairs is None:
+        return jsonify({"msg": "Invalid usernames or rooms!"}), 400
+    actor = UserModel.get_user_ref(get_jwt_identity())
+    if actor is None:
+        return jsonify({"msg": "User not found!"}), 404
+
+    resolved = bulk_resolve(pairs, actor.id)
+    removed = UserChatModel.remove_many([ids for _, _, ids, _ in resolved if ids is not None])
+    db.session.commit()
+    notify_memberships('removed', [(ids[0], room) for _, room, ids, _ in resolved if ids in removed])
+
+    return jsonify({"results": [
+        {"username": username, "room": room, "result": error or ("removed" if ids in removed else "not_member")}
+        for username, room, ids, error in resolved
+    ]}), 200
+
 @app.route('/chat/get_rooms', methods=['GET'])
+@max_queries(1)
 @jwt_required()
 def get_rooms():
     """
-    Retrieve the list of chat rooms associated with a user.
-    This function extracts the username from the request arguments, fetches the user
-    details from the UserModel, and then retrieves all chat rooms associated with the
-    user's ID from the UserChatModel. The names of these chat rooms are then returned
-    in a JSON response.
+    Retrieve the list of chat rooms associated with a user, with their last message and unread count.
+    This function takes the username from the access token, whose claims are cached once
+    verified, and retrieves the names of all chat rooms the user belongs to in a single query joining ChatModel,
+    UserChatModel and UserModel. The last message and the message count are kept on
+    ChatModel as messages are inserted, and the user's read cursor on UserChatModel,
+    so the sidebar is served without reading the message table.
     Returns:
-        tuple: A JSON response containing a list of chat room names and an HTTP status code 200.
+        tuple: A JSON response and an HTTP status code 200, with:
+        - rooms: A list of chat room names.
+        - previews: For each room name, its last message (id, username, text, timestamp and
+          dateTime, or None for an empty room) and the number of messages the user has not read.
     """
-    username = request.args.get('user')
-    user = UserModel.get_user_by_username(username)
+    username = get_jwt_identity()
+
+    sender = aliased(UserModel)
+    rooms = db.session.query(ChatModel.name, ChatModel.last_message_id, ChatModel.last_message_preview,
+                             ChatModel.last_message_at, sender.username.label('sender'),
+                             (ChatModel.message_count - UserChatModel.read_count).label('unread')) \
+        .join(UserChatModel, UserChatModel.chat_id == ChatModel.id) \
+        .join(UserModel, UserModel.id == UserChatModel.user_id) \
+        .outerjoin(sender, sender.id == ChatModel.last_message_user_id) \
+        .filter(UserModel.username == username) \
+        .all()
+
+    previews = {
+        room.name: {
+            "last_message": serialize_message(room.last_message_id, room.sender, room.last_message_preview,
+                                              room.last_message_at) if room.last_message_at is not None else None,
+            "unread": max(room.unread, 0)
+        }
+        for room in rooms
+    }
+    return jsonify({"rooms": [room.name for room in rooms], "previews": previews}), 200
 
-    rooms = UserChatModel.query.filter_by(user_id=user.id).all()
-    rooms_name = []
-    for room in rooms:
-        rooms_name.append(room.chat.name)
+@app.route('/chat/mark_read', methods=['POST'])
+@max_queries(3)
+@jwt_required()
+def mark_read():
+    """
+    Marks every message of a chat room as read by the current user, clearing the room's unread count.
+    The current user is the one of the access token.
+    Request JSON format:
+    {
+        "room": "string"
+    }
+    Returns:
+        Response: A JSON response indicating the result.
+        - 200: Read cursor moved.
+        - 404: User, room or membership not found.
+    """
+    data = request.get_json()
 
-    return jsonify({"rooms": rooms_name}), 200
+    user = UserModel.get_user_ref(get_jwt_identity())
+    chat = ChatModel.get_room_ref(data.get('room'))
+    if user is None or chat is None or not UserChatModel.mark_read(user.id, chat.id):
+        return jsonify({"msg": "Membership not found!"}), 404
+    db.session.commit()
+
+    return jsonify({"msg": "Room marked as read!"}), 200
 
 @app.route('/chat/find_chats', methods=['GET'])
+@max_queries(2)
 @jwt_required()
 def find_chats():
     """
     Find chats and users based on a search item.
-    This function retrieves users and chat rooms that match a given search item.
+    This function retrieves users and chat rooms whose name contains a given search item,
+    using the trigram full-text indexes of the search module.
     It excludes the current user from the search results and also excludes chat
-    rooms that the current user is already a part of.
+    rooms that the current user is already a part of, using a membership subquery
+    so the search runs in two statements however many rooms the user is in.
+    The current user is the one of the access token.
     Query Parameters:
     - item (str): The search term to filter users and chat rooms.
-    - user (str): The username of the current user.
     Returns:
     - Response: A JSON response containing two lists:
         - users: A list of dictionaries with 'username' and 'status' of matching users.
         - rooms: A list of names of matching chat rooms.
     """
     search_item = request.args.get('item')
-    username = request.args.get('user')
+    username = get_jwt_identity()
 
-    user = UserModel.get_user_by_username(username)
-    user_chat = UserChatModel.query.filter_by(user_id=user.id).all()
+    memberships = db.select(UserChatModel.chat_id) \
+        .join(UserModel, UserModel.id == UserChatModel.user_id) \
+        .where(UserModel.username == username)
 
-    users = UserModel.query.filter(UserModel.username.like(f'%{search_item}%'), UserModel.id != user.id).all()
+    users = UserModel.query.filter(search.matches(UserModel, search_item), UserModel.username != username).all()
     rooms = ChatModel.query.filter(
-        ChatModel.name.like(f'%{search_item}%'), 
-        ChatModel.id.notin_([chat.chat_id for chat in user_chat])
+        search.matches(ChatModel, search_item), 
+        ChatModel.id.notin_(memberships)
         ).all()
 
-    json_users = list(map(lambda x: {'username':x.username, "status":x.status}, users))
+    json_users = list(map(lambda x: {'username':x.username, "status":presence_registry.status_of(x.id, x.status)}, users))
     json_rooms = list(map(lambda x: x.name, rooms))
 
     return jsonify({"users": json_users, "rooms": json_rooms}), 200
 
 
 @app.route('/chat/add_user_to_chat', methods=['POST'])
+@max_queries(3)
 @jwt_required()
 def add_user_to_chat():
     """
-    Adds a user to a chat room.
-    This function retrieves JSON data from the request, gets the user and chat room
-    based on the provided username and room name, creates a UserChatModel instance
+    Adds the current user to a chat room.
+    This function retrieves JSON data from the request, gets the current user, the one of the
+    access token, and the chat room based on the provided room name, creates a UserChatModel instance
     to link the user to the chat room, and saves this instance to the database.
+    The user's connections are told to subscribe to the room with an 'invited' event.
+    Request JSON format:
+    {
+        "room": "string"
+    }
     Returns:
-        Response: A JSON response with a success message and a 201 status code.
+        Response: A JSON response indicating the result.
+        - 201: User added to the room.
+        - 404: User or room not found.
     """
     data = request.get_json()
 
-    user = UserModel.get_user_by_username(data.get('username'))
-    chat = ChatModel.get_room_by_name(data.get('room'))
+    user = UserModel.get_user_ref(get_jwt_identity())
+    chat = ChatModel.get_room_ref(data.get('room'))
+    if user is None or chat is None:
+        return jsonify({"msg": "Room not found!"}), 404
 
     user_chat = UserChatModel(user_id=user.id, chat_id=chat.id)
     user_chat.save()
+    notify_memberships('invited', [(user.id, chat.name)])
 
     return jsonify({"msg": "User added to chat!"}), 201
 
 @app.route('/chat/remove_user_from_chat', methods=['DELETE'])
+@max_queries(4)
 @jwt_required()
 def remove_user_from_chat():
     """
-    Remove a user from a chat room.
-    This function retrieves the user and chat room information from the request JSON payload,
-    finds the corresponding UserChatModel entry, and deletes it from the database.
+    Remove the current user from a chat room.
+    This function retrieves the chat room from the request JSON payload and the current user from
+    the access token, finds the corresponding UserChatModel entry, and deletes it from the database.
+    The user's connections are told to unsubscribe from the room with a 'removed' event.
     Request JSON format:
     {
-        "username": "string",
         "room": "string"
     }
     Returns:
         Response: A JSON response indicating the success or failure of the operation.
         - 200: If the user is successfully removed from the chat room.
+        - 404: If the user is not a member of the chat room.
         - 500: If there is an error during the removal process.
     """
     data = request.get_json()
 
-    user = UserModel.get_user_by_username(data.get('username'))
-    chat = ChatModel.get_room_by_name(data.get('room'))
-    user_chat = UserChatModel.query.filter_by(user_id=user.id, chat_id=chat.id).first()
+    user = UserModel.get_user_ref(get_jwt_identity())
+    chat = ChatModel.get_room_ref(data.get('room'))
+    user_chat = UserChatModel.query.filter_by(user_id=user.id, chat_id=chat.id).first() \
+        if user is not None and chat is not None else None
+    if user_chat is None:
+        return jsonify({"msg": "Membership not found!"}), 404
 
     try:
         db.session.delete(user_chat)
         db.session.commit()
+        notify_memberships('removed', [(user.id, chat.name)])
         return jsonify({"msg": "User removed from chat!"}), 200
     except:
         db.session.rollback()
         return jsonify({"msg": "Failed to remove user from chat!"}), 500
 
 @app.route('/chat/save_message', methods=['POST'])
+@max_queries(6)
 @jwt_required()
 def save_message():
     """
     Save a new chat message to the database.
-    This function retrieves JSON data from the request, extracts the username,
-    room name, and message text, and saves the message to the database with the
-    current timestamp.
+    This function retrieves JSON data from the request, extracts the room name and message text,
+    and saves the message of the current user, the one of the access token, to the database with
+    the current timestamp. The user must be a member of the room.
+    Request JSON format:
+    {
+        "room": "string",
+        "text": "string"
+    }
     Returns:
-        Response: A JSON response containing the saved message and timestamp,
-                  along with a 201 status code.
+        Response: A JSON response indicating the result.
+        - 201: The saved message, its id, its timestamp in epoch milliseconds and the formatted date.
+        - 400: The message is not a non-empty string.
+        - 404: User, room or membership not found.
     """
     data = request.get_json()
 
-    user = UserModel.get_user_by_username(data.get('username'))
-    chat = ChatModel.get_room_by_name(data.get('room'))
     message = data.get('text')
-    date = datetime.datetime.now().strftime("%b %d, %Y %I:%M %p")
-
-    new_message = MessageModel(message=message, user_id=user.id, chat_id=chat.id, created_at=date)
-    new_message.save()
+    if not isinstance(message, str) or not message.strip():
+        return jsonify({"msg": "Message must be a non-empty string!"}), 400
+    room = data.get('room')
+    user = UserModel.get_user_ref(get_jwt_identity())
+    chat_id = member_rooms(user.id, [room]).get(room) if user is not None and isinstance(room, str) else None
+    if chat_id is None:
+        return jsonify({"msg": "Membership not found!"}), 404
+    created_at = MessageModel.timestamp()
+
+    new_message = MessageModel(message=message, user_id=user.id, chat_id=chat_id, created_at=created_at)
+    message_id = new_message.save()
 
     return jsonify({
+        'id': message_id,
         'message': message,
-        'dateTime': date
+        'timestamp': created_at,
+        'dateTime': MessageModel.format_timestamp(created_at)
     }), 201
 
+@app.route('/chat/search_messages', methods=['GET'])
+@max_queries(1)
+@jwt_required()
+def search_messages():
+    """
+    Search the messages of the rooms the current user belongs to.
+    Results are ranked by relevance (bm25) and paginated. The current user is the one of the access token.
+    Query Parameters:
+    - q (str): The text to look for, at least 3 characters long.
+    - page (int, optional): The 1-based page number (default 1).
+    - limit (int, optional): Results per page (default 20, max 100).
+    Returns:
+        tuple: A JSON response with the matching messages and whether more pages exist,
+        and an HTTP status code.
+        - 200: Search completed.
+        - 400: The search text is too short.
+    """
+    term = request.args.get('q', '')
+    username = get_jwt_identity()
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), SEARCH_MAX_PAGE_SIZE)
+
+    if len(term) < search.MIN_TERM_LENGTH:
+        return jsonify({"msg": f"Search text must be at least {search.MIN_TERM_LENGTH} characters!"}), 400
+
+    results = search.search_messages(username, term, limit=limit + 1, offset=(page - 1) * limit)
+
+    messages_json = list(map(lambda x: {"id": x.id,
+                                        "room": x.room,
+                                        "username": x.username,
+                                        "text": x.message,
+                                        'timestamp': x.created_at,
+                                        'dateTime': MessageModel.format_timestamp(x.created_at)}
+                                        , results[:limit]))
+
+    return jsonify({"messages": messages_json, "page": page, "has_more": len(results) > limit}), 200
+
 @app.route('/chat/get_messages')
+@max_queries(2)
 @jwt_required()
 def get_messages():
     """
-    Retrieve messages for a specific chat room.
-    This function extracts the 'room' parameter from the request arguments,
-    fetches the corresponding chat room from the database, and retrieves all
-    messages associated with that room. The messages are then formatted into
-    a JSON-compatible structure and returned as a JSON response.
+    Retrieve a page of messages for a specific chat room.
+    Pages are walked from the newest message backwards using a keyset cursor, so a page
+    costs the same regardless of how long the room's history is. Messages inside a page
+    are returned in chronological order, ready to be prepended to the ones already shown.
+    A reconnecting client passes after_id instead to receive only the messages it missed.
+    since/until limit the page to a time range, answered from the (chat_id, created_at) index.
+    Pages reaching past the messages left in the table continue in the room's archive (see archive.py).
+    Every response carries an ETag derived from the room's last message id. It validates delta syncs
+    only: a request with an after_id at or past the room's last message, whose If-None-Match matches,
+    is answered with 304 without reading the message table. Other pages ignore If-None-Match, since
+    the ETag does not depend on their cursor or range.
+    Pages larger than COMPRESSION_MIN_BYTES are sent brotli or gzip compressed.
+    Query Parameters:
+    - room (str): The name of the chat room.
+    - before_id (int, optional): Only return messages older than this message id.
+    - after_id (int, optional): Only return messages newer than this message id, oldest first.
+    - since (int, optional): Only return messages created at or after this time, in epoch milliseconds.
+    - until (int, optional): Only return messages created before this time, in epoch milliseconds.
+    - limit (int, optional): Maximum number of messages to return (default 50, max 200).
     Returns:
-        tuple: A tuple containing a JSON response with the messages and an HTTP status code 200.
+        tuple: A JSON response with the messages, the cursor for the next page
+        and whether more messages exist, and an HTTP status code.
+        - 200: Page retrieved successfully.
+        - 304: The room has no new messages since the ETag sent by the client.
+        - 404: Room not found.
     """
     room = request.args.get('room')
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    since = request.args.get('since', type=int)
+    until = request.args.get('until', type=int)
+    limit = min(max(request.args.get('limit', MESSAGES_PAGE_SIZE, type=int), 1), MESSAGES_MAX_PAGE_SIZE)
+
+    found = ChatModel.get_room_last_message_id(room)
+    if found is None:
+        return jsonify({"msg": "Room not found!"}), 404
+    chat, last_message_id = found
+
+    etag = f'{chat.id}-{last_message_id}'
+    if after_id is not None and after_id >= last_message_id and request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    messages = archive.get_page(chat.id, before_id=before_id, after_id=after_id,
+                                since=since, until=until, limit=limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after_id is None:
+        messages.reverse()
+
+    messages_json = list(map(lambda x: serialize_message(x.id, x.username, x.message, x.created_at), messages))
+
+    response = jsonify({
+        'messages': messages_json,
+        'next_before_id': messages[0].id if has_more and after_id is None else None,
+        'next_after_id': messages[-1].id if has_more and after_id is not None else None,
+        'has_more': has_more
+    })
+    response.set_etag(etag)
+
+    return wire.compress(response), 200
+
+@socketio.on('connect')
+@observe_event('connect')
+def on_socket_connect(auth=None):
+    """
+    Handles a new Socket.IO connection.
+    The connection is authenticated here, once: its access token is verified (through the cache of
+    verified tokens) and the user's identity is stored in the connection's session, where the other
+    events read it. Connections without a valid access token are refused.
+    The connection is registered with the presence registry, which marks the user online, and joins
+    the user's private channel where presence changes of the user's room co-members and membership
+    changes are pushed. It is also subscribed to every room of the user, read in one query, so one
+    connection receives the messages of all of them.
+    Args:
+        auth (dict): The auth payload of the client.
+            - 'token' (str): The access token of the signed-in user.
+            - 'format' (str, optional): 'msgpack' to receive MessagePack-encoded events (see wire.py).
+    Raises:
+        ConnectionRefusedError: The token is missing, invalid or expired, or its user does not exist.
+    """
+    username = verify_access_token((auth or {}).get('token'))
+    user = UserModel.get_user_ref(username) if username else None
+    if user is None:
+        raise ConnectionRefusedError('Invalid token!')
+
+    wire.negotiate(request.sid, auth)
+    session['username'] = user.username
+    session['user_id'] = user.id
+    join_room(wire.room_for(request.sid, user_channel(user.id)))
+    subscribe(member_rooms(user.id))
+    presence_registry.connect(request.sid, user.id, user.username)
+
+@socketio.on('disconnect')
+@observe_event('disconnect')
+def on_socket_disconnect(reason=None):
+    """
+    Handles a closed Socket.IO connection by removing it from the presence registry.
+    """
+    presence_registry.disconnect(request.sid)
+    wire.forget(request.sid)
 
-    chat = ChatModel.get_room_by_name(room)
-    messages = chat.message
+@socketio.on('heartbeat')
+@observe_event('heartbeat')
+def on_heartbeat():
+    """
+    Handles a client heartbeat, keeping the connection's user online.
+    """
+    presence_registry.heartbeat(request.sid)
 
-    messages_json = list(map(lambda x: {"username": x.user.username, 
-                                        "text": x.message, 
-                                        'dateTime': x.created_at}
-                                        , messages))
+@socketio.on('subscribe')
+@observe_event('subscribe')
+def on_subscribe(data):
+    """
+    Subscribes the connection to rooms, usually those of an 'invited' event.
+    Rooms the signed-in user is not a member of are ignored.
+    Args:
+        data (dict): A dictionary containing the room names.
+            - 'rooms' (list): The names of the rooms.
+    """
+    subscribe(member_rooms(session['user_id'], data['rooms']))
 
-    return jsonify({'messages': messages_json}), 200
+@socketio.on('unsubscribe')
+@observe_event('unsubscribe')
+def on_unsubscribe(data):
+    """
+    Unsubscribes the connection from rooms, usually those of a 'removed' event.
+    Args:
+        data (dict): A dictionary containing the room names.
+            - 'rooms' (list): The names of the rooms.
+    """
+    unsubscribe(data['rooms'])
 
 @socketio.on('join')
+@observe_event('join')
 def on_join(data):
     """
-    Handles the event when a user joins a chat room.
+    Handles the event when the connection's user opens a chat room.
 
     Args:
-        data (dict): A dictionary containing the username and room information.
-            - 'username' (str): The username of the user joining the room.
+        data (dict): A dictionary containing the room information.
             - 'room' (str): The name of the chat room to join.
 
+    Returns:
+        dict: The acknowledgement with the latest page of the room, served from the room's
+        in-memory history buffer and read from the database only when the buffer misses.
+            - 'messages' (list): The latest messages, oldest first.
+            - 'next_before_id' (int): The before_id of the next older page, or None.
+            - 'has_more' (bool): Whether older messages exist.
+            - 'etag' (str): The room's ETag, as sent by /chat/get_messages.
+        or, when the room does not exist or the user is not one of its members:
+            - 'msg' (str): The error message.
+        Binary clients receive the acknowledgement MessagePack-encoded.
+
     Side Effects:
-        - Sets the 'username' and 'room' in the session.
-        - Joins the user to the specified chat room.
+        - Sets the open 'room' and its id in the session.
+        - Subscribes the connection to the room if it is not already.
     """
-    session['username'] = data['username']
-    session['room'] = data['room']
-    join_room(session['room'])
+    chat = ChatModel.get_room_ref(data['room'])
+    if chat is None:
+        return wire.pack(request.sid, {"msg": "Room not found!"})
+
+    if chat.name not in session.get('rooms', {}):
+        # rooms the connection is subscribed to were checked when it subscribed
+        if not member_rooms(session['user_id'], [chat.name]):
+            return wire.pack(request.sid, {"msg": "Not a member of the room!"})
+        subscribe({chat.name: chat.id})
+    session['room'] = chat.name
+    session['chat_id'] = chat.id
+
+    last_message_id = ChatModel.get_last_message_ids([chat.id]).get(chat.id, 0)
+    page = room_history.snapshot(chat.id, last_message_id)
+    if page is None:
+        messages = archive.get_page(chat.id, limit=room_history.capacity + 1)
+        has_more = len(messages) > room_history.capacity
+        messages = messages[:room_history.capacity]
+        messages.reverse()
+        page = room_history.fill(chat.id,
+                                 [serialize_message(x.id, x.username, x.message, x.created_at) for x in messages],
+                                 has_more)
+    return wire.pack(request.sid, page)
 
 @socketio.on('leave')
+@observe_event('leave')
 def on_leave():
     """
-    Handles the event when a user leaves a chat room.
-
-    This function performs the following actions:
-    1. Removes the user from the chat room specified in the session.
-    2. Clears the session data.
-
+    Handles the event when a user closes the open chat room.
+    The connection stays subscribed to the room, so its messages keep updating the room list.
     Returns:
         None
     """
-    leave_room(session['room'])
-    session.clear()
+    session.pop('room', None)
+    session.pop('chat_id', None)
 
 @socketio.on('message')
+@observe_event('message')
 def handle_message(data):
     """
-    Handles an incoming chat message, formats it, and sends it to the specified room.
+    Handles an incoming chat message sent to one of the rooms the connection is subscribed to.
+    The message is handed to the write-behind queue, which saves it in a batch with
+    other messages and then broadcasts it to the room, in insert order, with its id.
+    Messages that are not a non-empty string are rejected with a 'message_error' event before they
+    reach the queue.
     Args:
         data (dict): A dictionary containing the message data with keys:
             - "message" (str): The content of the message.
-            - "dateTime" (str): The timestamp of when the message was sent.
+            - "room" (str, optional): The room of the message, the open room by default.
     Returns:
         None
     """
-    output = {
-        "username": f'{session['username']}',
-        "text": f'{data["message"]}',
-        "dateTime": f'{data["dateTime"]}'
-    }
-
-    send(output, to=session['room'])
+    text = data.get('message') if isinstance(data, dict) else None
+    if not isinstance(text, str) or not text.strip():
+        wire.send('message_error', {"msg": "Message must be a non-empty string!"}, request.sid)
+        return
+
+    room = data.get('room', session.get('room'))
+    chat_id = session.get('rooms', {}).get(room)
+    if chat_id is None:
+        wire.send('message_error', {"msg": "Not subscribed to the room!"}, request.sid)
+        return
+
+    message_writer.submit(
+        request.sid,
+        session['user_id'],
+        chat_id,
+        room,
+        session['username'],
+        text,
+        MessageModel.timestamp()
+    )
 
 @socketio.on('exit')
+@observe_event('exit')
 def on_exit(data):
     """
     Handles the event when a user exits a chat room.
     This function performs the following actions:
-    1. Removes the user from the current chat room.
-    2. Sends a message to the chat room indicating that the user has left.
-    3. Clears the user's session data.
+    1. Broadcasts the user's saved leave message to the chat room (see broadcast_saved_message).
+    2. Unsubscribes the connection from the room.
+    The connection must be subscribed to the room, so the client sends it before removing the user.
     Args:
         data (dict): A dictionary containing the following keys:
-            - 'message' (str): The message to be sent to the chat room.
-            - 'dateTime' (str): The date and time when the user left the chat room.
+            - 'id' (int): The id the leave message was saved under.
+            - 'room' (str, optional): The room the user left, the open room by default.
     """
-    leave_room(session['room'])
-
-    send({
-        "username": f'{session['username']}',
-        "text": data['message'],
-        "dateTime":  f'{data["dateTime"]}'
-    }, to=session['room'])
+    room = data.get('room', session.get('room'))
+    chat_id = session.get('rooms', {}).get(room)
+    if chat_id is None:
+        wire.send('message_error', {"msg": "Not subscribed to the room!"}, request.sid)
+        return
 
-    session.clear()
+    if not broadcast_saved_message(data.get('id'), room, chat_id):
+        wire.send('message_error', {"msg": "Message not found!"}, request.sid)
+    unsubscribe([room])
 
 @socketio.on('connect_room')
+@observe_event('connect_room')
 def on_connect(data):
     """
-    Handles a user connecting to a chat room.
+    Handles a user connecting to a chat room by broadcasting the user's saved message to it
+    (see broadcast_saved_message).
+    The user must be a member of the room, but the connection does not need to be subscribed to it
+    yet; it is subscribed through the 'invited' event sent when the user was added.
     Args:
         data (dict): A dictionary containing the following keys:
-            - 'username' (str): The username of the user.
             - 'room' (str): The name of the chat room.
-            - 'message' (str): The message text.
-            - 'dateTime' (str): The date and time of the message.
-    Joins the specified chat room, sends a message to the room, and then leaves the room.
-    """
-    username = data['username']
-    room = data['room']
-
-    join_room(room)
-    send({
-        "username": username,
-        "text": data['message'],
-        "dateTime":  f'{data["dateTime"]}'
-    }, to=room)
-    leave_room(room)
\ No newline at end of file
+            - 'id' (int): The id the message was saved under.
+    """
+    room = data.get('room')
+    chat_id = session.get('rooms', {}).get(room) or member_rooms(session['user_id'], [room]).get(room)
+    if chat_id is None:
+        wire.send('message_error', {"msg": "Not a member of the room!"}, request.sid)
+        return
+
+    if not broadcast_saved_message(data.get('id'), room, chat_id):
+        wire.send('message_error', {"msg": "Message not found!"}, request.sid)
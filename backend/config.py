@@ -1,17 +1,87 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager
 from flask_socketio import SocketIO
+import outbound
+import storage
+import tokens
+import json
+import os
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['ETag'])
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///chat.db'
+# becomes SQLALCHEMY_DATABASE_URI
+app.config['DATABASE_URL'] = 'sqlite:///chat.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# run on every new SQLite connection (see storage.py)
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+app.config['SQLITE_READER_POOL_SIZE'] = 8
+app.config['SQLITE_WRITER_TIMEOUT_S'] = 30
+# development keys; `main.py serve` refuses to start unless CHAT_SECRET_KEY and CHAT_JWT_SECRET_KEY are set
 app.config['JWT_SECRET_KEY'] = "015ad8e2b2ba6341ca032d34"
 app.config['SECRET_KEY'] = "gfdlkjkahdfhgfjhsahdfasugf"
+app.config['MESSAGE_BATCH_SIZE'] = 100
+app.config['MESSAGE_BATCH_INTERVAL_MS'] = 20
+app.config['PRESENCE_FLUSH_INTERVAL_MS'] = 1000
+app.config['PRESENCE_HEARTBEAT_TIMEOUT_S'] = 60
+app.config['IDENTITY_CACHE_SIZE'] = 10000
+app.config['IDENTITY_CACHE_TTL_S'] = 300
+# verified access token claims, kept until the token expires or for TOKEN_CACHE_TTL_S, whichever comes first
+app.config['TOKEN_CACHE_SIZE'] = 10000
+app.config['TOKEN_CACHE_TTL_S'] = 900
+app.config['ROOM_HISTORY_SIZE'] = 50
+app.config['ROOM_HISTORY_MEMORY_BYTES'] = 16 * 1024 * 1024
+# messages older than ARCHIVE_AFTER_DAYS are moved to ARCHIVE_DIR by archive.py
+app.config['ARCHIVE_DIR'] = os.path.join(app.instance_path, 'archive')
+app.config['ARCHIVE_AFTER_DAYS'] = 90
+app.config['ARCHIVE_BLOCK_MESSAGES'] = 1000
+app.config['COMPRESSION_MIN_BYTES'] = 1024
+app.config['COMPRESSION_GZIP_LEVEL'] = 6
+app.config['COMPRESSION_BROTLI_QUALITY'] = 5
+# werkzeug method string; stored hashes made with another method or cost are upgraded at sign-in
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt:32768:8:1'
+app.config['PASSWORD_HASH_WORKERS'] = 4
+# unix:///path/to/broker.sock (see broker.py), redis://... or amqp://... to share rooms between workers
+app.config['SOCKETIO_MESSAGE_QUEUE'] = None
+# threading, gevent or eventlet; the best installed one is picked when unset
+app.config['SOCKETIO_ASYNC_MODE'] = None
+# packets waiting for a connection before it is a slow consumer; coalesce, drop_oldest or disconnect (see outbound.py)
+app.config['OUTBOUND_QUEUE_MAX_DEPTH'] = 256
+app.config['OUTBOUND_OVERFLOW_POLICY'] = 'coalesce'
+app.config['OUTBOUND_FLUSH_INTERVAL_MS'] = 200
+# seconds `main.py serve` waits for connections to close on SIGTERM before stopping
+app.config['SHUTDOWN_DRAIN_TIMEOUT_S'] = 30
 
-db = SQLAlchemy(app)
-jwt = JWTManager(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
\ No newline at end of file
+# every setting above can be overridden with a CHAT_<NAME> environment variable, parsed as JSON when
+# possible, e.g. CHAT_SECRET_KEY=... or CHAT_MESSAGE_BATCH_SIZE=200. The settings in LEGACY_ENV_NAMES
+# are still read from their older unprefixed variables (e.g. DATABASE_URL) when the CHAT_ one is unset.
+LEGACY_ENV_NAMES = ('DATABASE_URL', 'ARCHIVE_DIR', 'SQLITE_READER_POOL_SIZE', 'SOCKETIO_MESSAGE_QUEUE',
+                    'SOCKETIO_ASYNC_MODE', 'OUTBOUND_QUEUE_MAX_DEPTH', 'OUTBOUND_OVERFLOW_POLICY')
+for name in LEGACY_ENV_NAMES:
+    if name in os.environ and f'CHAT_{name}' not in os.environ:
+        try:
+            app.config[name] = json.loads(os.environ[name])
+        except ValueError:
+            app.config[name] = os.environ[name]
+app.config.from_prefixed_env('CHAT')
+app.config['SQLALCHEMY_DATABASE_URI'] = app.config['DATABASE_URL']
+
+storage.configure(app)
+db = SQLAlchemy(app, session_options={"class_": storage.RoutingSession})
+storage.install_pragmas(app, db)
+jwt = tokens.CachingJWTManager(app)
+
+client_manager = outbound.make_manager(app.config['SOCKETIO_MESSAGE_QUEUE'],
+                                      app.config['OUTBOUND_QUEUE_MAX_DEPTH'],
+                                      app.config['OUTBOUND_OVERFLOW_POLICY'],
+                                      app.config['OUTBOUND_FLUSH_INTERVAL_MS'])
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+                    client_manager=client_manager)
@@ -0,0 +1,165 @@
+from config import app, db
+from hashing import password_hasher
+from models import ChatModel, MessageModel, UserChatModel, UserModel
+from sqlalchemy import func, select, text
+import argparse
+import bisect
+import itertools
+import migrations
+import random
+import search
+import sys
+import time
+
+"""
+This module fills an empty database with a large synthetic data set, to see how the queries of the
+backend behave at a scale the development database never reaches (see queryplans.py).
+The data is skewed like a real chat service: room popularity follows a Zipf distribution, so a few
+rooms have most of the members and most of the traffic, the number of rooms per user is geometric,
+and messages are spread over --days with ids in time order. Every user shares the same password hash,
+so loading does not spend hours in scrypt.
+Rows are inserted with executemany in batches through the writer connection, with synchronous = OFF and
+the secondary indexes, full-text indexes included, dropped during the load and rebuilt at the end by
+migrations.upgrade(). The denormalized room previews, message counts and read cursors are computed last,
+with about one membership in five left with unread messages.
+Functions:
+    zipf_weights(count, skew): Cumulative Zipf weights for weighted sampling.
+    generate(users, rooms, messages, rooms_per_user, skew, days, seed, batch_size): Loads the data set.
+Usage:
+    CHAT_DATABASE_URL=sqlite:////tmp/large.db python datagen.py --users 1000000 --rooms 100000 --messages 100000000
+"""
+
+WORDS = ('hello', 'thanks', 'meeting', 'tomorrow', 'deploy', 'lunch', 'review', 'ticket', 'ok', 'why',
+         'release', 'coffee', 'build', 'green', 'broken', 'fixed', 'later', 'today', 'please', 'done',
+         'weekend', 'question', 'link', 'docs', 'call', 'yes', 'no', 'maybe', 'soon', 'great')
+PASSWORD = 'password'
+UNREAD_SHARE = 5
+
+def zipf_weights(count, skew):
+    """
+    Returns the cumulative weights of ranks 1..count under a Zipf distribution, for random.choices.
+    """
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+def _insert(connection, statement, rows, batch_size):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, batch_size)):
+        connection.exec_driver_sql(statement, batch)
+
+def _drop_secondary_indexes(connection):
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            connection.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+    for fts, _ in search.INDEXES.values():
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS {fts}')
+
+def _message_text(rng):
+    return ' '.join(rng.choices(WORDS, k=min(int(rng.expovariate(1 / 6)) + 1, 60)))
+
+def generate(users, rooms, messages, rooms_per_user=5, skew=1.1, days=365, seed=0, batch_size=10000):
+    """
+    Loads a synthetic data set into an empty database.
+    Args:
+        users (int): Number of users.
+        rooms (int): Number of rooms.
+        messages (int): Number of messages.
+        rooms_per_user (float): Mean number of rooms a user is a member of.
+        skew (float): Zipf exponent of room popularity; higher is more skewed.
+        days (float): Messages are spread over this many days, up to now.
+        seed (int): Seed of the random generator, so a data set can be regenerated.
+        batch_size (int): Rows per executemany call.
+    """
+    rng = random.Random(seed)
+    db.create_all()
+    if db.session.query(UserModel.id).first() is not None:
+        sys.exit('datagen.py only loads an empty database; point CHAT_DATABASE_URL at a new file.')
+
+    password = password_hasher.hash(PASSWORD)
+    room_weights = zipf_weights(rooms, skew)
+
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('PRAGMA synchronous = OFF')
+        _drop_secondary_indexes(connection)
+
+        start = time.monotonic()
+        _insert(connection,
+                'INSERT INTO user_model (id, username, email, password, status) VALUES (?, ?, ?, ?, ?)',
+                ((i, f'user{i:07d}', f'user{i:07d}@example.com', password, 'offline') for i in range(1, users + 1)),
+                batch_size)
+        _insert(connection, 'INSERT INTO chat_model (id, name, type) VALUES (?, ?, ?)',
+                ((i, f'user{rng.randint(1, users):07d}#{i}', 'public') for i in range(1, rooms + 1)), batch_size)
+        print(f'users and rooms: {time.monotonic() - start:.1f}s')
+
+        # members[room] holds the user ids of a room, to pick senders among them
+        members = [[] for _ in range(rooms + 1)]
+        memberships = []
+        for user_id in range(1, users + 1):
+            count = min(int(rng.expovariate(1 / rooms_per_user)) + 1, rooms)
+            for chat_id in {bisect.bisect_left(room_weights, rng.random() * room_weights[-1]) + 1
+                            for _ in range(count)}:
+                members[chat_id].append(user_id)
+                memberships.append((user_id, chat_id))
+        for chat_id in range(1, rooms + 1):
+            if not members[chat_id]:
+                user_id = rng.randint(1, users)
+                members[chat_id].append(user_id)
+                memberships.append((user_id, chat_id))
+        _insert(connection, 'INSERT INTO user_chat_model (user_id, chat_id) VALUES (?, ?)', memberships, batch_size)
+        print(f'{len(memberships)} memberships: {time.monotonic() - start:.1f}s')
+        del memberships
+
+        now = MessageModel.timestamp()
+        first = now - int(days * 86_400_000)
+        step = (now - first) / max(messages, 1)
+
+        def message_rows():
+            for i in range(1, messages + 1):
+                chat_id = bisect.bisect_left(room_weights, rng.random() * room_weights[-1]) + 1
+                yield (i, _message_text(rng), rng.choice(members[chat_id]), chat_id, first + int(i * step))
+
+        _insert(connection, 'INSERT INTO message_model (id, message, user_id, chat_id, created_at) VALUES (?, ?, ?, ?, ?)',
+                message_rows(), batch_size)
+        print(f'{messages} messages: {time.monotonic() - start:.1f}s')
+
+    migrations.upgrade()
+    print(f'indexes: {time.monotonic() - start:.1f}s')
+
+    last_message = lambda column: select(column).where(MessageModel.id == ChatModel.last_message_id).scalar_subquery()
+    db.session.query(ChatModel).update({
+        ChatModel.last_message_id: select(func.coalesce(func.max(MessageModel.id), 0))
+            .where(MessageModel.chat_id == ChatModel.id).scalar_subquery(),
+        ChatModel.message_count: select(func.count(MessageModel.id))
+            .where(MessageModel.chat_id == ChatModel.id).scalar_subquery(),
+    }, synchronize_session=False)
+    db.session.query(ChatModel).update({
+        ChatModel.last_message_preview: func.substr(last_message(MessageModel.message), 1, ChatModel.PREVIEW_LENGTH),
+        ChatModel.last_message_user_id: last_message(MessageModel.user_id),
+        ChatModel.last_message_at: last_message(MessageModel.created_at),
+    }, synchronize_session=False)
+    room = lambda column: select(column).where(ChatModel.id == UserChatModel.chat_id).scalar_subquery()
+    db.session.query(UserChatModel).update({
+        UserChatModel.read_count: room(ChatModel.message_count),
+        UserChatModel.last_read_id: room(ChatModel.last_message_id),
+    }, synchronize_session=False)
+    db.session.execute(text(
+        f'UPDATE user_chat_model SET read_count = max(read_count - abs(random() % 50), 0) '
+        f'WHERE abs(random() % {UNREAD_SHARE}) = 0'))
+    db.session.commit()
+    db.session.execute(text('ANALYZE'))
+    print(f'previews and read cursors: {time.monotonic() - start:.1f}s')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fill an empty database with a large, skewed synthetic data set.')
+    parser.add_argument('--users', type=int, default=100_000, help='Number of users.')
+    parser.add_argument('--rooms', type=int, default=10_000, help='Number of rooms.')
+    parser.add_argument('--messages', type=int, default=1_000_000, help='Number of messages.')
+    parser.add_argument('--rooms-per-user', type=float, default=5, help='Mean number of rooms per user.')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of room popularity.')
+    parser.add_argument('--days', type=float, default=365, help='Days the messages are spread over.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--batch-size', type=int, default=10_000, help='Rows per insert batch.')
+    args = parser.parse_args()
+
+    with app.app_context():
+        generate(args.users, args.rooms, args.messages, args.rooms_per_user, args.skew, args.days,
+                 args.seed, args.batch_size)
@@ -0,0 +1,97 @@
+from config import app, socketio
+from flask import g, has_request_context
+from werkzeug.security import generate_password_hash, check_password_hash
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+"""
+This module hashes and checks passwords on a dedicated, bounded pool of worker threads.
+scrypt and pbkdf2 spend hundreds of milliseconds of CPU per call; run inline they stall every other
+request and Socket.IO client served by the same worker. With the gevent async mode the work goes to
+a native gevent ThreadPool so the hub keeps serving other greenlets; otherwise a ThreadPoolExecutor
+is used. hashlib releases the GIL while hashing, so the pool also uses more than one core.
+The hash method and cost come from PASSWORD_HASH_METHOD (a werkzeug method string such as
+"scrypt:32768:8:1" or "pbkdf2:sha256:600000") and the pool size from PASSWORD_HASH_WORKERS.
+Time spent per request is reported in a Server-Timing response header.
+Classes:
+    PasswordHasher: Runs werkzeug hashing on the pool and keeps latency counters.
+Functions:
+    add_server_timing(response): after_request hook reporting hashing time of the request.
+Objects:
+    password_hasher: The process-wide PasswordHasher.
+"""
+
+class PasswordHasher():
+
+    def __init__(self, method, workers):
+        self.method = method
+        self.workers = workers
+        self.pool = None
+        self.canonical_method = None
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def _run(self, fn, *args):
+        if self.pool is None:
+            if socketio.async_mode in ('gevent', 'gevent_uwsgi'):
+                from gevent.threadpool import ThreadPool
+                self.pool = ThreadPool(self.workers)
+            else:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+
+        start = time.perf_counter()
+        if isinstance(self.pool, ThreadPoolExecutor):
+            result = self.pool.submit(fn, *args).result()
+        else:
+            result = self.pool.apply(fn, args)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self.lock:
+            self.count += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+        if has_request_context():
+            g.password_hash_ms = g.get('password_hash_ms', 0.0) + elapsed_ms
+        return result
+
+    def hash(self, password):
+        """
+        Returns the hash of a password made with the configured method and cost.
+        """
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        """
+        Returns True if the password matches the hash.
+        """
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """
+        Returns True if the hash was made with a method or cost other than the configured one.
+        """
+        if self.canonical_method is None:
+            # werkzeug fills in default costs, so compare against the method string it actually writes
+            self.canonical_method = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self.canonical_method
+
+    def stats(self):
+        """
+        Returns the number of hashing calls and their total and maximum latency in milliseconds.
+        """
+        with self.lock:
+            return {"count": self.count, "total_ms": self.total_ms, "max_ms": self.max_ms}
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'])
+
+@app.after_request
+def add_server_timing(response):
+    """
+    Adds a Server-Timing header with the time the request spent hashing passwords, if any.
+    """
+    if 'password_hash_ms' in g:
+        response.headers.add('Server-Timing', f'password-hash;dur={g.password_hash_ms:.1f}')
+    return response
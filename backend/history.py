@@ -0,0 +1,155 @@
+from config import app
+from models import MessageModel
+from collections import OrderedDict, deque
+from werkzeug.http import quote_etag
+import threading
+
+"""
+This module keeps the latest messages of recently used rooms in memory so joining a room does not read the database.
+Every buffered room holds up to ROOM_HISTORY_SIZE serialized messages in a ring buffer that the write-behind
+writer extends after each commit. Rooms are evicted least recently used first once the buffers together take
+more than ROOM_HISTORY_MEMORY_BYTES. A buffer is only served while its last message id equals the room's
+last_message_id, so messages written by another worker, or a room recreated under the same id, turn it into a miss.
+Classes:
+    RoomHistory: The per-room ring buffers and their memory budget.
+Functions:
+    serialize_message(message_id, username, text, created_at): Returns the payload sent to clients for a message.
+Objects:
+    room_history: The process-wide RoomHistory.
+"""
+
+# rough per-message cost of the dict, its keys and the formatted date, on top of the text and username
+ENTRY_OVERHEAD = 400
+
+def serialize_message(message_id, username, text, created_at):
+    """
+    Returns the payload sent to clients for a message.
+    Args:
+        message_id (int): The id the message was saved under.
+        username (str): The username of the sender.
+        text (str): The message content.
+        created_at (int): The time of the message in epoch milliseconds.
+    Returns:
+        dict: The message with its id, sender, text, timestamp and formatted date.
+    """
+    return {
+        "id": message_id,
+        "username": username,
+        "text": text,
+        "timestamp": created_at,
+        "dateTime": MessageModel.format_timestamp(created_at)
+    }
+
+def _entry_size(message):
+    return len(message['text']) + len(message['username']) + ENTRY_OVERHEAD
+
+class RoomBuffer():
+
+    def __init__(self, capacity, messages, has_more):
+        self.messages = deque(messages, maxlen=capacity)
+        self.has_more = has_more or len(messages) > capacity
+        self.last_id = messages[-1]['id'] if messages else 0
+        self.size = sum(map(_entry_size, self.messages))
+
+    def extend(self, messages):
+        for message in messages:
+            if len(self.messages) == self.messages.maxlen:
+                self.size -= _entry_size(self.messages[0])
+                self.has_more = True
+            self.messages.append(message)
+            self.size += _entry_size(message)
+            self.last_id = message['id']
+
+class RoomHistory():
+
+    def __init__(self, capacity, memory_bytes):
+        self.capacity = capacity
+        self.memory_bytes = memory_bytes
+        self.rooms = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def snapshot(self, chat_id, last_message_id):
+        """
+        Returns the buffered page of a room if it is up to date with last_message_id, or None.
+        Returns:
+            dict: The messages oldest first, the cursor of the next older page, whether older messages
+            exist and the ETag get_messages gives the room.
+        """
+        with self.lock:
+            buffer = self.rooms.get(chat_id)
+            if buffer is None or buffer.last_id != last_message_id:
+                self.misses += 1
+                return None
+            self.rooms.move_to_end(chat_id)
+            self.hits += 1
+            return self._page(chat_id, buffer)
+
+    def fill(self, chat_id, messages, has_more):
+        """
+        Buffers the latest messages of a room read from the database, oldest first.
+        Returns:
+            dict: The page of the room, as returned by snapshot.
+        """
+        buffer = RoomBuffer(self.capacity, messages, has_more)
+        with self.lock:
+            self._drop(chat_id)
+            self.rooms[chat_id] = buffer
+            self.size += buffer.size
+            self._evict()
+            return self._page(chat_id, buffer)
+
+    def extend(self, chat_id, previous_last_id, messages):
+        """
+        Appends newly committed messages of a room to its buffer, if the room is buffered.
+        The buffer is dropped instead when it did not end at previous_last_id, the room's
+        last message before the commit, because messages in between would be missing.
+        """
+        with self.lock:
+            buffer = self.rooms.get(chat_id)
+            if buffer is None:
+                return
+            if buffer.last_id != previous_last_id:
+                self._drop(chat_id)
+                return
+            self.size -= buffer.size
+            buffer.extend(messages)
+            self.size += buffer.size
+            self._evict()
+
+    def invalidate(self, chat_id):
+        """
+        Drops the buffer of a room.
+        """
+        with self.lock:
+            self._drop(chat_id)
+
+    def stats(self):
+        """
+        Returns the hit and miss counters, the number of buffered rooms and their estimated size in bytes.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "rooms": len(self.rooms), "bytes": self.size}
+
+    def _page(self, chat_id, buffer):
+        messages = list(buffer.messages)
+        return {
+            "messages": messages,
+            "next_before_id": messages[0]['id'] if buffer.has_more and messages else None,
+            "has_more": buffer.has_more,
+            "etag": quote_etag(f'{chat_id}-{buffer.last_id}')
+        }
+
+    def _drop(self, chat_id):
+        buffer = self.rooms.pop(chat_id, None)
+        if buffer is not None:
+            self.size -= buffer.size
+
+    def _evict(self):
+        while self.size > self.memory_bytes and len(self.rooms) > 1:
+            _, buffer = self.rooms.popitem(last=False)
+            self.size -= buffer.size
+
+room_history = RoomHistory(app.config['ROOM_HISTORY_SIZE'], app.config['ROOM_HISTORY_MEMORY_BYTES'])
@@ -1,9 +1,155 @@
-from config import app, db, socketio
-from auth import *
-from chat import *
+import argparse
+import logging
+import os
+import signal
+import sys
 
-if __name__ == "__main__":
+"""
+This module is the entry point of the backend.
+The application modules are imported only once the command is known, so that `serve` can monkey patch
+the standard library for gevent before anything else is loaded.
+Commands:
+    dev: Creates and migrates the schema, then runs the development server with the debugger and reloader.
+    migrate: Creates missing tables and applies the migrations, then exits. Run it once per deploy, before serve.
+    serve: Serves the backend with the gevent WSGI server, for production. It does not touch the schema,
+        so a restarted node is ready as soon as it has imported the application. CHAT_SECRET_KEY and
+        CHAT_JWT_SECRET_KEY must be set. On SIGTERM or SIGINT it stops accepting connections, closes the
+        Socket.IO connections over the first half of SHUTDOWN_DRAIN_TIMEOUT_S (clients reconnect to another
+        node), flushes the write-behind and presence queues and waits for the remaining requests.
+Functions:
+    env(name, default): Reads a CHAT_<name> environment variable, falling back to the unprefixed name.
+    load_app(): Imports the application and the modules registering its routes and Socket.IO handlers.
+    migrate(): Creates missing tables and applies the migrations.
+    drain(server, timeout): Shuts a serving node down gracefully.
+    serve(host, port, access_log): Serves the backend until it is drained.
+    dev(port): Runs the development server.
+Usage:
+    python main.py migrate
+    CHAT_SECRET_KEY=... CHAT_JWT_SECRET_KEY=... python main.py serve --host 0.0.0.0 --port 5000
+    CHAT_HOST and CHAT_PORT set the default interface and port.
+    python main.py
+"""
+
+DRAIN_BATCH_SIZE = 100
+
+def env(name, default=None):
+    """
+    Returns the CHAT_<name> environment variable, or the older unprefixed <name> one, or default.
+    """
+    return os.environ.get(f'CHAT_{name}', os.environ.get(name, default))
+
+def load_app():
+    """
+    Imports the application and the modules registering its routes and Socket.IO handlers.
+    Returns:
+        tuple: The Flask app, the SQLAlchemy db and the SocketIO server.
+    """
+    from config import app, db, socketio
+    import auth  # noqa: F401 registers the authentication routes
+    import chat  # noqa: F401 registers the chat routes and Socket.IO handlers
+    return app, db, socketio
+
+def migrate():
+    """
+    Creates the missing tables and applies every pending migration.
+    """
+    app, db, _ = load_app()
+    import migrations
     with app.app_context():
         db.create_all()
-    
-    socketio.run(app, debug=True)
\ No newline at end of file
+        migrations.upgrade()
+
+def drain(server, timeout):
+    """
+    Shuts a serving node down gracefully: stops accepting connections, closes the Socket.IO connections
+    in batches spread over the first half of the timeout so their clients do not all reconnect at once,
+    saves the queued messages and presence changes, and stops the server once the remaining requests
+    finish or the timeout expires.
+    Args:
+        server (WSGIServer): The running gevent server.
+        timeout (float): Seconds the whole drain may take.
+    """
+    from config import app, socketio
+    from presence import presence_registry
+    from writebehind import message_writer
+    import time
+
+    deadline = time.monotonic() + timeout
+    server.stop_accepting()
+    app.logger.info('Draining: no longer accepting connections')
+
+    # closing the Engine.IO transport, not the namespace, lets the clients reconnect on their own
+    eio_sids = [eio_sid for _, eio_sid in socketio.server.manager.get_participants('/', None)]
+    batches = [eio_sids[i:i + DRAIN_BATCH_SIZE] for i in range(0, len(eio_sids), DRAIN_BATCH_SIZE)]
+    for number, batch in enumerate(batches):
+        if number:
+            socketio.sleep(timeout / 2 / len(batches))
+        for eio_sid in batch:
+            socketio.server.eio.disconnect(eio_sid)
+    app.logger.info('Draining: closed %d connections', len(eio_sids))
+
+    message_writer.stop()
+    presence_registry.stop()
+    server.stop(timeout=max(deadline - time.monotonic(), 1))
+
+def serve(host, port, access_log):
+    """
+    Serves the backend with the gevent WSGI server until SIGTERM or SIGINT, then drains it.
+    Args:
+        host (str): The interface to listen on.
+        port (int): The port to listen on.
+        access_log (bool): Whether to log every request.
+    """
+    from gevent import monkey
+    monkey.patch_all()
+    os.environ.setdefault('CHAT_SOCKETIO_ASYNC_MODE', 'gevent')
+
+    for name in ('CHAT_SECRET_KEY', 'CHAT_JWT_SECRET_KEY'):
+        if not os.environ.get(name):
+            sys.exit(f'{name} must be set to serve in production')
+
+    import gevent
+    from gevent import pywsgi
+    app, _, socketio = load_app()
+    if socketio.async_mode != 'gevent':
+        sys.exit(f'serve needs the gevent async mode, not {socketio.async_mode}')
+
+    app.logger.setLevel(logging.INFO)
+    server = pywsgi.WSGIServer((host, port), app, log='default' if access_log else None)
+    draining = []
+
+    def on_signal():
+        if not draining:
+            draining.append(gevent.spawn(drain, server, app.config['SHUTDOWN_DRAIN_TIMEOUT_S']))
+
+    gevent.signal_handler(signal.SIGTERM, on_signal)
+    gevent.signal_handler(signal.SIGINT, on_signal)
+    app.logger.info('Serving on %s:%d', host, port)
+    server.serve_forever()
+    gevent.joinall(draining)
+
+def dev(port):
+    """
+    Creates and migrates the schema, then runs the development server with the debugger and reloader.
+    """
+    migrate()
+    app, _, socketio = load_app()
+    socketio.run(app, debug=True, port=port)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the chat backend.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('dev', help='Run the development server (the default).')
+    commands.add_parser('migrate', help='Create the tables and apply the migrations.')
+    serve_parser = commands.add_parser('serve', help='Serve in production with gevent.')
+    serve_parser.add_argument('--host', default=env('HOST', '0.0.0.0'), help='Interface to listen on.')
+    serve_parser.add_argument('--port', type=int, default=int(env('PORT', 5000)), help='Port to listen on.')
+    serve_parser.add_argument('--access-log', action='store_true', help='Log every request.')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate()
+    elif args.command == 'serve':
+        serve(args.host, args.port, args.access_log)
+    else:
+        dev(int(env('PORT', 5000)))
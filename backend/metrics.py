@@ -0,0 +1,256 @@
+from config import app, socketio
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from cache import identity_cache, token_cache
+from hashing import password_hasher
+from history import room_history
+from presence import presence_registry
+from writebehind import message_writer
+from bisect import bisect_left
+import functools
+import threading
+import time
+
+"""
+This module records where the backend spends its time and serves it on /metrics in the Prometheus text format.
+It keeps latency histograms per HTTP route and per Socket.IO event, the number and duration of the SQL
+statements run by each request or event (through SQLAlchemy engine events), and reads the connection and
+room counts, the outbound queue depths and the stats of the caches, the password hasher and the write-behind
+queue at scrape time.
+Observations only take a lock and a bisect, so the instrumentation can stay on in production.
+Metrics are kept per process; scrape every worker.
+Classes:
+    Histogram: A labelled histogram with cumulative buckets.
+    Counter: A labelled counter.
+Functions:
+    observe_event(name): Decorator timing a Socket.IO event handler.
+    start_timer(): before_request hook recording the start of the request.
+    observe_request(response): after_request hook recording the latency and SQL usage of the request.
+    before_statement(...)/after_statement(...): SQLAlchemy cursor hooks timing every statement.
+    metrics(): The /metrics route.
+Objects:
+    REGISTRY: Every Histogram and Counter, in exposition order.
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+REGISTRY = []
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Histogram():
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        """
+        Records one observation for the given label values.
+        """
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.series.items()]
+        for labels, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+            le = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+class Counter():
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        """
+        Adds amount to the counter of the given label values.
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {value}')
+        return lines
+
+http_duration = Histogram('http_request_duration_seconds', 'Latency of HTTP requests by route.', ('route', 'method'))
+http_responses = Counter('http_responses_total', 'HTTP responses by route and status.', ('route', 'method', 'status'))
+event_duration = Histogram('socketio_event_duration_seconds', 'Latency of Socket.IO event handlers.', ('event',))
+event_errors = Counter('socketio_event_errors_total', 'Socket.IO event handlers that raised.', ('event',))
+sql_duration = Histogram('sql_statement_duration_seconds', 'Duration of SQL statements by verb.', ('verb',), SQL_BUCKETS)
+sql_per_request = Histogram('sql_statements_per_request', 'SQL statements run by each HTTP request or Socket.IO event.',
+                            ('handler',), STATEMENT_BUCKETS)
+sql_time_per_request = Histogram('sql_seconds_per_request', 'Time spent in SQL by each HTTP request or Socket.IO event.',
+                                 ('handler',), SQL_BUCKETS)
+
+def _observe_sql(handler):
+    sql_per_request.observe(g.get('sql_statements', 0), handler)
+    sql_time_per_request.observe(g.get('sql_seconds', 0.0), handler)
+
+def observe_event(name):
+    """
+    Times a Socket.IO event handler and the SQL it runs. Must be placed directly below @socketio.on.
+    Args:
+        name (str): The event name used as the metric label.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            g.sql_statements = 0
+            g.sql_seconds = 0.0
+            start = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                event_errors.inc(name)
+                raise
+            finally:
+                event_duration.observe(time.perf_counter() - start, name)
+                _observe_sql(f'event:{name}')
+        return wrapper
+    return decorator
+
+@app.before_request
+def start_timer():
+    """
+    Records when the current request started.
+    """
+    g.request_start = time.perf_counter()
+    g.sql_seconds = 0.0
+
+@app.after_request
+def observe_request(response):
+    """
+    Records the latency, the status and the SQL statements of the current request.
+    Returns:
+        Response: The unchanged response.
+    """
+    if 'request_start' not in g:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    http_duration.observe(time.perf_counter() - g.request_start, route, request.method)
+    http_responses.inc(route, request.method, response.status_code)
+    _observe_sql(route)
+    return response
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Records when a statement started on its execution context, which is dropped with the statement
+    whether it succeeds or fails.
+    """
+    if context is not None:
+        context.statement_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Records the duration of a statement, and adds it to the SQL time of the current request or event.
+    """
+    start = getattr(context, 'statement_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    sql_duration.observe(elapsed, statement.lstrip().split(' ', 1)[0].upper())
+    if has_request_context():
+        g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+
+def _gauge(name, help, value, type='gauge'):
+    return [f'# HELP {name} {help}', f'# TYPE {name} {type}', f'{name} {value}']
+
+def _socketio_gauges():
+    rooms = socketio.server.manager.rooms.get('/', {})
+    sids = rooms.get(None, {})
+    return _gauge('socketio_connections', 'Open Socket.IO connections on this process.', len(sids)) \
+        + _gauge('socketio_rooms', 'Socket.IO rooms with a member on this process.',
+                 sum(1 for room in rooms if room is not None and room not in sids)) \
+        + _gauge('presence_connections', 'Signed-in connections tracked by the presence registry.',
+                 len(presence_registry.sids))
+
+def _outbound_gauges():
+    outbound = socketio.server.manager.stats()
+    return _gauge('outbound_queue_depth_max', 'Deepest outbound queue of a connection, in packets.', outbound['max_depth']) \
+        + _gauge('outbound_queue_depth_total', 'Packets waiting in every outbound queue.', outbound['total_depth']) \
+        + _gauge('outbound_lagging_connections', 'Connections over the outbound queue limit.', outbound['lagging']) \
+        + _gauge('outbound_coalesced_total', 'Messages replaced by a resync signal.', outbound['coalesced'], 'counter') \
+        + _gauge('outbound_dropped_total', 'Held back messages dropped to make room for newer ones.',
+                 outbound['dropped'], 'counter') \
+        + _gauge('outbound_disconnects_total', 'Slow consumers disconnected.', outbound['disconnected'], 'counter') \
+        + _gauge('outbound_resyncs_total', 'Resync signals sent to connections that caught up.',
+                 outbound['resyncs'], 'counter')
+
+def _stats_gauges():
+    cache = identity_cache.stats()
+    tokens = token_cache.stats()
+    hashing = password_hasher.stats()
+    history = room_history.stats()
+    return _gauge('identity_cache_hits_total', 'Identity cache hits.', cache['hits'], 'counter') \
+        + _gauge('identity_cache_misses_total', 'Identity cache misses.', cache['misses'], 'counter') \
+        + _gauge('identity_cache_entries', 'Entries in the identity cache.', cache['size']) \
+        + _gauge('token_cache_hits_total', 'JWTs accepted without verifying their signature again.',
+                 tokens['hits'], 'counter') \
+        + _gauge('token_cache_misses_total', 'JWTs verified.', tokens['misses'], 'counter') \
+        + _gauge('token_cache_entries', 'Verified JWTs in the token cache.', tokens['size']) \
+        + _gauge('password_hash_seconds_total', 'Time spent hashing passwords, queueing included.',
+                 hashing['total_ms'] / 1000, 'counter') \
+        + _gauge('password_hash_calls_total', 'Password hash and check calls.', hashing['count'], 'counter') \
+        + _gauge('password_hash_max_seconds', 'Longest password hash or check call.', hashing['max_ms'] / 1000) \
+        + _gauge('room_history_hits_total', 'Joins served from the room history buffers.', history['hits'], 'counter') \
+        + _gauge('room_history_misses_total', 'Joins that read the room history from the database.',
+                 history['misses'], 'counter') \
+        + _gauge('room_history_rooms', 'Rooms with a history buffer.', history['rooms']) \
+        + _gauge('room_history_bytes', 'Estimated size of the room history buffers.', history['bytes']) \
+        + _gauge('message_writer_queue_length', 'Messages waiting in the write-behind queue.', message_writer.queue.qsize())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Serves every metric of this process in the Prometheus text exposition format.
+    Returns:
+        Response: The metrics as text/plain; version=0.0.4.
+    """
+    lines = _socketio_gauges() + _outbound_gauges() + _stats_gauges()
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,172 @@
+from config import app, db
+import search
+from models import ChatModel, MessageModel, UserChatModel
+from sqlalchemy import Integer, func, inspect, select
+from sqlalchemy.schema import CreateColumn
+import datetime
+
+"""
+This module applies schema changes that db.create_all() cannot make on an existing database.
+db.create_all() only creates missing tables, so columns and indexes added to models whose table
+already exists in instance/chat.db are created here. Every step is idempotent; `python main.py migrate`
+runs them once per deploy, and the development server on each boot.
+Functions:
+    upgrade(): Applies all pending schema changes to the current database.
+    add_column(column): Adds a model column to its existing table, returns True if it was missing.
+    convert_message_timestamps(): Rebuilds message_model with created_at stored as epoch milliseconds.
+"""
+
+MIGRATION_BATCH_SIZE = 10000
+
+def add_column(column):
+    """
+    Adds a model column to its existing table.
+    Args:
+        column (Column): The mapped column, e.g. ChatModel.__table__.c.last_message_id.
+    Returns:
+        bool: True if the column was missing and has been added, False otherwise.
+    """
+    existing = [c['name'] for c in inspect(db.engine).get_columns(column.table.name)]
+    if column.name in existing:
+        return False
+
+    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql(f'ALTER TABLE {column.table.name} ADD COLUMN {ddl}')
+    return True
+
+def _parse_display_timestamp(value):
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return int(datetime.datetime.strptime(value, MessageModel.DISPLAY_FORMAT).timestamp() * 1000)
+    except (TypeError, ValueError):
+        return None
+
+def _check_display_timestamps(connection):
+    """
+    Raises ValueError if a room has messages but none with a parsable timestamp, before anything is changed:
+    SQLite commits the ALTER TABLE of the conversion at once, so it cannot be rolled back afterwards.
+    """
+    valid_rooms, unparsable = set(), {}
+    rows = connection.exec_driver_sql('SELECT id, chat_id, created_at FROM message_model')
+    while batch := rows.fetchmany(MIGRATION_BATCH_SIZE):
+        for id, chat_id, created_at in batch:
+            if _parse_display_timestamp(created_at) is None:
+                unparsable.setdefault(chat_id, []).append(id)
+            else:
+                valid_rooms.add(chat_id)
+    stranded = sorted(id for chat_id, ids in unparsable.items() if chat_id not in valid_rooms for id in ids)
+    if stranded:
+        raise ValueError(f'Messages {stranded} have unparsable timestamps and no message of their room has '
+                         f'a valid one; fix them and migrate again')
+
+def convert_message_timestamps():
+    """
+    Rebuilds message_model so created_at holds epoch milliseconds instead of display strings.
+    SQLite cannot change a column's type, so the table is renamed, recreated from the model
+    and refilled in batches, parsing the old "%b %d, %Y %I:%M %p" strings as local time.
+    A message whose timestamp cannot be parsed takes the timestamp of the previous message of its room,
+    or of the next one for the first messages of a room, and its id is logged. If no message of a room
+    has a valid timestamp, nothing is converted.
+    Message ids are kept, so the full-text index and room cursors stay valid.
+    Returns:
+        bool: True if the table had to be converted, False otherwise.
+    Raises:
+        ValueError: A room has no message with a valid timestamp; the table is left unchanged.
+    """
+    created_at = next(c for c in inspect(db.engine).get_columns('message_model') if c['name'] == 'created_at')
+    if isinstance(created_at['type'], Integer):
+        return False
+
+    table = MessageModel.__table__
+    with db.engine.begin() as connection:
+        _check_display_timestamps(connection)
+        connection.exec_driver_sql('ALTER TABLE message_model RENAME TO message_model_old')
+        for index in table.indexes:
+            connection.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+        table.create(connection)
+
+        rows = connection.exec_driver_sql(
+            'SELECT id, message, user_id, chat_id, created_at FROM message_model_old ORDER BY id'
+        )
+        # last valid timestamp of each room, and the messages of a room waiting for its first one;
+        # every room has one, see _check_display_timestamps
+        last_created_at, waiting, unparsed = {}, {}, []
+        while True:
+            batch = rows.fetchmany(MIGRATION_BATCH_SIZE)
+            if not batch:
+                break
+            converted = []
+            for row in batch:
+                message = {"id": row.id, "message": row.message, "user_id": row.user_id, "chat_id": row.chat_id,
+                           "created_at": _parse_display_timestamp(row.created_at)}
+                if message['created_at'] is None:
+                    unparsed.append(row.id)
+                    message['created_at'] = last_created_at.get(row.chat_id)
+                    if message['created_at'] is None:
+                        waiting.setdefault(row.chat_id, []).append(message)
+                        continue
+                else:
+                    last_created_at[row.chat_id] = message['created_at']
+                    for earlier in waiting.pop(row.chat_id, ()):
+                        earlier['created_at'] = message['created_at']
+                        converted.append(earlier)
+                converted.append(message)
+            if converted:
+                connection.execute(table.insert(), converted)
+
+        if unparsed:
+            app.logger.warning('Messages %s had unparsable timestamps and took their neighbours\' ones', unparsed)
+
+        connection.exec_driver_sql('DROP TABLE message_model_old')
+    return True
+
+def upgrade():
+    """
+    Applies all pending schema changes to the current database.
+    Must be called inside an application context, after db.create_all().
+    """
+    if add_column(ChatModel.__table__.c.last_message_id):
+        last_message_id = select(func.coalesce(func.max(MessageModel.id), 0)) \
+            .where(MessageModel.chat_id == ChatModel.id) \
+            .scalar_subquery()
+        db.session.query(ChatModel).update({ChatModel.last_message_id: last_message_id}, synchronize_session=False)
+        db.session.commit()
+
+    convert_message_timestamps()
+
+    for column in ('last_message_preview', 'last_message_user_id', 'last_message_at'):
+        add_column(ChatModel.__table__.c[column])
+    if add_column(ChatModel.__table__.c.message_count):
+        last_message = lambda column: select(column) \
+            .where(MessageModel.id == ChatModel.last_message_id) \
+            .scalar_subquery()
+        message_count = select(func.count(MessageModel.id)) \
+            .where(MessageModel.chat_id == ChatModel.id) \
+            .scalar_subquery()
+        db.session.query(ChatModel).update({
+            ChatModel.message_count: message_count,
+            ChatModel.last_message_preview: func.substr(last_message(MessageModel.message), 1, ChatModel.PREVIEW_LENGTH),
+            ChatModel.last_message_user_id: last_message(MessageModel.user_id),
+            ChatModel.last_message_at: last_message(MessageModel.created_at),
+        }, synchronize_session=False)
+        db.session.commit()
+
+    add_column(UserChatModel.__table__.c.last_read_id)
+    if add_column(UserChatModel.__table__.c.read_count):
+        # existing members start with everything read
+        room = lambda column: select(column).where(ChatModel.id == UserChatModel.chat_id).scalar_subquery()
+        db.session.query(UserChatModel).update({
+            UserChatModel.read_count: room(ChatModel.message_count),
+            UserChatModel.last_read_id: room(ChatModel.last_message_id),
+        }, synchronize_session=False)
+        db.session.commit()
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+    search.create_indexes()
@@ -1,14 +1,26 @@
 from config import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from cache import identity_cache, identity_keys
+from collections import namedtuple
+import datetime
+import search
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.sqlite import insert
+import time
+from hashing import password_hasher
 
 """
 This module defines the database models for a real-time chat application using Flask and SQLAlchemy.
 Classes:
     MyModels: A base class providing save and delete methods for database operations.
+        Both keep the search module's full-text indexes in sync with the saved or deleted row
+        and invalidate its entries in the identity cache.
+        save(commit=False) leaves the commit to the caller, to save several rows in one transaction.
+    UserRef, RoomRef: Cached id and immutable fields of a user or a chat room.
     UserModel: Represents a user in the chat application.
     UserChatModel: Represents the association between users and chats.
     ChatModel: Represents a chat room.
     MessageModel: Represents a message in a chat room.
+    PresenceModel: Represents the users connected to a backend worker.
 UserModel:
     id (int): Primary key.
     username (str): Unique username of the user.
@@ -20,43 +32,102 @@ UserModel:
     Methods:
         set_password(password): Hashes and sets the user's password.
         check_password(password): Checks the hashed password.
-        get_user_by_username(username): Class method to get a user by username.
+        password_needs_rehash(): Checks if the password was hashed with outdated parameters.
+        get_user_by_username(username): Class method to get a user row by username, always read from the
+            database since it carries the password hash (signin); it refreshes the user's cached UserRef.
+        get_user_ref(username): Class method to get the cached UserRef of a user by username.
+        get_user_refs(usernames): Class method mapping usernames to UserRefs, reading the cache misses in one query.
         to_json(): Returns a JSON representation of the user.
 UserChatModel:
     id (int): Primary key.
     user_id (int): Foreign key to UserModel.
     chat_id (int): Foreign key to ChatModel.
+    last_read_id (int): Read cursor, the room's last_message_id when the user last read the room.
+    read_count (int): The room's message_count when the user last read the room; the unread count
+        of the room is message_count - read_count.
     __table_args__: Unique constraint on user_id and chat_id.
     Methods:
         to_json(): Returns a JSON representation of the user-chat association.
+        mark_read(user_id, chat_id): Class method moving the user's read cursor to the room's latest message.
+        add_many(pairs): Class method inserting (user_id, chat_id) memberships in one statement, skipping
+            existing ones. Returns the pairs that were inserted.
+        remove_many(pairs): Class method deleting (user_id, chat_id) memberships in one statement.
+            Returns the pairs that were deleted.
 ChatModel:
     id (int): Primary key.
     name (str): Unique name of the chat room.
     type (str): Type of the chat room.
+    last_message_id (int): Id of the latest message in the room (0 when empty), used as the room's ETag.
+    last_message_preview (str): The first PREVIEW_LENGTH characters of the latest message.
+    last_message_user_id (int): The sender of the latest message.
+    last_message_at (int): Epoch milliseconds of the latest message.
+    message_count (int): Number of messages ever sent to the room.
     users (relationship): Relationship to UserChatModel.
     message (relationship): Relationship to MessageModel.
     Methods:
         to_json(): Returns a JSON representation of the chat room.
-        get_room_by_name(name): Class method to get a chat room by name.
+        get_room_by_name(name): Class method to get a chat room row by name, always read from the database
+            since its last message fields change with every message; it refreshes the room's cached RoomRef.
+        get_room_ref(name): Class method to get the cached RoomRef of a chat room by name.
+        get_room_refs(names): Class method mapping room names to RoomRefs, reading the cache misses in one query.
+        create_many(rooms): Class method inserting and indexing (name, type) rooms in one statement, skipping
+            existing names. Returns the RoomRefs of the created rooms by name.
+        record_messages(last_message, count): Class method counting new messages of a room and advancing
+            its last message fields to last_message, in one UPDATE.
+        get_last_message_ids(chat_ids): Class method mapping room ids to their last_message_id.
+        get_room_last_message_id(name): Class method returning the RoomRef and last_message_id of a room by
+            name, or None. A cached RoomRef leaves only last_message_id to read; a miss reads both in one query.
 MessageModel:
     id (int): Primary key.
     message (str): The message content.
     user_id (int): Foreign key to UserModel.
     chat_id (int): Foreign key to ChatModel.
-    created_at (str): Timestamp of when the message was created.
+    created_at (int): Epoch milliseconds of when the message was created.
+    __table_args__: Composite indexes on chat_id and id for keyset pagination,
+        and on chat_id and created_at for time-range queries.
     Methods:
+        save(): Saves and indexes the message, records it as the room's last message and marks the room
+            read by the sender, in the same transaction. Returns the message id, taken at the flush so
+            reading it does not reload the committed row.
         to_json(): Returns a JSON representation of the message.
+        get_page(chat_id, before_id, after_id, since, until, limit): Class method to get a page of messages,
+            newest first, or oldest first when syncing messages newer than after_id,
+            optionally limited to the messages created in [since, until).
+        timestamp(): Static method returning the current time in epoch milliseconds.
+        format_timestamp(ms): Static method formatting epoch milliseconds for display.
+PresenceModel:
+    worker (str): Primary key, with user_id. Id of the backend worker process.
+    user_id (int): Primary key, with worker. A user with open connections on the worker.
+    seen_at (int): Epoch milliseconds of when the worker last confirmed the row; rows of workers
+        that stopped refreshing them are stale.
+    Methods:
+        attach_many(worker, user_ids, seen_at): Class method recording users connected to a worker.
+        detach_many(worker, user_ids): Class method forgetting users no longer connected to a worker.
+        online_elsewhere(worker, user_ids, since): Class method returning the users with connections
+            on other workers, seen since the given epoch milliseconds.
 """
 
+UserRef = namedtuple('UserRef', ['id', 'username'])
+RoomRef = namedtuple('RoomRef', ['id', 'name', 'type'])
+
 class MyModels():
 
-    def save(self):
+    def save(self, commit=True):
+        replace = self.id is not None
+        keys = identity_keys(self)
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        search.index(self, replace=replace)
+        if commit:
+            db.session.commit()
+        identity_cache.invalidate(*keys)
     
     def delete(self):
+        keys = identity_keys(self)
+        search.unindex(self)
         db.session.delete(self)
         db.session.commit()
+        identity_cache.invalidate(*keys)
 
 class UserModel(db.Model, MyModels):
     id = db.Column(db.Integer, primary_key=True)
@@ -69,14 +140,45 @@ class UserModel(db.Model, MyModels):
 
 
     def set_password(self, password):
-        self.password = generate_password_hash(password)
+        self.password = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return password_hasher.verify(self.password, password)
+
+    def password_needs_rehash(self):
+        return password_hasher.needs_rehash(self.password)
     
     @classmethod
     def get_user_by_username(cls, username):
-        return cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username).first()
+        if user is not None:
+            identity_cache.put((cls.__tablename__, username), UserRef(user.id, user.username))
+        return user
+    
+    @classmethod
+    def get_user_ref(cls, username):
+        ref = identity_cache.get((cls.__tablename__, username))
+        if ref is None:
+            user = db.session.query(cls.id, cls.username).filter_by(username=username).first()
+            if user is None:
+                return None
+            ref = UserRef(user.id, user.username)
+            identity_cache.put((cls.__tablename__, username), ref)
+        return ref
+    
+    @classmethod
+    def get_user_refs(cls, usernames):
+        refs = {}
+        for username in usernames:
+            ref = identity_cache.get((cls.__tablename__, username))
+            if ref is not None:
+                refs[username] = ref
+        missing = [username for username in usernames if username not in refs]
+        if missing:
+            for user in db.session.query(cls.id, cls.username).filter(cls.username.in_(missing)):
+                refs[user.username] = UserRef(user.id, user.username)
+                identity_cache.put((cls.__tablename__, user.username), refs[user.username])
+        return refs
     
     def to_json(self):
         return {
@@ -90,6 +192,8 @@ class UserChatModel(db.Model, MyModels):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user_model.id'))
     chat_id = db.Column(db.Integer, db.ForeignKey('chat_model.id'))
+    last_read_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    read_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     __table_args__ = (
         db.UniqueConstraint('user_id', 'chat_id', name='unique_user_chat'),
@@ -100,16 +204,47 @@ class UserChatModel(db.Model, MyModels):
             "id": self.id,
             "user_id": self.user_id,
             "chat_id": self.chat_id,
+            "last_read_id": self.last_read_id,
         }
     
+    @classmethod
+    def mark_read(cls, user_id, chat_id):
+        last_message_id = db.select(ChatModel.last_message_id).where(ChatModel.id == chat_id).scalar_subquery()
+        message_count = db.select(ChatModel.message_count).where(ChatModel.id == chat_id).scalar_subquery()
+        return cls.query.filter(cls.user_id == user_id, cls.chat_id == chat_id) \
+            .update({cls.last_read_id: last_message_id, cls.read_count: message_count}, synchronize_session=False)
+    
+    @classmethod
+    def add_many(cls, pairs):
+        if not pairs:
+            return set()
+        statement = insert(cls).values([{"user_id": user_id, "chat_id": chat_id} for user_id, chat_id in pairs]) \
+            .on_conflict_do_nothing(index_elements=['user_id', 'chat_id']) \
+            .returning(cls.user_id, cls.chat_id)
+        return set(map(tuple, db.session.execute(statement)))
+    
+    @classmethod
+    def remove_many(cls, pairs):
+        if not pairs:
+            return set()
+        statement = db.delete(cls).where(tuple_(cls.user_id, cls.chat_id).in_(pairs)) \
+            .returning(cls.user_id, cls.chat_id)
+        return set(map(tuple, db.session.execute(statement)))
+    
 class ChatModel(db.Model, MyModels):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, unique=True, index=True)
     type = db.Column(db.String, nullable=False, unique=False)
-    # last_message_id = db.Column(db.Integer, db.ForeignKey('message_model.id'))
+    last_message_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_message_preview = db.Column(db.String, nullable=True)
+    last_message_user_id = db.Column(db.Integer, nullable=True)
+    last_message_at = db.Column(db.BigInteger, nullable=True)
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     users = db.relationship('UserChatModel', backref='chat', cascade='all, delete-orphan')
     message = db.relationship('MessageModel', backref='chat', cascade='all, delete-orphan')
 
+    PREVIEW_LENGTH = 100
+
     def to_json(self):
         return {
             "id": self.id,
@@ -119,16 +254,97 @@ class ChatModel(db.Model, MyModels):
     
     @classmethod
     def get_room_by_name(cls, name):
-        return cls.query.filter_by(name=name).first()
+        room = cls.query.filter_by(name=name).first()
+        if room is not None:
+            identity_cache.put((cls.__tablename__, name), RoomRef(room.id, room.name, room.type))
+        return room
+    
+    @classmethod
+    def get_room_ref(cls, name):
+        ref = identity_cache.get((cls.__tablename__, name))
+        if ref is None:
+            room = db.session.query(cls.id, cls.name, cls.type).filter_by(name=name).first()
+            if room is None:
+                return None
+            ref = RoomRef(room.id, room.name, room.type)
+            identity_cache.put((cls.__tablename__, name), ref)
+        return ref
+    
+    @classmethod
+    def get_room_refs(cls, names):
+        refs = {}
+        for name in names:
+            ref = identity_cache.get((cls.__tablename__, name))
+            if ref is not None:
+                refs[name] = ref
+        missing = [name for name in names if name not in refs]
+        if missing:
+            for room in db.session.query(cls.id, cls.name, cls.type).filter(cls.name.in_(missing)):
+                refs[room.name] = RoomRef(room.id, room.name, room.type)
+                identity_cache.put((cls.__tablename__, room.name), refs[room.name])
+        return refs
+    
+    @classmethod
+    def create_many(cls, rooms):
+        if not rooms:
+            return {}
+        statement = insert(cls).values([{"name": name, "type": type} for name, type in rooms]) \
+            .on_conflict_do_nothing(index_elements=['name']) \
+            .returning(cls.id, cls.name, cls.type)
+        created = db.session.execute(statement).all()
+        search.index_many(created, model=cls)
+        return {room.name: RoomRef(room.id, room.name, room.type) for room in created}
+    
+    @classmethod
+    def record_messages(cls, last_message, count=1):
+        newer = cls.last_message_id < last_message.id
+        latest = lambda column, value: db.case((newer, value), else_=column)
+        cls.query.filter(cls.id == last_message.chat_id).update({
+            cls.message_count: cls.message_count + count,
+            cls.last_message_id: latest(cls.last_message_id, last_message.id),
+            cls.last_message_preview: latest(cls.last_message_preview, last_message.message[:cls.PREVIEW_LENGTH]),
+            cls.last_message_user_id: latest(cls.last_message_user_id, last_message.user_id),
+            cls.last_message_at: latest(cls.last_message_at, last_message.created_at),
+        }, synchronize_session=False)
+    
+    @classmethod
+    def get_last_message_ids(cls, chat_ids):
+        return dict(db.session.query(cls.id, cls.last_message_id).filter(cls.id.in_(chat_ids)).all())
+    
+    @classmethod
+    def get_room_last_message_id(cls, name):
+        ref = identity_cache.get((cls.__tablename__, name))
+        if ref is None:
+            room = cls.get_room_by_name(name)
+            return None if room is None else (RoomRef(room.id, room.name, room.type), room.last_message_id)
+        last_message_id = cls.get_last_message_ids([ref.id]).get(ref.id)
+        return None if last_message_id is None else (ref, last_message_id)
     
 class MessageModel(db.Model, MyModels):
     id = db.Column(db.Integer, primary_key=True)
     message = db.Column(db.String, nullable=False, unique=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user_model.id'))
     chat_id = db.Column(db.Integer, db.ForeignKey('chat_model.id'))
-    created_at = db.Column(db.String, nullable=False, unique=False)
+    created_at = db.Column(db.BigInteger, nullable=False, unique=False)
     # chat = db.relationship('ChatModel', backref='message', uselist=False)
 
+    __table_args__ = (
+        db.Index('ix_message_chat_id_id', 'chat_id', 'id'),
+        db.Index('ix_message_chat_id_created_at', 'chat_id', 'created_at'),
+    )
+
+    DISPLAY_FORMAT = "%b %d, %Y %I:%M %p"
+
+    def save(self):
+        db.session.add(self)
+        db.session.flush()
+        message_id = self.id
+        search.index(self, replace=False)
+        ChatModel.record_messages(self)
+        UserChatModel.mark_read(self.user_id, self.chat_id)
+        db.session.commit()
+        return message_id
+
     def to_json(self):
         return {
             "id": self.id,
@@ -136,4 +352,57 @@ class MessageModel(db.Model, MyModels):
             "user_id": self.user_id,
             "chat_id": self.chat_id,
             "created_at": self.created_at,
-        }
\ No newline at end of file
+        }
+    
+    @staticmethod
+    def timestamp():
+        return time.time_ns() // 1_000_000
+    
+    @classmethod
+    def format_timestamp(cls, ms):
+        return datetime.datetime.fromtimestamp(ms / 1000).strftime(cls.DISPLAY_FORMAT)
+    
+    @classmethod
+    def get_page(cls, chat_id, before_id=None, after_id=None, since=None, until=None, limit=50):
+        query = db.session.query(cls.id, cls.message, cls.created_at, UserModel.username) \
+            .join(UserModel, UserModel.id == cls.user_id) \
+            .filter(cls.chat_id == chat_id)
+
+        if since is not None:
+            query = query.filter(cls.created_at >= since)
+        if until is not None:
+            query = query.filter(cls.created_at < until)
+
+        if after_id is not None:
+            return query.filter(cls.id > after_id).order_by(cls.id.asc()).limit(limit).all()
+
+        if before_id is not None:
+            query = query.filter(cls.id < before_id)
+
+        return query.order_by(cls.id.desc()).limit(limit).all()
+
+class PresenceModel(db.Model):
+    worker = db.Column(db.String, primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)
+    seen_at = db.Column(db.BigInteger, nullable=False)
+
+    @classmethod
+    def attach_many(cls, worker, user_ids, seen_at):
+        if not user_ids:
+            return
+        statement = insert(cls).values([{"worker": worker, "user_id": user_id, "seen_at": seen_at}
+                                        for user_id in user_ids])
+        db.session.execute(statement.on_conflict_do_update(index_elements=['worker', 'user_id'],
+                                                           set_={"seen_at": statement.excluded.seen_at}))
+
+    @classmethod
+    def detach_many(cls, worker, user_ids):
+        if user_ids:
+            db.session.execute(db.delete(cls).where(cls.worker == worker, cls.user_id.in_(user_ids)))
+
+    @classmethod
+    def online_elsewhere(cls, worker, user_ids, since):
+        if not user_ids:
+            return set()
+        return set(db.session.scalars(db.select(cls.user_id).distinct()
+                                      .where(cls.user_id.in_(user_ids), cls.worker != worker, cls.seen_at >= since)))
@@ -0,0 +1,217 @@
+from broker import UnixSocketManager
+from collections import deque
+from engineio import packet as eio_packet
+from socketio import packet
+import socketio
+import threading
+
+"""
+This module bounds the outbound queue of every Socket.IO connection, so one slow consumer cannot make the
+server buffer messages without limit or delay the other members of its rooms.
+Each connection already has an Engine.IO send queue, drained by its transport. BoundedOutbound takes over
+the broadcasts of the client manager and checks the depth of that queue before handing a message to it.
+Once a connection has OUTBOUND_QUEUE_MAX_DEPTH packets waiting it is lagging, and OUTBOUND_OVERFLOW_POLICY
+decides what happens to the messages sent to it:
+    coalesce: Every message is dropped and the connection gets a single "resync" event instead.
+    drop_oldest: Up to OUTBOUND_QUEUE_MAX_DEPTH messages are kept, dropping the oldest, and delivered
+        after a "resync" event when the connection catches up.
+    disconnect: The connection is closed; the client resyncs when it reconnects.
+A background task checks the lagging connections every OUTBOUND_FLUSH_INTERVAL_MS milliseconds and
+resumes them once their queue is down to half of the maximum depth. The "resync" event has no arguments,
+so it reads the same in every wire format; clients answer it by fetching the messages they missed over REST.
+Classes:
+    BoundedOutbound: Socket.IO client manager mixin bounding the outbound queue of every connection.
+Functions:
+    make_manager(message_queue, max_depth, policy, flush_interval_ms): Returns the client manager for
+        a message queue URL, with bounded outbound queues.
+"""
+
+POLICIES = ('coalesce', 'drop_oldest', 'disconnect')
+RESYNC_EVENT = 'resync'
+
+class _Lag():
+
+    def __init__(self, sid, namespace, keep):
+        self.sid = sid
+        self.namespace = namespace
+        self.pending = deque(maxlen=keep) if keep else None
+        self.missed = 0
+
+class BoundedOutbound(socketio.Manager):
+    """
+    Client manager delivering broadcasts through bounded per-connection queues.
+    Placed before socketio.Manager in the method resolution order, it also bounds the broadcasts
+    relayed by the pub/sub managers.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_depth = 256
+        self.policy = 'coalesce'
+        self.flush_interval = 0.2
+        self.lagging = {}
+        self.counts = {"coalesced": 0, "dropped": 0, "disconnected": 0, "resyncs": 0}
+        self.lock = threading.Lock()
+        self.task = None
+
+    def set_limits(self, max_depth, policy, flush_interval_ms):
+        """
+        Sets the maximum queue depth, the overflow policy and the flush interval.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown outbound overflow policy {policy!r}, expected one of {POLICIES}')
+        self.max_depth = max_depth
+        self.policy = policy
+        self.flush_interval = flush_interval_ms / 1000
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        """
+        Emits an event to a single client, a room, or the whole namespace, like socketio.Manager.emit,
+        applying the overflow policy to the recipients that are lagging.
+        """
+        if callback:
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback,
+                                to=to, **kwargs)
+        room = to or room
+        if namespace not in self.rooms:
+            return
+        if isinstance(data, tuple):
+            data = list(data)
+        elif data is not None:
+            data = [data]
+        else:
+            data = []
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+
+        # the packets are the same for every recipient, so they are encoded once
+        encoded = self.server.packet_class(packet.EVENT, namespace=namespace, data=[event] + data).encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        packets = [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encoded]
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid not in skip_sid:
+                self._deliver(sid, eio_sid, namespace, packets)
+
+    def _deliver(self, sid, eio_sid, namespace, packets):
+        socket = self.server.eio.sockets.get(eio_sid)
+        if socket is None:
+            # let Engine.IO report it, like socketio.Manager does
+            for pkt in packets:
+                self.server._send_eio_packet(eio_sid, pkt)
+            return
+        with self.lock:
+            lag = self.lagging.get(eio_sid)
+            if lag is None:
+                if socket.queue.qsize() < self.max_depth:
+                    for pkt in packets:
+                        self.server._send_eio_packet(eio_sid, pkt)
+                    return
+                lag = self._start_lagging(sid, eio_sid, namespace)
+
+            if self.policy == 'disconnect':
+                return
+            if lag.pending is None:
+                lag.missed += 1
+                self.counts['coalesced'] += 1
+            else:
+                if len(lag.pending) == lag.pending.maxlen:
+                    lag.missed += 1
+                    self.counts['dropped'] += 1
+                lag.pending.append(packets)
+
+    def _start_lagging(self, sid, eio_sid, namespace):
+        if self.task is None:
+            self.task = self.server.start_background_task(self._run)
+        if self.policy == 'disconnect':
+            self.counts['disconnected'] += 1
+            self.server.start_background_task(self.server.disconnect, sid, namespace=namespace)
+        lag = self.lagging[eio_sid] = _Lag(sid, namespace, self.max_depth if self.policy == 'drop_oldest' else 0)
+        return lag
+
+    def _run(self):
+        while True:
+            self.server.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Resumes the lagging connections whose queue has drained to half of the maximum depth:
+        sends them a "resync" event, then the messages kept for them. Forgets closed connections.
+        """
+        sockets = self.server.eio.sockets
+        with self.lock:
+            for eio_sid, lag in list(self.lagging.items()):
+                socket = sockets.get(eio_sid)
+                if socket is None or socket.closed:
+                    del self.lagging[eio_sid]
+                    continue
+                if lag.pending is None and lag.missed == 0 or socket.queue.qsize() > self.max_depth // 2:
+                    continue
+
+                del self.lagging[eio_sid]
+                if lag.missed:
+                    self.counts['resyncs'] += 1
+                    self.server._send_packet(eio_sid, self.server.packet_class(
+                        packet.EVENT, namespace=lag.namespace, data=[RESYNC_EVENT]))
+                for packets in lag.pending or ():
+                    for pkt in packets:
+                        self.server._send_eio_packet(eio_sid, pkt)
+
+    def depth(self, sid, namespace='/'):
+        """
+        Returns the number of packets waiting to be sent to a connection, held back ones included.
+        """
+        eio_sid = self.eio_sid_from_sid(sid, namespace)
+        socket = self.server.eio.sockets.get(eio_sid)
+        if socket is None:
+            return 0
+        lag = self.lagging.get(eio_sid)
+        held = sum(len(packets) for packets in lag.pending) if lag is not None and lag.pending else 0
+        return socket.queue.qsize() + held
+
+    def stats(self):
+        """
+        Returns the outbound queue depths of this process and the overflow counts.
+        Returns:
+            dict: max_depth and total_depth of the Engine.IO send queues, the number of lagging
+            connections, and the coalesced, dropped, disconnected and resyncs counts.
+        """
+        depths = [socket.queue.qsize() for socket in list(self.server.eio.sockets.values())]
+        with self.lock:
+            return {
+                "max_depth": max(depths, default=0),
+                "total_depth": sum(depths),
+                "lagging": len(self.lagging),
+                **self.counts
+            }
+
+def make_manager(message_queue, max_depth, policy, flush_interval_ms):
+    """
+    Returns the Socket.IO client manager for a message queue URL, picked like Flask-SocketIO does
+    (with unix:// URLs going to the bundled broker), with bounded outbound queues.
+    Args:
+        message_queue (str): The message queue URL, or None for a single process.
+        max_depth (int): Packets waiting for a connection before it counts as lagging.
+        policy (str): coalesce, drop_oldest or disconnect.
+        flush_interval_ms (int): How often lagging connections are checked.
+    Returns:
+        BoundedOutbound: The client manager.
+    """
+    if message_queue is None:
+        manager = BoundedOutbound()
+    else:
+        if message_queue.startswith('unix://'):
+            queue_class = UnixSocketManager
+        elif message_queue.startswith(('redis://', 'rediss://')):
+            queue_class = socketio.RedisManager
+        elif message_queue.startswith('kafka://'):
+            queue_class = socketio.KafkaManager
+        elif message_queue.startswith('zmq'):
+            queue_class = socketio.ZmqManager
+        else:
+            queue_class = socketio.KombuManager
+        bounded_class = type(f'Bounded{queue_class.__name__}', (queue_class, BoundedOutbound), {})
+        manager = bounded_class(message_queue, channel='flask-socketio')
+    manager.set_limits(max_depth, policy, flush_interval_ms)
+    return manager
@@ -0,0 +1,220 @@
+from config import app, db, socketio
+from models import PresenceModel, UserModel, UserChatModel
+from sqlalchemy.orm import aliased
+import atexit
+import wire
+import threading
+import time
+import uuid
+
+"""
+This module tracks which users are connected and pushes presence changes to the users who share a room with them.
+Live state is kept in an in-memory registry driven by Socket.IO connect/disconnect events and client heartbeats.
+A connection whose heartbeats stop for PRESENCE_HEARTBEAT_TIMEOUT_S seconds no longer counts as online.
+Status changes are written to UserModel.status in one batch every PRESENCE_FLUSH_INTERVAL_MS milliseconds,
+and the same batch is sent as a compact {username: status} diff on the private channel of every co-member.
+When several workers share a message queue (SOCKETIO_MESSAGE_QUEUE), a user can be connected to more than one
+of them, so each worker also records the users connected to it in PresenceModel, in the same transaction as the
+status changes, and refreshes its rows every third of PRESENCE_HEARTBEAT_TIMEOUT_S. A user whose last connection
+on a worker closes stays online while another worker has a fresh row for them; rows of a worker that stopped
+refreshing them, e.g. because it crashed, are ignored and deleted once they are older than the timeout.
+Logging out marks the user offline on every worker.
+Classes:
+    PresenceRegistry: The registry and its background flush task.
+Functions:
+    user_channel(user_id): Name of the Socket.IO room every connection of a user joins.
+Objects:
+    presence_registry: The process-wide PresenceRegistry.
+"""
+
+def user_channel(user_id):
+    """
+    Returns the name of the Socket.IO room every connection of a user joins.
+    """
+    return f'user:{user_id}'
+
+class PresenceRegistry():
+
+    def __init__(self, flush_interval_ms, heartbeat_timeout_s, worker=None):
+        """
+        Args:
+            flush_interval_ms (int): Milliseconds between two flushes of the status changes.
+            heartbeat_timeout_s (float): Seconds without heartbeats after which a connection is stale.
+            worker (str, optional): Id of this worker in PresenceModel, when presence is shared between
+                workers; None for a single worker.
+        """
+        self.flush_interval = flush_interval_ms / 1000
+        self.heartbeat_timeout = heartbeat_timeout_s
+        self.worker = worker
+        self.sids = {}
+        self.users = {}
+        self.pending = {}
+        self.logged_out = set()
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+        self.task = None
+
+    def connect(self, sid, user_id, username):
+        """
+        Registers a connection of a user, marking the user online if it is the first one.
+        """
+        if self.task is None:
+            self.task = socketio.start_background_task(self._run)
+        with self.lock:
+            self.sids[sid] = (user_id, username)
+            self._attach(sid, user_id, username)
+
+    def disconnect(self, sid):
+        """
+        Forgets a connection, marking its user offline if it was the last one.
+        """
+        with self.lock:
+            if sid in self.sids:
+                self._detach(sid, *self.sids.pop(sid))
+
+    def heartbeat(self, sid):
+        """
+        Records a heartbeat of a connection, bringing its user back online if the connection had gone stale.
+        """
+        with self.lock:
+            if sid in self.sids:
+                self._attach(sid, *self.sids[sid])
+
+    def logout(self, user_id, username):
+        """
+        Marks a user offline and stops counting the user's open connections.
+        """
+        with self.lock:
+            self.sids = {sid: user for sid, user in self.sids.items() if user[0] != user_id}
+            self.users.pop(user_id, None)
+            self.pending[user_id] = (username, 'offline')
+            self.logged_out.add(user_id)
+
+    def status_of(self, user_id, default):
+        """
+        Returns the live status of a user known to this process, or default for the others.
+        """
+        with self.lock:
+            if user_id in self.pending:
+                return self.pending[user_id][1]
+            if user_id in self.users:
+                return 'online'
+        return default
+
+    def stop(self):
+        """
+        Writes the pending status changes and stops the flush task.
+        """
+        if self.task is None:
+            return
+        self.task = None
+        self.flush()
+
+    def _attach(self, sid, user_id, username):
+        if user_id not in self.users:
+            self.users[user_id] = {}
+            self.pending[user_id] = (username, 'online')
+        self.users[user_id][sid] = time.monotonic()
+
+    def _detach(self, sid, user_id, username):
+        connections = self.users.get(user_id)
+        if connections is None or sid not in connections:
+            return
+        del connections[sid]
+        if not connections:
+            del self.users[user_id]
+            self.pending[user_id] = (username, 'offline')
+
+    def _sweep(self):
+        stale_before = time.monotonic() - self.heartbeat_timeout
+        with self.lock:
+            for user_id, connections in list(self.users.items()):
+                for sid, last_seen in list(connections.items()):
+                    if last_seen < stale_before:
+                        self._detach(sid, *self.sids[sid])
+
+    def _run(self):
+        while self.task is not None:
+            socketio.sleep(self.flush_interval)
+            self._sweep()
+            self.flush()
+
+    def _share(self, changes, logged_out, connected):
+        """
+        Records the users connected to this worker in PresenceModel and returns the status changes other
+        workers do not contradict: users still connected elsewhere neither go offline nor come online again.
+        """
+        now = time.time_ns() // 1_000_000
+        stale_before = now - int(self.heartbeat_timeout * 1000)
+        PresenceModel.detach_many(self.worker, [user_id for user_id, (_, s) in changes.items() if s == 'offline'])
+        if logged_out:
+            db.session.execute(db.delete(PresenceModel).where(PresenceModel.user_id.in_(logged_out)))
+        if connected is None:
+            connected = [user_id for user_id, (_, s) in changes.items() if s == 'online']
+        else:
+            db.session.execute(db.delete(PresenceModel).where(PresenceModel.seen_at < stale_before))
+        PresenceModel.attach_many(self.worker, connected, now)
+
+        elsewhere = PresenceModel.online_elsewhere(
+            self.worker, [user_id for user_id in changes if user_id not in logged_out], stale_before)
+        return {user_id: change for user_id, change in changes.items() if user_id not in elsewhere}
+
+    def flush(self):
+        """
+        Writes the pending status changes in one transaction and pushes them to the co-members' channels.
+        With a shared registry, this worker's rows in PresenceModel are updated in the same transaction.
+        """
+        refresh = self.worker is not None and (
+            self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.heartbeat_timeout / 3)
+        with self.lock:
+            changes, self.pending = self.pending, {}
+            logged_out, self.logged_out = self.logged_out, set()
+            connected = list(self.users) if refresh else None
+        if not changes and not refresh:
+            return
+
+        pending = changes
+        with app.app_context():
+            try:
+                if self.worker is not None:
+                    changes = self._share(changes, logged_out, connected)
+                for status in ('online', 'offline'):
+                    ids = [user_id for user_id, (_, s) in changes.items() if s == status]
+                    if ids:
+                        UserModel.query.filter(UserModel.id.in_(ids)) \
+                            .update({UserModel.status: status}, synchronize_session=False)
+                db.session.commit()
+                if refresh:
+                    self.refreshed_at = time.monotonic()
+                if not changes:
+                    return
+
+                changed = aliased(UserChatModel)
+                member = aliased(UserChatModel)
+                pairs = db.session.query(member.user_id, changed.user_id) \
+                    .select_from(changed) \
+                    .join(member, member.chat_id == changed.chat_id) \
+                    .filter(changed.user_id.in_(list(changes)), member.user_id != changed.user_id) \
+                    .distinct() \
+                    .all()
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Failed to flush %d presence changes', len(pending))
+                with self.lock:
+                    for user_id, change in pending.items():
+                        self.pending.setdefault(user_id, change)
+                    self.logged_out |= logged_out
+                return
+            finally:
+                db.session.remove()
+
+        diffs = {}
+        for recipient, user_id in pairs:
+            username, status = changes[user_id]
+            diffs.setdefault(recipient, {})[username] = status
+        for recipient, diff in diffs.items():
+            wire.broadcast('presence', diff, user_channel(recipient))
+
+presence_registry = PresenceRegistry(app.config['PRESENCE_FLUSH_INTERVAL_MS'], app.config['PRESENCE_HEARTBEAT_TIMEOUT_S'],
+                                     uuid.uuid4().hex if app.config['SOCKETIO_MESSAGE_QUEUE'] else None)
+atexit.register(presence_registry.stop)
@@ -0,0 +1,59 @@
+from config import app
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+This module counts the SQL statements executed while handling each request and, in debug mode,
+fails requests whose view runs more statements than it declared. It guards the routes against
+N+1 regressions, where the number of statements grows with the number of rows a user owns.
+Functions:
+    max_queries(limit): Decorator declaring the statement budget of a view.
+    count_statement(): SQLAlchemy cursor hook incrementing the per-request statement counter.
+    reset_statement_count(): before_request hook starting the counter at zero.
+    check_query_budget(response): after_request hook enforcing the budget in debug mode.
+"""
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Increments the statement counter of the current request, if there is one.
+    """
+    if has_request_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+
+def max_queries(limit):
+    """
+    Declares the maximum number of SQL statements a view may execute per request.
+    Must be placed directly below @app.route so the budget is set on the registered view.
+    Args:
+        limit (int): The statement budget of the view.
+    """
+    def decorator(view):
+        view.max_queries = limit
+        return view
+    return decorator
+
+@app.before_request
+def reset_statement_count():
+    """
+    Starts the statement counter of the current request at zero.
+    """
+    g.sql_statements = 0
+
+@app.after_request
+def check_query_budget(response):
+    """
+    Raises an AssertionError in debug mode when a view exceeded its declared statement budget.
+    Returns:
+        Response: The unchanged response.
+    """
+    if not app.debug or request.endpoint is None:
+        return response
+
+    limit = getattr(app.view_functions[request.endpoint], 'max_queries', None)
+    statements = g.get('sql_statements', 0)
+    if limit is not None and statements > limit:
+        raise AssertionError(f'{request.endpoint} executed {statements} SQL statements, budget is {limit}')
+
+    return response
@@ -0,0 +1,278 @@
+from config import app, db
+from flask_jwt_extended import create_access_token
+from models import ChatModel, MessageModel, UserChatModel, UserModel
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+import argparse
+import auth  # noqa: F401 registers the authentication routes
+import chat  # noqa: F401 registers the chat routes
+import json
+import statistics
+import sys
+import time
+
+"""
+This module checks that the read endpoints keep using their indexes on a large database, such as one
+filled by datagen.py. It calls each endpoint through the Flask test client for a few skewed samples
+(the user in the most rooms, the busiest room, a median room), records every SQL statement the request
+runs, and reports for each statement its EXPLAIN QUERY PLAN and its median duration.
+A check fails when:
+    - a plan scans a whole table ("SCAN <table>" without an index, full-text tables excepted),
+    - a case does not use one of the indexes it expects (e.g. ix_message_chat_id_id for history pages),
+    - a statement takes longer than --max-ms,
+    - with --compare, a statement or request got slower than in the baseline report by more than --tolerance
+      (and by more than --min-delta-ms, so sub-millisecond noise does not fail the run).
+The process exits with status 1 if any check fails.
+Functions:
+    pick_samples(): Picks the users and rooms the cases run against.
+    cases(samples): Returns the checked requests and the indexes each one must use.
+    check_plan(plan, expected): Returns the problems found in the query plans of a request.
+    run_case(client, case, repeat): Runs one request and explains and times its statements.
+    run(repeat, max_ms): Runs every case and returns the report.
+    compare(report, baseline, tolerance, min_delta_ms): Returns the timings that regressed from a baseline.
+Usage:
+    CHAT_DATABASE_URL=sqlite:////tmp/large.db python queryplans.py --output plans.json
+    CHAT_DATABASE_URL=sqlite:////tmp/large.db python queryplans.py --compare plans.json
+"""
+
+TABLES = ('user_model', 'chat_model', 'user_chat_model', 'message_model')
+SEARCH_TERM = 'deploy broken build'
+
+_statements = None
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Records the statements run while a case is being captured.
+    """
+    if _statements is not None and not executemany:
+        _statements.append((statement, parameters))
+
+def pick_samples():
+    """
+    Picks the samples the cases run against: the user in the most rooms, the room with the most
+    messages and the room with the median number of messages.
+    Returns:
+        dict: username, busy_room and median_room (ChatModel names), and message ids and timestamps
+        of the busy room to page from.
+    """
+    user_id = db.session.query(UserChatModel.user_id) \
+        .group_by(UserChatModel.user_id) \
+        .order_by(func.count(UserChatModel.id).desc()) \
+        .limit(1).scalar()
+    if user_id is None:
+        sys.exit('The database is empty; fill it with datagen.py first.')
+
+    rooms = db.session.query(ChatModel.id, ChatModel.name).order_by(ChatModel.message_count.desc())
+    busy = rooms.first()
+    median = rooms.offset(rooms.count() // 2).first()
+    first_id, last_id, first_at, last_at = db.session.query(
+        func.min(MessageModel.id), func.max(MessageModel.id),
+        func.min(MessageModel.created_at), func.max(MessageModel.created_at)
+    ).filter(MessageModel.chat_id == busy.id).one()
+
+    return {
+        "username": db.session.get(UserModel, user_id).username,
+        "busy_room": busy.name,
+        "median_room": median.name,
+        "middle_id": (first_id + last_id) // 2,
+        "old_id": first_id + (last_id - first_id) // 10,
+        "middle_at": (first_at + last_at) // 2,
+        "day_ms": 86_400_000,
+    }
+
+def cases(samples):
+    """
+    Returns the checked requests.
+    Args:
+        samples (dict): The result of pick_samples().
+    Returns:
+        list: Tuples of a case name, a route, its query parameters and the indexes its plans must use.
+    """
+    user, busy, median = samples['username'], samples['busy_room'], samples['median_room']
+    return [
+        ('get_rooms', '/chat/get_rooms', {"user": user},
+         ['ix_user_model_username', 'sqlite_autoindex_user_chat_model_1']),
+        ('find_chats', '/chat/find_chats', {"user": user, "item": user[:-1]},
+         ['user_search', 'chat_search', 'sqlite_autoindex_user_chat_model_1']),
+        ('search_messages', '/chat/search_messages', {"user": user, "q": SEARCH_TERM},
+         ['message_search', 'sqlite_autoindex_user_chat_model_1']),
+        ('get_messages latest (busy room)', '/chat/get_messages', {"room": busy},
+         ['ix_message_chat_id_id']),
+        ('get_messages latest (median room)', '/chat/get_messages', {"room": median},
+         ['ix_message_chat_id_id']),
+        ('get_messages before_id', '/chat/get_messages', {"room": busy, "before_id": samples['middle_id']},
+         ['ix_message_chat_id_id']),
+        ('get_messages after_id', '/chat/get_messages', {"room": busy, "after_id": samples['old_id']},
+         ['ix_message_chat_id_id']),
+        ('get_messages since/until', '/chat/get_messages',
+         {"room": busy, "since": samples['middle_at'], "until": samples['middle_at'] + samples['day_ms']},
+         ['ix_message_chat_id_created_at']),
+    ]
+
+def check_plan(plan, expected):
+    """
+    Returns the problems found in the query plans of a request.
+    Args:
+        plan (list): The EXPLAIN QUERY PLAN detail lines of every statement of the request.
+        expected (list): Names of indexes, or full-text tables, the plans must use.
+    Returns:
+        list: Human readable problems, empty if the plans are fine.
+    """
+    problems = []
+    for line in plan:
+        words = line.split()
+        if words[:1] == ['SCAN'] and words[1] in TABLES and 'INDEX' not in words:
+            problems.append(f'full table scan: {line}')
+    for name in expected:
+        if not any(name in line.split() for line in plan):
+            problems.append(f'does not use {name}')
+    return problems
+
+def _explain(statement, parameters):
+    with db.engine.connect() as connection:
+        return [row[3] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+
+def _time(statement, parameters, repeat):
+    durations = []
+    with db.engine.connect() as connection:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            connection.exec_driver_sql(statement, parameters).fetchall()
+            durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+def run_case(client, case, repeat):
+    """
+    Runs one request, then explains and times every statement it ran.
+    Args:
+        client (FlaskClient): A test client.
+        case (tuple): A case from cases().
+        repeat (int): How many times each statement and the request are timed; the median is kept.
+    Returns:
+        dict: The status code, the median request duration, the plan problems and every statement
+        with its plan and median duration.
+    """
+    global _statements
+    name, route, params, expected = case
+    token = create_access_token(identity=params.get('user', 'queryplans'))
+    headers = {"Authorization": f'Bearer {token}'}
+
+    _statements = []
+    response = client.get(route, query_string=params, headers=headers)
+    recorded, _statements = _statements, None
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        client.get(route, query_string=params, headers=headers)
+        durations.append((time.perf_counter() - start) * 1000)
+
+    statements = []
+    for statement, parameters in recorded:
+        if not statement.lstrip().upper().startswith('SELECT'):
+            continue
+        statements.append({
+            "sql": ' '.join(statement.split()),
+            "plan": _explain(statement, parameters),
+            "ms": round(_time(statement, parameters, repeat), 3),
+        })
+
+    return {
+        "route": route,
+        "params": params,
+        "status": response.status_code,
+        "ms": round(statistics.median(durations), 3),
+        "problems": check_plan([line for s in statements for line in s['plan']], expected),
+        "statements": statements,
+    }
+
+def run(repeat=5, max_ms=50):
+    """
+    Runs every case against the current database.
+    Args:
+        repeat (int): How many times each statement and request are timed.
+        max_ms (float): The slowest a single statement may be, in milliseconds.
+    Returns:
+        dict: The samples, the row counts, and the result of every case by name.
+    """
+    samples = pick_samples()
+    client = app.test_client()
+    report = {
+        "samples": samples,
+        "rows": {table: db.session.execute(db.text(f'SELECT count(*) FROM {table}')).scalar() for table in TABLES},
+        "cases": {},
+    }
+    for case in cases(samples):
+        result = run_case(client, case, repeat)
+        if result['status'] != 200:
+            result['problems'].append(f'status {result["status"]}')
+        for statement in result['statements']:
+            if statement['ms'] > max_ms:
+                result['problems'].append(f'{statement["ms"]} ms > {max_ms} ms: {statement["sql"][:80]}')
+        report['cases'][case[0]] = result
+    return report
+
+def compare(report, baseline, tolerance, min_delta_ms):
+    """
+    Prints the timings of every case next to a baseline report and returns the regressions.
+    Statements are matched by their SQL text; a statement missing from the baseline is not compared.
+    Args:
+        report (dict): The current report.
+        baseline (dict): A report saved with --output.
+        tolerance (float): Allowed slowdown, as a fraction.
+        min_delta_ms (float): Slowdowns smaller than this many milliseconds are ignored.
+    Returns:
+        list: Descriptions of the timings that regressed.
+    """
+    regressions = []
+    for name, result in report['cases'].items():
+        before = baseline['cases'].get(name)
+        if before is None:
+            continue
+        before_statements = {statement['sql']: statement['ms'] for statement in before['statements']}
+        timings = [(name, before['ms'], result['ms'])] + [
+            (f'{name}: {statement["sql"][:60]}', before_statements[statement['sql']], statement['ms'])
+            for statement in result['statements'] if statement['sql'] in before_statements
+        ]
+        for label, old, new in timings:
+            regressed = new - old > min_delta_ms and new > old * (1 + tolerance)
+            print(f'{"REGRESSED " if regressed else ""}{label}: {old} ms -> {new} ms')
+            if regressed:
+                regressions.append(f'{label}: {old} ms -> {new} ms')
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the query plans and timings of the read endpoints.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per statement and request.')
+    parser.add_argument('--max-ms', type=float, default=50, help='Slowest allowed statement, in milliseconds.')
+    parser.add_argument('--output', help='Save the report to this JSON file.')
+    parser.add_argument('--compare', help='Compare with the report saved in this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='Allowed slowdown, as a fraction.')
+    parser.add_argument('--min-delta-ms', type=float, default=1, help='Ignore slowdowns smaller than this.')
+    parser.add_argument('--verbose', action='store_true', help='Print every statement and its plan.')
+    args = parser.parse_args()
+
+    with app.app_context():
+        report = run(args.repeat, args.max_ms)
+
+    failures = []
+    for name, result in report['cases'].items():
+        print(f'{"FAIL" if result["problems"] else "ok  "} {name}: {result["ms"]} ms, '
+              f'{len(result["statements"])} statements')
+        for problem in result['problems']:
+            print(f'       {problem}')
+            failures.append(f'{name}: {problem}')
+        if args.verbose or result['problems']:
+            for statement in result['statements']:
+                print(f'       {statement["ms"]} ms  {statement["sql"]}')
+                for line in statement['plan']:
+                    print(f'           {line}')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            failures += compare(report, json.load(baseline), args.tolerance, args.min_delta_ms)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,136 @@
+from config import db
+from sqlalchemy import column, table, text
+
+"""
+This module keeps SQLite FTS5 trigram indexes over usernames, room names and message bodies.
+A leading-wildcard LIKE cannot use a b-tree index, so substring searches are answered from the
+trigram indexes instead. The indexes are standalone FTS5 tables whose rowid is the id of the
+indexed row; MyModels.save/delete keep them in sync through index() and unindex().
+Functions:
+    create_indexes(): Creates missing FTS5 tables and fills them from the existing rows.
+    index(obj, replace): Adds or refreshes the index entry of a model instance.
+    index_many(objs, model): Adds index entries for many new instances, or inserted rows, of one model in one statement.
+    unindex(obj): Removes the index entry of a model instance.
+    unindex_many(ids, model): Removes the index entries of many rows of one model in one statement.
+    matches(model, term): Returns a filter selecting the rows of a model matching a search term.
+    search_messages(username, term, limit, offset): Ranked message search in the user's rooms.
+"""
+
+MIN_TERM_LENGTH = 3
+
+INDEXES = {
+    'user_model': ('user_search', 'username'),
+    'chat_model': ('chat_search', 'name'),
+    'message_model': ('message_search', 'message'),
+}
+
+def _phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+def create_indexes():
+    """
+    Creates the FTS5 tables that do not exist yet and fills them from the indexed tables.
+    Must be called inside an application context, after db.create_all().
+    """
+    with db.engine.begin() as connection:
+        for source, (fts, field) in INDEXES.items():
+            exists = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": fts}
+            ).first()
+            if exists:
+                continue
+
+            connection.exec_driver_sql(f"CREATE VIRTUAL TABLE {fts} USING fts5({field}, tokenize = 'trigram')")
+            connection.exec_driver_sql(f"INSERT INTO {fts} (rowid, {field}) SELECT id, {field} FROM {source}")
+
+def index(obj, replace=True):
+    """
+    Adds the index entry of a flushed model instance, replacing the previous one if replace is set.
+    Instances of models without an index are ignored.
+    """
+    if obj.__tablename__ not in INDEXES:
+        return
+
+    fts, field = INDEXES[obj.__tablename__]
+    if replace:
+        db.session.execute(text(f"DELETE FROM {fts} WHERE rowid = :id"), {"id": obj.id})
+    db.session.execute(text(f"INSERT INTO {fts} (rowid, {field}) VALUES (:id, :value)"),
+                       {"id": obj.id, "value": getattr(obj, field)})
+
+def index_many(objs, model=None):
+    """
+    Adds the index entries of many flushed, newly created instances of the same model.
+    Rows returned by an INSERT ... RETURNING can be indexed too, by passing their model.
+    """
+    if not objs:
+        return
+    table = (model or objs[0]).__tablename__
+    if table not in INDEXES:
+        return
+
+    fts, field = INDEXES[table]
+    db.session.execute(text(f"INSERT INTO {fts} (rowid, {field}) VALUES (:id, :value)"),
+                       [{"id": obj.id, "value": getattr(obj, field)} for obj in objs])
+
+def unindex(obj):
+    """
+    Removes the index entry of a model instance. Instances of models without an index are ignored.
+    """
+    if obj.__tablename__ not in INDEXES:
+        return
+
+    fts, _ = INDEXES[obj.__tablename__]
+    db.session.execute(text(f"DELETE FROM {fts} WHERE rowid = :id"), {"id": obj.id})
+
+def unindex_many(ids, model):
+    """
+    Removes the index entries of many rows of one model, by id, in one statement.
+    """
+    if not ids or model.__tablename__ not in INDEXES:
+        return
+
+    fts, _ = INDEXES[model.__tablename__]
+    db.session.execute(text(f"DELETE FROM {fts} WHERE rowid = :id"), [{"id": id} for id in ids])
+
+def matches(model, term):
+    """
+    Returns a filter selecting the rows of a model whose indexed field contains the term.
+    Terms shorter than a trigram cannot be answered by the index and fall back to LIKE.
+    Args:
+        model (db.Model): UserModel, ChatModel or MessageModel.
+        term (str): The substring to look for.
+    Returns:
+        ColumnElement: A criterion usable in Query.filter().
+    """
+    fts, field = INDEXES[model.__tablename__]
+    if len(term) < MIN_TERM_LENGTH:
+        return getattr(model, field).like(f'%{term}%')
+
+    matching = db.select(column('rowid')) \
+        .select_from(table(fts)) \
+        .where(text(f"{fts} MATCH :{fts}_term").bindparams(**{f'{fts}_term': _phrase(term)}))
+    return model.id.in_(matching)
+
+def search_messages(username, term, limit, offset=0):
+    """
+    Searches the bodies of messages posted in the rooms the user belongs to, best match first.
+    Args:
+        username (str): The user whose rooms are searched.
+        term (str): The substring to look for, at least MIN_TERM_LENGTH characters long.
+        limit (int): Maximum number of results.
+        offset (int): Number of results to skip.
+    Returns:
+        list: Rows with id, message, created_at, username and room.
+    """
+    return db.session.execute(text("""
+        SELECT m.id, m.message, m.created_at, author.username, c.name AS room
+        FROM message_search
+        JOIN message_model m ON m.id = message_search.rowid
+        JOIN user_chat_model uc ON uc.chat_id = m.chat_id
+        JOIN user_model member ON member.id = uc.user_id
+        JOIN user_model author ON author.id = m.user_id
+        JOIN chat_model c ON c.id = m.chat_id
+        WHERE message_search MATCH :term AND member.username = :username
+        ORDER BY message_search.rank
+        LIMIT :limit OFFSET :offset
+    """), {"term": _phrase(term), "username": username, "limit": limit, "offset": offset}).all()
@@ -0,0 +1,102 @@
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql.elements import TextClause
+
+"""
+This module tunes the SQLite storage of the backend and splits its connections into one writer and many readers.
+Every new connection runs the SQLITE_PRAGMAS from the config (WAL journal, synchronous, cache and mmap
+sizes, busy timeout, ...). With WAL, readers and the writer no longer block each other.
+The default engine keeps a single connection, so the writes of a process are serialized in the pool instead of
+failing with "database is locked", and a "reader" bind holds SQLITE_READER_POOL_SIZE connections opened with
+query_only. RoutingSession sends reads to the readers and everything else to the writer. Once a transaction
+has written, it stays on the writer until it ends, so it reads its own writes.
+In-memory and non-SQLite databases keep a single engine.
+Classes:
+    RoutingSession: Flask-SQLAlchemy session routing reads to the reader bind.
+Functions:
+    configure(app): Sets the engine options and the reader bind from the storage settings.
+    install_pragmas(app, db): Runs the configured pragmas on every new connection.
+"""
+
+READER = 'reader'
+WRITER_PINNED = 'writer_pinned'
+
+def _splits(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:') \
+        and 'mode=memory' not in str(url)
+
+def configure(app):
+    """
+    Sets SQLALCHEMY_ENGINE_OPTIONS and SQLALCHEMY_BINDS from the storage settings of the config.
+    Must run before SQLAlchemy(app).
+    Args:
+        app (Flask): The application, with SQLITE_WRITER_TIMEOUT_S and SQLITE_READER_POOL_SIZE set.
+    """
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    if not _splits(url):
+        return
+
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {}).update({
+        "pool_size": 1,
+        "max_overflow": 0,
+        "pool_timeout": app.config['SQLITE_WRITER_TIMEOUT_S'],
+    })
+    app.config.setdefault('SQLALCHEMY_BINDS', {})[READER] = {
+        "url": url,
+        "pool_size": app.config['SQLITE_READER_POOL_SIZE'],
+        "max_overflow": 0,
+    }
+
+def install_pragmas(app, db):
+    """
+    Runs the SQLITE_PRAGMAS of the config on every new SQLite connection, and makes the
+    connections of the reader bind query_only.
+    """
+    pragmas = app.config['SQLITE_PRAGMAS']
+    with app.app_context():
+        engines = dict(db.engines)
+
+    for key, engine in engines.items():
+        if engine.dialect.name != 'sqlite':
+            continue
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record, query_only=(key == READER)):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+            if query_only:
+                cursor.execute('PRAGMA query_only = ON')
+            cursor.close()
+
+def _is_read(clause):
+    if clause is None:
+        return False
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip()[:6].upper() == 'SELECT'
+    return getattr(clause, 'is_select', False)
+
+class RoutingSession(Session):
+    """
+    Session sending reads to the reader bind, when there is one, and writes to the default engine.
+    A transaction that has written stays on the default engine until it ends.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self.info.get(WRITER_PINNED) and not self._flushing and _is_read(clause):
+            engine = self._db.engines.get(READER)
+            if engine is not None:
+                return engine
+
+        self.info[WRITER_PINNED] = True
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def unpin_writer(session, transaction):
+    """
+    Lets the next transaction of a session read from the reader bind again.
+    """
+    if transaction.parent is None:
+        session.info.pop(WRITER_PINNED, None)
@@ -0,0 +1,90 @@
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+
+"""
+Shared fixtures of the backend tests.
+The tests run against a scratch SQLite database and archive directory, set through the environment
+before config is imported, and every test starts from an empty, migrated schema and empty caches.
+The app runs in debug mode, so a route that exceeds its @max_queries budget fails its test.
+Fixtures:
+    database: Recreates the schema, removes the archive and clears the per-process caches (autouse).
+    make_user: Creates a user and returns its id.
+    make_room: Creates a room with the given members and returns its id.
+    connect: Opens a Socket.IO test client authenticated as a user.
+"""
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRATCH_DIR = tempfile.mkdtemp(prefix='chat-tests-')
+os.environ['CHAT_DATABASE_URL'] = 'sqlite:///' + os.path.join(SCRATCH_DIR, 'chat.db')
+os.environ['CHAT_ARCHIVE_DIR'] = os.path.join(SCRATCH_DIR, 'archive')
+os.environ['CHAT_DEBUG'] = 'true'
+sys.path.insert(0, BACKEND_DIR)
+
+from config import app, db, socketio  # noqa: E402
+from cache import identity_cache  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
+from history import room_history  # noqa: E402
+from models import ChatModel, UserChatModel, UserModel  # noqa: E402
+from writebehind import message_writer  # noqa: E402
+import archive  # noqa: E402
+import auth  # noqa: E402,F401 registers the authentication routes
+import chat  # noqa: E402,F401 registers the chat routes and Socket.IO handlers
+import migrations  # noqa: E402
+import search  # noqa: E402
+
+@pytest.fixture(autouse=True)
+def database():
+    with app.app_context():
+        with db.engine.begin() as connection:
+            for fts, _ in search.INDEXES.values():
+                connection.exec_driver_sql(f'DROP TABLE IF EXISTS {fts}')
+        db.drop_all()
+        db.create_all()
+        migrations.upgrade()
+    shutil.rmtree(app.config['ARCHIVE_DIR'], ignore_errors=True)
+    archive._open_archives.clear()
+    identity_cache.entries.clear()
+    with room_history.lock:
+        room_history.rooms.clear()
+        room_history.size = 0
+    yield
+    message_writer.stop()
+
+@pytest.fixture
+def make_user():
+    def make(username):
+        with app.app_context():
+            user = UserModel(username=username, email=f'{username}@test.local', password='-')
+            user.save()
+            return user.id
+    return make
+
+@pytest.fixture
+def make_room():
+    def make(name, user_ids, type='public'):
+        with app.app_context():
+            room = ChatModel(name=name, type=type)
+            room.save()
+            for user_id in user_ids:
+                UserChatModel(user_id=user_id, chat_id=room.id).save()
+            return room.id
+    return make
+
+@pytest.fixture
+def connect():
+    clients = []
+
+    def open_client(username, **auth):
+        with app.app_context():
+            token = create_access_token(identity=username)
+        client = socketio.test_client(app, auth={"token": token, **auth})
+        clients.append(client)
+        return client
+
+    yield open_client
+    for client in clients:
+        if client.is_connected():
+            client.disconnect()
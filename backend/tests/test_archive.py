@@ -0,0 +1,92 @@
+from config import app
+from models import MessageModel
+import archive
+import os
+import pytest
+
+"""
+Tests of the message archive: history pages read through from the table to the archive without gaps or repeats.
+"""
+
+@pytest.fixture
+def room(make_user, make_room, monkeypatch):
+    monkeypatch.setitem(app.config, 'ARCHIVE_BLOCK_MESSAGES', 3)
+    alice = make_user('alice')
+    chat_id = make_room('general', [alice])
+    with app.app_context():
+        for i in range(1, 11):
+            MessageModel(message=f'message {i}', user_id=alice, chat_id=chat_id, created_at=i).save()
+        os.makedirs(app.config['ARCHIVE_DIR'], exist_ok=True)
+        assert archive.archive_room(chat_id, cutoff=7) == 6
+    return chat_id
+
+def ids(messages):
+    return [message.id for message in messages]
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 4, 5, 20])
+def test_pages_before_read_through_the_archive(room, limit):
+    pages, before_id = [], None
+    with app.app_context():
+        assert MessageModel.query.count() == 4
+        while page := archive.get_page(room, before_id=before_id, limit=limit):
+            pages.append(ids(page))
+            before_id = page[-1].id
+
+    assert all(len(page) == limit for page in pages[:-1])
+    assert [id for page in pages for id in page] == list(range(10, 0, -1))
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 4, 5, 20])
+def test_pages_after_read_through_the_archive(room, limit):
+    pages, after_id = [], 0
+    with app.app_context():
+        while page := archive.get_page(room, after_id=after_id, limit=limit):
+            pages.append(ids(page))
+            after_id = page[-1].id
+
+    assert all(len(page) == limit for page in pages[:-1])
+    assert [id for page in pages for id in page] == list(range(1, 11))
+
+def test_time_range_spans_the_archive_and_the_table(room):
+    with app.app_context():
+        page = archive.get_page(room, since=5, until=9)
+
+    assert ids(page) == [8, 7, 6, 5]
+    assert [message.message for message in page] == ['message 8', 'message 7', 'message 6', 'message 5']
+
+@pytest.fixture
+def blocks_read(monkeypatch):
+    read = []
+    messages = archive.RoomArchive._messages
+
+    def record(self, block):
+        read.append(block)
+        return messages(self, block)
+    monkeypatch.setattr(archive.RoomArchive, '_messages', record)
+    return read
+
+def test_time_bounded_reads_skip_blocks_outside_the_range(room, blocks_read):
+    with app.app_context():
+        assert ids(archive.get_page(room, since=5, until=9)) == [8, 7, 6, 5]
+        assert blocks_read == [1]
+        assert ids(archive.get_page(room, after_id=0, until=3)) == [1, 2]
+        assert blocks_read == [1, 0]
+        assert ids(archive.get_page(room, before_id=7, since=2, until=3)) == [2]
+        assert blocks_read == [1, 0, 0]
+
+def test_index_without_time_bounds_is_converted(room, blocks_read):
+    segment_path, index_path = archive._paths(room)
+    with open(index_path, 'rb') as index_file:
+        records = [archive.INDEX_RECORD.unpack(chunk) for chunk in iter(lambda: index_file.read(archive.INDEX_RECORD.size), b'')]
+    with open(os.path.join(app.config['ARCHIVE_DIR'], f'{room}.idx'), 'wb') as old_index_file:
+        for first_id, last_id, _, _, offset, length in records:
+            old_index_file.write(archive.OLD_INDEX_RECORD.pack(first_id, last_id, offset, length))
+    os.unlink(index_path)
+    archive._open_archives.clear()
+
+    with app.app_context():
+        assert ids(archive.get_page(room, before_id=7, limit=10)) == [6, 5, 4, 3, 2, 1]
+
+    with open(index_path, 'rb') as index_file:
+        assert [archive.INDEX_RECORD.unpack(chunk) for chunk in
+                iter(lambda: index_file.read(archive.INDEX_RECORD.size), b'')] == records
+    assert not os.path.exists(os.path.join(app.config['ARCHIVE_DIR'], f'{room}.idx'))
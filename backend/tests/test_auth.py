@@ -0,0 +1,51 @@
+from config import app, db
+from flask_jwt_extended import create_access_token
+from hashing import password_hasher
+from models import UserModel
+from presence import presence_registry
+from werkzeug.security import generate_password_hash
+
+"""
+Tests of the authentication routes.
+"""
+
+def patch(route, identity=None, **body):
+    headers = {}
+    if identity is not None:
+        with app.app_context():
+            headers["Authorization"] = f'Bearer {create_access_token(identity=identity)}'
+    return app.test_client().patch(route, json=body, headers=headers)
+
+def test_logout_only_logs_out_the_token_user(make_user, connect):
+    alice, mallory = make_user('alice'), make_user('mallory')
+    connect('alice')
+    connect('mallory')
+
+    assert patch('/logout', username='alice').status_code == 401
+    assert patch('/logout', 'mallory', username='alice').status_code == 200
+
+    assert presence_registry.status_of(alice, 'offline') == 'online'
+    assert presence_registry.status_of(mallory, 'online') == 'offline'
+
+def stored_hash(user_id):
+    with app.app_context():
+        return db.session.get(UserModel, user_id).password
+
+def test_signin_rehashes_passwords_of_an_outdated_cost(make_user, monkeypatch):
+    alice = make_user('alice')
+    with app.app_context():
+        user = db.session.get(UserModel, alice)
+        user.password = generate_password_hash('secret', 'pbkdf2:sha256:1000')
+        user.save()
+    monkeypatch.setattr(password_hasher, 'method', 'pbkdf2:sha256:2000')
+    monkeypatch.setattr(password_hasher, 'canonical_method', None)
+
+    assert patch('/signin', username='alice', password='wrong').status_code == 400
+    assert stored_hash(alice).startswith('pbkdf2:sha256:1000$')
+
+    assert patch('/signin', username='alice', password='secret').status_code == 200
+    rehashed = stored_hash(alice)
+    assert rehashed.startswith('pbkdf2:sha256:2000$')
+
+    assert patch('/signin', username='alice', password='secret').status_code == 200
+    assert stored_hash(alice) == rehashed
@@ -0,0 +1,60 @@
+from broker import BrokerServer, UnixSocketManager
+import json
+import os
+import pytest
+import socketio
+import tempfile
+import threading
+import time
+
+"""
+Tests of the bundled broker: emits made on one worker reach the clients connected to another.
+"""
+
+@pytest.fixture
+def broker():
+    server = BrokerServer(os.path.join(tempfile.mkdtemp(prefix='chat-broker-'), 'broker.sock'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def start_worker(path):
+    server = socketio.Server(async_mode='threading', client_manager=UnixSocketManager(f'unix://{path}'))
+    server.manager.initialize()
+    server.manager_initialized = True
+    sent = []
+    server._send_eio_packet = lambda eio_sid, packet: sent.append((eio_sid, json.loads(packet.data[1:])))
+    return server, sent
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_emit_reaches_the_clients_of_every_worker(broker):
+    (first, first_sent), (second, second_sent) = start_worker(broker.server_address), start_worker(broker.server_address)
+    assert wait_for(lambda: len(broker.subscribers) == 2)
+    for server, eio_sid in ((first, 'eio-first'), (second, 'eio-second')):
+        sid = server.manager.connect(eio_sid, '/')
+        server.manager.enter_room(sid, '/', 'room:general')
+        server.manager.connect(f'{eio_sid}-outside', '/')
+
+    first.emit('message', {"text": 'hello'}, to='room:general')
+
+    assert wait_for(lambda: first_sent and second_sent)
+    assert first_sent == [('eio-first', ['message', {"text": 'hello'}])]
+    assert second_sent == [('eio-second', ['message', {"text": 'hello'}])]
+
+def test_write_only_publisher_reaches_the_workers(broker):
+    worker, sent = start_worker(broker.server_address)
+    assert wait_for(lambda: len(broker.subscribers) == 1)
+    worker.manager.enter_room(worker.manager.connect('eio-1', '/'), '/', 'user:1')
+
+    publisher = UnixSocketManager(f'unix://{broker.server_address}', write_only=True)
+    publisher.emit('presence', {"alice": 'online'}, namespace='/', room='user:1')
+
+    assert wait_for(lambda: sent)
+    assert sent == [('eio-1', ['presence', {"alice": 'online'}])]
+    assert len(broker.subscribers) == 1
@@ -0,0 +1,107 @@
+from config import app, socketio
+from models import MessageModel
+import msgpack
+import wire
+
+"""
+Tests of the Socket.IO chat events: who may open a room and what a connection receives.
+"""
+
+def received(client, name):
+    return [event['args'][0] if isinstance(event['args'], list) else event['args']
+            for event in client.get_received() if event['name'] == name]
+
+def save_message(user_id, chat_id, text):
+    with app.app_context():
+        message = MessageModel(message=text, user_id=user_id, chat_id=chat_id, created_at=MessageModel.timestamp())
+        message.save()
+        return message.id
+
+def test_join_requires_membership(make_user, make_room, connect):
+    alice, mallory = make_user('alice'), make_user('mallory')
+    make_room('secret', [alice], type='private')
+    owner, intruder = connect('alice'), connect('mallory')
+
+    assert intruder.emit('join', {"room": 'secret'}, callback=True) == {"msg": "Not a member of the room!"}
+    owner.emit('message', {"message": 'for members only', "room": 'secret'})
+    socketio.sleep(0.2)
+
+    assert received(intruder, 'message') == []
+    assert [message['text'] for message in received(owner, 'message')] == ['for members only']
+    page = owner.emit('join', {"room": 'secret'}, callback=True)
+    assert [message['text'] for message in page['messages']] == ['for members only']
+
+def test_join_unknown_room(make_user, connect):
+    make_user('alice')
+    client = connect('alice')
+
+    assert client.emit('join', {"room": 'nowhere'}, callback=True) == {"msg": "Room not found!"}
+    assert client.is_connected()
+
+def test_room_names_cannot_reach_private_channels(make_user, make_room, connect):
+    bob, mallory = make_user('bob'), make_user('mallory')
+    for name in (f'user:{bob}', f'msgpack:user:{bob}'):
+        make_room(name, [mallory])
+    victim, sender = connect('bob'), connect('mallory')
+    binary_victim = connect('bob', format='msgpack')
+
+    for name in (f'user:{bob}', f'msgpack:user:{bob}'):
+        sender.emit('message', {"message": 'spoofed', "room": name})
+    socketio.sleep(0.2)
+
+    assert len(received(sender, 'message')) == 2
+    assert received(victim, 'message') == []
+    assert received(binary_victim, 'message') == []
+
+def test_exit_broadcasts_the_saved_message(make_user, make_room, connect):
+    alice, bob = make_user('alice'), make_user('bob')
+    room = make_room('general', [alice, bob])
+    forging, leaving, staying = connect('alice'), connect('alice'), connect('bob')
+    forged = save_message(bob, room, 'written by bob')
+    left = save_message(alice, room, 'has left the room.')
+
+    forging.emit('exit', {"id": forged, "room": 'general', "message": 'forged', "dateTime": 'never'})
+    forging.emit('exit', {"id": left, "room": 'general'})
+    leaving.emit('exit', {"id": left, "room": 'general', "message": 'forged', "dateTime": 'never'})
+    socketio.sleep(0.2)
+
+    assert received(forging, 'message_error') == [{"msg": "Message not found!"},
+                                                  {"msg": "Not subscribed to the room!"}]
+    [notice] = received(staying, 'message')
+    assert (notice['id'], notice['username'], notice['text']) == (left, 'alice', 'has left the room.')
+
+def test_connect_room_requires_membership(make_user, make_room, connect):
+    alice, mallory = make_user('alice'), make_user('mallory')
+    room = make_room('secret', [alice], type='private')
+    member, intruder = connect('alice'), connect('mallory')
+    message = save_message(mallory, room, 'spam')
+
+    intruder.emit('connect_room', {"id": message, "room": 'secret', "message": 'spam', "dateTime": 'now'})
+    socketio.sleep(0.2)
+
+    assert received(intruder, 'message_error') == [{"msg": "Not a member of the room!"}]
+    assert received(member, 'message') == []
+
+def test_binary_clients_get_errors_in_their_format(make_user, connect):
+    make_user('alice')
+    client = connect('alice', format='msgpack')
+
+    client.emit('message', {"message": ' ', "room": 'general'})
+
+    assert [msgpack.unpackb(error) for error in received(client, 'message_error')] == \
+        [{"msg": "Message must be a non-empty string!"}]
+
+def test_broadcast_encodes_for_binary_members_only(make_user, make_room, connect, monkeypatch):
+    alice = make_user('alice')
+    make_room('general', [alice])
+    make_room('binary', [alice])
+    connect('alice')
+    packed = []
+    monkeypatch.setattr(wire.msgpack, 'packb', lambda payload: packed.append(payload) or b'\x80')
+
+    wire.broadcast('message', {"text": 'json only'}, wire.room_channel('general'))
+    assert packed == []
+
+    connect('alice', format='msgpack')
+    wire.broadcast('message', {"text": 'both'}, wire.room_channel('binary'))
+    assert packed == [{"text": 'both'}]
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+"""
+Tests of the configuration: environment variable names and the production secret keys.
+"""
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run(args, **env):
+    clean = {name: value for name, value in os.environ.items() if not name.startswith('CHAT_')}
+    return subprocess.run([sys.executable, *args], cwd=BACKEND_DIR, env=dict(clean, **env),
+                          capture_output=True, text=True, timeout=60)
+
+def config_values(**env):
+    script = ('from config import app; print(app.config["SQLALCHEMY_DATABASE_URI"], '
+              'app.config["OUTBOUND_QUEUE_MAX_DEPTH"], app.config["SOCKETIO_MESSAGE_QUEUE"])')
+    return run(['-c', script], **env).stdout.split()
+
+def test_prefixed_names_win_over_the_legacy_ones():
+    assert config_values(DATABASE_URL='sqlite:////tmp/legacy.db', OUTBOUND_QUEUE_MAX_DEPTH='8') == \
+        ['sqlite:////tmp/legacy.db', '8', 'None']
+    assert config_values(DATABASE_URL='sqlite:////tmp/legacy.db', CHAT_DATABASE_URL='sqlite:////tmp/chat.db',
+                         CHAT_SOCKETIO_MESSAGE_QUEUE='unix:///tmp/broker.sock') == \
+        ['sqlite:////tmp/chat.db', '256', 'unix:///tmp/broker.sock']
+
+def test_serve_needs_the_secret_keys():
+    result = run(['main.py', 'serve'], CHAT_JWT_SECRET_KEY='set')
+
+    assert result.returncode == 1
+    assert 'CHAT_SECRET_KEY must be set' in result.stderr
@@ -0,0 +1,57 @@
+from config import app
+from flask_jwt_extended import create_access_token
+from models import MessageModel
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import pytest
+
+"""
+Tests of /chat/get_messages: keyset pages and the ETag validating delta syncs.
+"""
+
+@pytest.fixture
+def room(make_user, make_room):
+    alice = make_user('alice')
+    chat_id = make_room('general', [alice])
+    with app.app_context():
+        for i in range(5):
+            MessageModel(message=f'message {i}', user_id=alice, chat_id=chat_id, created_at=i).save()
+        token = create_access_token(identity='alice')
+    return {"Authorization": f'Bearer {token}'}
+
+def get_messages(headers, etag=None, **params):
+    if etag is not None:
+        headers = dict(headers, **{"If-None-Match": etag})
+    return app.test_client().get('/chat/get_messages', query_string={"room": 'general', **params}, headers=headers)
+
+def texts(response):
+    return [message['text'] for message in response.get_json()['messages']]
+
+def test_etag_of_one_page_does_not_validate_another(room):
+    first = get_messages(room, limit=2)
+    assert texts(first) == ['message 3', 'message 4']
+
+    second = get_messages(room, etag=first.headers['ETag'], limit=2, before_id=first.get_json()['next_before_id'])
+    assert second.status_code == 200
+    assert texts(second) == ['message 1', 'message 2']
+
+def test_etag_validates_only_complete_delta_syncs(room):
+    etag = get_messages(room).headers['ETag']
+
+    assert get_messages(room, etag=etag, after_id=5).status_code == 304
+    behind = get_messages(room, etag=etag, after_id=3)
+    assert behind.status_code == 200
+    assert texts(behind) == ['message 3', 'message 4']
+
+def test_room_is_resolved_from_the_identity_cache(room):
+    get_messages(room)
+    statements = []
+    record = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        assert get_messages(room, etag='"none"', after_id=5).status_code == 200
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+
+    assert len(statements) == 2
+    assert not any('chat_model.name' in statement for statement in statements)
@@ -0,0 +1,23 @@
+from config import app, db
+from metrics import sql_duration
+from sqlalchemy import exc
+import pytest
+
+"""
+Tests of the metrics: SQL timings survive failing statements.
+"""
+
+def test_failed_statements_leave_no_timing_state(make_user):
+    make_user('alice')
+    with app.app_context():
+        with db.engine.connect() as connection:
+            for _ in range(3):
+                with pytest.raises(exc.IntegrityError):
+                    connection.exec_driver_sql("INSERT INTO user_model (username, email, password, status) "
+                                               "VALUES ('alice', 'alice@test.local', '-', 'offline')")
+                connection.rollback()
+            selects = sql_duration.series.get(('SELECT',), [None, 0.0, 0])[2]
+            connection.exec_driver_sql('SELECT 1').scalar()
+
+            assert 'statement_start' not in connection.info
+            assert sql_duration.series[('SELECT',)][2] == selects + 1
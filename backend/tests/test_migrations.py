@@ -0,0 +1,46 @@
+from config import app, db
+from sqlalchemy import Integer, inspect
+import datetime
+import migrations
+import pytest
+
+"""
+Tests of the schema migrations.
+"""
+
+@pytest.fixture
+def old_messages():
+    def make(rows):
+        with app.app_context():
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql('DROP TABLE message_model')
+                connection.exec_driver_sql('CREATE TABLE message_model (id INTEGER PRIMARY KEY, message VARCHAR NOT NULL, '
+                                           'user_id INTEGER, chat_id INTEGER, created_at VARCHAR NOT NULL)')
+                connection.exec_driver_sql('INSERT INTO message_model VALUES (?, ?, 1, ?, ?)', rows)
+    return make
+
+def converted():
+    with app.app_context():
+        with db.engine.connect() as connection:
+            return dict(connection.exec_driver_sql('SELECT id, created_at FROM message_model ORDER BY id').all())
+
+def test_unparsable_timestamps_take_their_neighbours(old_messages):
+    old_messages([(1, 'a', 1, 'garbage'), (2, 'b', 1, 'Jan 02, 2024 10:00 AM'), (3, 'c', 2, '1700000000000'),
+                  (4, 'd', 1, ''), (5, 'e', 2, 'Feb 30, 2024 10:00 AM')])
+    at_ten = int(datetime.datetime(2024, 1, 2, 10).timestamp() * 1000)
+
+    with app.app_context():
+        assert migrations.convert_message_timestamps()
+
+    assert converted() == {1: at_ten, 2: at_ten, 3: 1700000000000, 4: at_ten, 5: 1700000000000}
+
+def test_room_without_a_valid_timestamp_aborts(old_messages):
+    old_messages([(1, 'a', 1, 'Jan 02, 2024 10:00 AM'), (2, 'b', 2, 'garbage')])
+
+    with app.app_context():
+        with pytest.raises(ValueError, match=r'\[2\]'):
+            migrations.convert_message_timestamps()
+        created_at = next(c for c in inspect(db.engine).get_columns('message_model') if c['name'] == 'created_at')
+
+    assert not isinstance(created_at['type'], Integer)
+    assert converted() == {1: 'Jan 02, 2024 10:00 AM', 2: 'garbage'}
@@ -0,0 +1,82 @@
+from outbound import RESYNC_EVENT, make_manager
+import json
+import pytest
+import socketio
+
+"""
+Tests of the bounded outbound queues: what a lagging connection gets under each overflow policy.
+"""
+
+class FakeQueue():
+
+    def __init__(self):
+        self.depth = 0
+
+    def qsize(self):
+        return self.depth
+
+class FakeSocket():
+
+    def __init__(self):
+        self.queue = FakeQueue()
+        self.closed = False
+
+@pytest.fixture
+def outbound():
+    def make(policy):
+        manager = make_manager(None, 2, policy, 60_000)
+        server = socketio.Server(async_mode='threading', client_manager=manager)
+        server.sent, server.tasks = [], []
+        server._send_eio_packet = lambda eio_sid, pkt: server.sent.append((eio_sid, json.loads(pkt.data[1:])[0]))
+        server._send_packet = lambda eio_sid, pkt: server.sent.append((eio_sid, pkt.data[0]))
+        server.start_background_task = lambda target, *args, **kwargs: server.tasks.append((target, args, kwargs))
+        for eio_sid in ('slow', 'fast'):
+            server.eio.sockets[eio_sid] = FakeSocket()
+            manager.enter_room(manager.connect(eio_sid, '/'), '/', 'room:general')
+        return server
+    return make
+
+def send(server, *events):
+    for event in events:
+        server.emit(event, {}, to='room:general')
+
+def received(server, eio_sid):
+    return [event for sid, event in server.sent if sid == eio_sid]
+
+def test_coalesce_replaces_the_missed_messages_with_one_resync(outbound):
+    server = outbound('coalesce')
+    server.eio.sockets['slow'].queue.depth = 2
+
+    send(server, 'm1', 'm2', 'm3')
+    server.manager.flush()
+    assert received(server, 'slow') == []
+    server.eio.sockets['slow'].queue.depth = 1
+    server.manager.flush()
+    send(server, 'm4')
+
+    assert received(server, 'slow') == [RESYNC_EVENT, 'm4']
+    assert received(server, 'fast') == ['m1', 'm2', 'm3', 'm4']
+    assert server.manager.stats()['coalesced'] == 3
+
+def test_drop_oldest_keeps_the_newest_messages_after_a_resync(outbound):
+    server = outbound('drop_oldest')
+    server.eio.sockets['slow'].queue.depth = 2
+
+    send(server, 'm1', 'm2', 'm3')
+    assert server.manager.depth(server.manager.sid_from_eio_sid('slow', '/')) == 4
+    server.eio.sockets['slow'].queue.depth = 0
+    server.manager.flush()
+
+    assert received(server, 'slow') == [RESYNC_EVENT, 'm2', 'm3']
+    assert server.manager.stats()['dropped'] == 1
+
+def test_disconnect_closes_the_lagging_connection(outbound):
+    server = outbound('disconnect')
+    server.eio.sockets['slow'].queue.depth = 2
+
+    send(server, 'm1', 'm2')
+
+    assert received(server, 'slow') == []
+    assert received(server, 'fast') == ['m1', 'm2']
+    assert [(target, args) for target, args, _ in server.tasks if target == server.disconnect] == \
+        [(server.disconnect, (server.manager.sid_from_eio_sid('slow', '/'),))]
@@ -0,0 +1,72 @@
+from config import app, db
+from models import PresenceModel, UserModel
+from presence import PresenceRegistry, user_channel
+import pytest
+import wire
+
+"""
+Tests of presence shared between workers: a user stays online while connected to any worker.
+"""
+
+@pytest.fixture
+def workers(monkeypatch):
+    pushed = []
+    monkeypatch.setattr(wire, 'broadcast', lambda event, payload, to: pushed.append((to, payload)))
+    registries = [PresenceRegistry(60_000, 60, worker) for worker in ('a', 'b')]
+    yield registries, pushed
+    for registry in registries:
+        registry.stop()
+
+def status(user_id):
+    with app.app_context():
+        return db.session.get(UserModel, user_id).status
+
+def test_user_stays_online_while_connected_to_another_worker(make_user, make_room, workers):
+    (a, b), pushed = workers
+    alice, bob = make_user('alice'), make_user('bob')
+    make_room('general', [alice, bob])
+
+    a.connect('sid-a', alice, 'alice')
+    a.flush()
+    b.connect('sid-b', alice, 'alice')
+    b.flush()
+    a.disconnect('sid-a')
+    a.flush()
+
+    assert status(alice) == 'online'
+    assert pushed == [(user_channel(bob), {"alice": 'online'})]
+
+    b.disconnect('sid-b')
+    b.flush()
+
+    assert status(alice) == 'offline'
+    assert pushed[1:] == [(user_channel(bob), {"alice": 'offline'})]
+
+def test_rows_of_a_stopped_worker_expire(make_user, workers):
+    (a, _), _ = workers
+    alice = make_user('alice')
+    with app.app_context():
+        PresenceModel.attach_many('crashed', [alice], 0)
+        db.session.commit()
+
+    a.connect('sid-a', alice, 'alice')
+    a.flush()
+    a.disconnect('sid-a')
+    a.flush()
+
+    assert status(alice) == 'offline'
+    with app.app_context():
+        assert PresenceModel.query.count() == 0
+
+def test_logout_is_shared(make_user, workers):
+    (a, b), _ = workers
+    alice = make_user('alice')
+
+    a.connect('sid-a', alice, 'alice')
+    b.connect('sid-b', alice, 'alice')
+    a.flush()
+    b.flush()
+    a.logout(alice, 'alice')
+    a.flush()
+
+    assert status(alice) == 'offline'
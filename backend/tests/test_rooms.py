@@ -0,0 +1,86 @@
+from config import app
+from flask_jwt_extended import create_access_token
+from models import ChatModel, MessageModel, UserChatModel
+
+"""
+Tests of the chat REST routes: they act as the user of the access token, whatever the body says.
+"""
+
+def call(method, route, identity, **body):
+    with app.app_context():
+        token = create_access_token(identity=identity)
+    return app.test_client().open(route, method=method, json=body, headers={"Authorization": f'Bearer {token}'})
+
+def members(room):
+    with app.app_context():
+        chat = ChatModel.get_room_ref(room)
+        return sorted(x.user_id for x in UserChatModel.query.filter_by(chat_id=chat.id))
+
+def test_save_message_acts_as_the_token_user(make_user, make_room):
+    alice, mallory = make_user('alice'), make_user('mallory')
+    make_room('secret', [alice], type='private')
+
+    assert call('POST', '/chat/save_message', 'mallory', username='alice', room='secret', text='forged').status_code == 404
+    saved = call('POST', '/chat/save_message', 'alice', username='mallory', room='secret', text='hello')
+    assert saved.status_code == 201
+    assert call('POST', '/chat/save_message', 'alice', room='secret', text=' ').status_code == 400
+
+    with app.app_context():
+        assert [(x.user_id, x.message) for x in MessageModel.query.all()] == [(alice, 'hello')]
+
+def test_memberships_change_only_for_the_token_user(make_user, make_room):
+    alice, mallory = make_user('alice'), make_user('mallory')
+    make_room('general', [alice])
+
+    assert call('POST', '/chat/create_room', 'mallory', username='alice', room='mallory#1', type='public').status_code == 201
+    assert members('mallory#1') == [mallory]
+    assert call('POST', '/chat/add_user_to_chat', 'mallory', username='alice', room='general').status_code == 201
+    assert members('general') == [alice, mallory]
+    assert call('POST', '/chat/add_user_to_chat', 'mallory', room='nowhere').status_code == 404
+
+    removed = call('DELETE', '/chat/remove_user_from_chat', 'mallory', username='alice', room='general')
+    assert removed.status_code == 200
+    assert members('general') == [alice]
+
+def test_bulk_create_rooms_for_the_token_user(make_user):
+    mallory = make_user('mallory')
+    make_user('alice')
+    body = {"username": 'alice', "rooms": [{"room": 'one', "type": 'group'}, {"room": 'two', "type": 'group'}]}
+
+    first = call('POST', '/chat/bulk_create_rooms', 'mallory', **body)
+    again = call('POST', '/chat/bulk_create_rooms', 'mallory', **body)
+
+    assert first.get_json() == {"results": [{"room": 'one', "result": 'created'}, {"room": 'two', "result": 'created'}]}
+    assert again.get_json() == {"results": [{"room": 'one', "result": 'exists'}, {"room": 'two', "result": 'exists'}]}
+    assert members('one') == members('two') == [mallory]
+
+def test_bulk_memberships_are_limited_to_the_callers_rooms(make_user, make_room):
+    alice, bob, carol = make_user('alice'), make_user('bob'), make_user('carol')
+    make_room('general', [alice])
+    make_room('secret', [bob], type='private')
+    body = {"usernames": ['carol', 'ghost'], "rooms": ['general', 'secret', 'nowhere']}
+
+    def results(response):
+        assert response.status_code == 200
+        return [(x['username'], x['room'], x['result']) for x in response.get_json()['results']]
+
+    assert results(call('POST', '/chat/bulk_add_users', 'alice', **body)) == [
+        ('carol', 'general', 'added'), ('ghost', 'general', 'user_not_found'),
+        ('carol', 'secret', 'forbidden'), ('ghost', 'secret', 'user_not_found'),
+        ('carol', 'nowhere', 'room_not_found'), ('ghost', 'nowhere', 'user_not_found'),
+    ]
+    assert results(call('POST', '/chat/bulk_add_users', 'alice', **body))[0] == ('carol', 'general', 'already_member')
+    assert members('general') == [alice, carol]
+    assert members('secret') == [bob]
+
+    assert results(call('DELETE', '/chat/bulk_remove_users', 'alice', usernames=['carol', 'bob'],
+                        rooms=['general', 'secret'])) == [
+        ('carol', 'general', 'removed'), ('bob', 'general', 'not_member'),
+        ('carol', 'secret', 'forbidden'), ('bob', 'secret', 'forbidden'),
+    ]
+    assert results(call('DELETE', '/chat/bulk_remove_users', 'alice', usernames=['carol'], rooms=['general'])) == [
+        ('carol', 'general', 'not_member'),
+    ]
+    assert members('general') == [alice]
+    assert members('secret') == [bob]
+    assert call('POST', '/chat/bulk_add_users', 'ghost', **body).status_code == 404
@@ -0,0 +1,55 @@
+from config import app, db
+from flask_jwt_extended import create_access_token
+from models import MessageModel
+import archive
+import os
+import pytest
+
+"""
+Tests of the message search index: it follows saved, deleted and archived messages, and
+/chat/search_messages only returns messages of the caller's rooms.
+"""
+
+@pytest.fixture
+def rooms(make_user, make_room):
+    alice = make_user('alice')
+    bob = make_user('bob')
+    return {
+        "alice": alice,
+        "general": make_room('general', [alice, bob]),
+        "secret": make_room('secret', [bob]),
+    }
+
+def search_messages(username, term):
+    with app.app_context():
+        token = create_access_token(identity=username)
+    response = app.test_client().get('/chat/search_messages', query_string={"q": term},
+                                     headers={"Authorization": f'Bearer {token}'})
+    assert response.status_code == 200
+    return [(message['room'], message['text']) for message in response.get_json()['messages']]
+
+def test_index_follows_saved_deleted_and_archived_messages(rooms):
+    with app.app_context():
+        old = MessageModel(message='the deploy is done', user_id=rooms['alice'], chat_id=rooms['general'], created_at=1)
+        old.save()
+        new = MessageModel(message='the deploy failed', user_id=rooms['alice'], chat_id=rooms['general'], created_at=5)
+        new.save()
+        new_id = new.id
+    assert sorted(search_messages('alice', 'deploy')) == [('general', 'the deploy failed'), ('general', 'the deploy is done')]
+
+    with app.app_context():
+        db.session.get(MessageModel, new_id).delete()
+    assert search_messages('alice', 'deploy') == [('general', 'the deploy is done')]
+
+    with app.app_context():
+        os.makedirs(app.config['ARCHIVE_DIR'], exist_ok=True)
+        assert archive.archive_room(rooms['general'], cutoff=2) == 1
+    assert search_messages('alice', 'deploy') == []
+
+def test_results_are_limited_to_the_callers_rooms(rooms):
+    with app.app_context():
+        MessageModel(message='lunch at noon', user_id=rooms['alice'], chat_id=rooms['general'], created_at=1).save()
+        MessageModel(message='lunch without alice', user_id=rooms['alice'], chat_id=rooms['secret'], created_at=2).save()
+
+    assert search_messages('alice', 'lunch') == [('general', 'lunch at noon')]
+    assert sorted(search_messages('bob', 'lunch')) == [('general', 'lunch at noon'), ('secret', 'lunch without alice')]
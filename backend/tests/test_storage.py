@@ -0,0 +1,43 @@
+from config import app, db
+from models import UserModel
+from sqlalchemy import event, exc
+import pytest
+import storage
+
+"""
+Tests of the SQLite storage: the pragmas, and reads sent to the readers unless the transaction has written.
+"""
+
+@pytest.fixture
+def statements():
+    recorded = []
+    with app.app_context():
+        engines = {engine: key for key, engine in db.engines.items()}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        recorded.append((engines[conn.engine], statement.split()[0].upper()))
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', record)
+    yield recorded
+    for engine in engines:
+        event.remove(engine, 'before_cursor_execute', record)
+
+def test_reads_go_to_the_readers_until_the_transaction_writes(statements):
+    with app.app_context():
+        UserModel.query.filter_by(username='alice').first()
+        db.session.add(UserModel(username='alice', email='alice@test.local', password='-'))
+        db.session.flush()
+        assert UserModel.query.filter_by(username='alice').first() is not None
+        db.session.commit()
+        UserModel.query.filter_by(username='alice').first()
+
+    assert statements == [(storage.READER, 'SELECT'), (None, 'INSERT'), (None, 'SELECT'), (storage.READER, 'SELECT')]
+
+def test_pragmas_and_read_only_readers():
+    with app.app_context():
+        assert db.session.execute(db.text('PRAGMA journal_mode'), bind_arguments={"bind": db.engine}).scalar() == 'wal'
+        with db.engines[storage.READER].connect() as reader:
+            assert reader.exec_driver_sql('PRAGMA query_only').scalar() == 1
+            with pytest.raises(exc.OperationalError):
+                reader.exec_driver_sql("INSERT INTO chat_model (name, type) VALUES ('general', 'public')")
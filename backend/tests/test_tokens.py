@@ -0,0 +1,33 @@
+from cache import token_cache
+from config import app, socketio
+from datetime import timedelta
+from flask_jwt_extended import create_access_token, create_refresh_token
+from tokens import token_digest, verify_access_token
+import time
+
+"""
+Tests of the verified-token cache and of the Socket.IO handshake authentication.
+"""
+
+def test_cached_claims_expire_with_the_token(make_user):
+    make_user('alice')
+    with app.app_context():
+        token = create_access_token(identity='alice', expires_delta=timedelta(seconds=1))
+        assert verify_access_token(token) == 'alice'
+        _, deadline = token_cache.entries[token_digest(token)]
+        assert deadline - time.monotonic() <= 1
+
+        time.sleep(1.5)
+        assert verify_access_token(token) is None
+        assert token_digest(token) not in token_cache.entries
+
+def test_handshake_without_a_valid_access_token_is_refused(make_user):
+    make_user('alice')
+    with app.app_context():
+        expired = create_access_token(identity='alice', expires_delta=timedelta(seconds=-1))
+        refresh = create_refresh_token(identity='alice')
+        missing_user = create_access_token(identity='mallory')
+
+    for auth in (None, {}, {"token": 'not-a-jwt'}, {"token": expired}, {"token": refresh}, {"token": missing_user}):
+        client = socketio.test_client(app, auth=auth)
+        assert not client.is_connected()
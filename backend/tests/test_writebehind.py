@@ -0,0 +1,84 @@
+from config import app, socketio
+from models import MessageModel
+from writebehind import message_writer
+import pytest
+import wire
+
+"""
+Tests of the write-behind message queue: failure isolation inside a batch, per-room ordering,
+and a writer task that survives broadcast errors.
+"""
+
+@pytest.fixture
+def emitted(monkeypatch):
+    events = []
+    monkeypatch.setattr(socketio, 'emit', lambda event, payload, to=None, **kwargs: events.append((event, payload, to)))
+    return events
+
+def broadcasts(emitted, room):
+    return [payload for event, payload, to in emitted if event == 'message' and to == wire.room_channel(room)]
+
+def saved_messages():
+    with app.app_context():
+        return [(m.chat_id, m.user_id, m.message) for m in MessageModel.query.order_by(MessageModel.id)]
+
+def test_bad_message_does_not_fail_its_batch(make_user, make_room, emitted):
+    alice, bob = make_user('alice'), make_user('bob')
+    room = make_room('general', [alice, bob])
+
+    message_writer._write([
+        ('sid-alice', alice, room, 'general', 'alice', 'hello', 1),
+        ('sid-bad', alice, room, 'general', 'alice', None, 2),
+        ('sid-bob', bob, room, 'general', 'bob', 'hi alice', 3),
+    ])
+
+    assert saved_messages() == [(room, alice, 'hello'), (room, bob, 'hi alice')]
+    assert [to for event, _, to in emitted if event == 'message_error'] == ['sid-bad']
+    assert [payload['text'] for payload in broadcasts(emitted, 'general')] == ['hello', 'hi alice']
+
+def test_messages_keep_their_order_per_room(make_user, make_room, emitted):
+    alice = make_user('alice')
+    rooms = {name: make_room(name, [alice]) for name in ('one', 'two')}
+
+    sent = [(name, f'{name} {i}') for i in range(30) for name in rooms]
+    for name, text in sent:
+        message_writer.submit('sid', alice, rooms[name], name, 'alice', text, 0)
+    message_writer.stop()
+
+    for name, chat_id in rooms.items():
+        expected = [text for room, text in sent if room == name]
+        assert [text for room, _, text in saved_messages() if room == chat_id] == expected
+        broadcast = broadcasts(emitted, name)
+        assert [payload['text'] for payload in broadcast] == expected
+        assert [payload['id'] for payload in broadcast] == sorted(payload['id'] for payload in broadcast)
+
+def test_writer_survives_a_broadcast_error(make_user, make_room, emitted, monkeypatch):
+    alice = make_user('alice')
+    room = make_room('general', [alice])
+    broadcast = wire.broadcast
+    failures = iter([RuntimeError('broker down')])
+
+    def flaky_broadcast(*args):
+        error = next(failures, None)
+        if error is not None:
+            raise error
+        broadcast(*args)
+
+    monkeypatch.setattr(wire, 'broadcast', flaky_broadcast)
+    message_writer.submit('sid', alice, room, 'general', 'alice', 'lost broadcast', 0)
+    socketio.sleep(0.2)
+    message_writer.submit('sid', alice, room, 'general', 'alice', 'delivered', 0)
+    message_writer.stop()
+
+    assert [text for _, _, text in saved_messages()] == ['lost broadcast', 'delivered']
+    assert [payload['text'] for payload in broadcasts(emitted, 'general')] == ['delivered']
+
+def test_non_string_messages_are_rejected_before_the_queue(make_user, make_room, connect):
+    alice = make_user('alice')
+    make_room('general', [alice])
+    client = connect('alice')
+
+    for message in (None, '', '   ', 42, ['hi']):
+        client.emit('message', {"message": message, "room": 'general'})
+        assert [event['name'] for event in client.get_received()] == ['message_error']
+    assert message_writer.queue.qsize() == 0
@@ -0,0 +1,69 @@
+from flask import current_app
+from flask_jwt_extended import JWTManager, decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+import hashlib
+import time
+
+"""
+This module verifies JWTs once per token instead of once per request.
+CachingJWTManager keeps the claims of every token it has verified in cache.token_cache, keyed by the
+SHA-256 digest of the token, until the token expires (or TOKEN_CACHE_TTL_S passes), so the @jwt_required()
+routes skip the signature check for the tokens a client sends again and again. A token that fails
+verification is never cached, and the type, freshness and identity checks of Flask-JWT-Extended still
+run on the cached claims.
+Socket.IO connections are authenticated once, at the handshake, with verify_access_token(); the identity
+is then kept in the connection's session, so events are handled without verifying anything.
+Classes:
+    CachingJWTManager: JWTManager caching the claims of verified tokens.
+Functions:
+    token_digest(encoded_token): Returns the cache key of a token.
+    verify_access_token(encoded_token): Returns the identity of a valid access token, or None.
+"""
+
+def token_digest(encoded_token):
+    """
+    Returns the cache key of a token, so the cache does not hold usable tokens.
+    """
+    return hashlib.sha256(encoded_token.encode()).digest()
+
+class CachingJWTManager(JWTManager):
+    """
+    JWTManager caching the claims of the tokens it has verified until they expire.
+    """
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        if csrf_value is not None or allow_expired:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+
+        # imported here: cache imports config, which creates this manager
+        from cache import token_cache
+
+        key = token_digest(encoded_token)
+        claims = token_cache.get(key)
+        if claims is None:
+            claims = super()._decode_jwt_from_config(encoded_token)
+            expires_in = claims['exp'] - time.time() if 'exp' in claims else None
+            if expires_in is None or expires_in > 0:
+                token_cache.put(key, claims, expires_in)
+        return dict(claims)
+
+def verify_access_token(encoded_token):
+    """
+    Verifies an access token, through the cache of verified tokens.
+    Must be called inside an application context.
+    Args:
+        encoded_token (str): The encoded JWT, without the "Bearer " prefix.
+    Returns:
+        str: The identity (username) of the token, or None if the token is missing, invalid,
+        expired or not an access token.
+    """
+    if not encoded_token:
+        return None
+    try:
+        claims = decode_token(encoded_token)
+    except (JWTExtendedException, PyJWTError):
+        return None
+    if claims.get('type') != 'access':
+        return None
+    return claims.get(current_app.config['JWT_IDENTITY_CLAIM'])
@@ -0,0 +1,138 @@
+from config import app, socketio
+from flask import request
+import gzip
+import msgpack
+import socketio as socketio_base
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+This module handles the wire formats of the backend: an opt-in MessagePack format for Socket.IO clients
+and compression of large REST responses.
+A client opts in by opening its connection with {"format": "msgpack"} in the auth payload. The Socket.IO
+packet parser is shared by the whole server, so binary clients keep the standard protocol but receive
+every event argument as one MessagePack-encoded binary attachment, and are put in a parallel room
+("msgpack:<room>") instead of the room itself. A broadcast is therefore encoded once per room and
+format, never once per recipient, and JSON clients are unaffected. The binary copy is only encoded when
+the binary room has members, or may have some on another worker when a message queue is used.
+Every Socket.IO room name starts with its kind: "room:<name>" for chat rooms (room_channel), "user:<id>"
+for the private channel of a user (presence.user_channel) and "msgpack:" followed by one of those for the
+binary members. Users choose chat room names, so a chat room can never share its Socket.IO room with a
+private channel, a binary room or a connection's own room.
+Responses larger than COMPRESSION_MIN_BYTES are compressed with brotli (when the brotli package is
+installed) or gzip, whichever the client accepts.
+Functions:
+    negotiate(sid, auth): Records the wire format a connection asked for.
+    forget(sid): Forgets the wire format of a closed connection.
+    room_channel(room): Returns the name of the Socket.IO room of a chat room.
+    room_for(sid, room): Returns the room a connection joins to receive broadcasts to a room.
+    pack(sid, payload): Encodes an acknowledgement for a connection.
+    send(event, payload, sid): Emits an event to a single connection, in its wire format.
+    broadcast(event, payload, room): Emits an event to the JSON and binary members of a room.
+    compress(response): Compresses a response in an encoding the client accepts.
+Objects:
+    binary_clients: The session ids of the connections using MessagePack.
+"""
+
+BINARY_FORMAT = 'msgpack'
+
+binary_clients = set()
+
+def negotiate(sid, auth):
+    """
+    Records the wire format a connection asked for in its auth payload.
+    Returns:
+        bool: True if the connection uses MessagePack.
+    """
+    if (auth or {}).get('format') == BINARY_FORMAT:
+        binary_clients.add(sid)
+        return True
+    return False
+
+def forget(sid):
+    """
+    Forgets the wire format of a closed connection.
+    """
+    binary_clients.discard(sid)
+
+def room_channel(room):
+    """
+    Returns the name of the Socket.IO room of a chat room.
+    """
+    return f'room:{room}'
+
+def binary_room(room):
+    """
+    Returns the name of the room the binary members of a room join.
+    """
+    return f'{BINARY_FORMAT}:{room}'
+
+def room_for(sid, room):
+    """
+    Returns the room a connection joins to receive the broadcasts to a room in its wire format.
+    """
+    return binary_room(room) if sid in binary_clients else room
+
+def pack(sid, payload):
+    """
+    Encodes a payload sent to a single connection, such as an acknowledgement, in its wire format.
+    """
+    return msgpack.packb(payload) if sid in binary_clients else payload
+
+def send(event, payload, sid):
+    """
+    Emits an event to a single connection, such as an error, with its payload in the connection's wire format.
+    """
+    socketio.emit(event, pack(sid, payload), to=sid)
+
+def _may_have_members(room):
+    manager = socketio.server.manager
+    if isinstance(manager, socketio_base.PubSubManager):
+        # the rooms of the other workers are not known here
+        return True
+    return bool(manager.rooms.get('/', {}).get(room))
+
+def broadcast(event, payload, room):
+    """
+    Emits an event to every member of a room, encoding the payload once for the JSON members
+    and once for the MessagePack members, if the room has any.
+    Args:
+        event (str): The event name.
+        payload (dict): The event argument.
+        room (str): The room the event is sent to.
+    """
+    socketio.emit(event, payload, to=room)
+    if _may_have_members(binary_room(room)):
+        socketio.emit(event, msgpack.packb(payload), to=binary_room(room))
+
+def compress(response):
+    """
+    Compresses a response with brotli or gzip when it is large enough and the client accepts the encoding.
+    The ETag of a compressed response is made weak, since it no longer identifies the exact bytes sent.
+    Returns:
+        Response: The response, compressed in place when possible.
+    """
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESSION_MIN_BYTES']:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        data, encoding = brotli.compress(data, quality=app.config['COMPRESSION_BROTLI_QUALITY']), 'br'
+    elif accepted['gzip']:
+        data, encoding = gzip.compress(data, compresslevel=app.config['COMPRESSION_GZIP_LEVEL']), 'gzip'
+    else:
+        return response
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,153 @@
+from config import app, db, socketio
+from models import ChatModel, MessageModel, UserChatModel
+from history import room_history, serialize_message
+import atexit
+import time
+import search
+import wire
+
+"""
+This module persists chat messages sent over Socket.IO through an in-process write-behind queue.
+Instead of one commit (and one fsync) per message, queued messages are inserted in a single
+transaction once MESSAGE_BATCH_SIZE messages are waiting or MESSAGE_BATCH_INTERVAL_MS milliseconds
+have passed since the first one. Each batch is broadcast after it is committed, in the order it was
+inserted, so every client sees messages in id order and never sees a message that was not saved.
+When a batch fails, its messages are saved again one at a time, so only the bad one is lost and only
+its sender gets a 'message_error' event. Errors never stop the writer task.
+Each batch also updates the rooms' last message and message count and the senders' read cursors,
+and committed messages are appended to the rooms' in-memory history buffers (see history.py).
+The queue and the writer task come from the Socket.IO server, so they follow its async mode.
+Classes:
+    MessageWriter: The write-behind queue and its background writer task.
+Objects:
+    message_writer: The process-wide MessageWriter, flushed on interpreter shutdown.
+"""
+
+class MessageWriter():
+
+    def __init__(self, batch_size, interval_ms):
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self.queue = socketio.server.eio.create_queue()
+        self.queue_empty = socketio.server.eio.get_queue_empty_exception()
+        self.task = None
+
+    def submit(self, sid, user_id, chat_id, room, username, text, created_at):
+        """
+        Queues a message for persistence and broadcast, starting the writer task on first use.
+        Args:
+            sid (str): The Socket.IO session id of the sender, notified if the batch fails.
+            user_id (int): The id of the sender.
+            chat_id (int): The id of the chat room.
+            room (str): The name of the chat room the message is broadcast to.
+            username (str): The username of the sender.
+            text (str): The message content.
+            created_at (int): The time of the message in epoch milliseconds.
+        """
+        if self.task is None:
+            self.task = socketio.start_background_task(self._run)
+        self.queue.put((sid, user_id, chat_id, room, username, text, created_at))
+
+    def stop(self):
+        """
+        Flushes every queued message and stops the writer task.
+        """
+        if self.task is None:
+            return
+        self.queue.put(None)
+        self.task.join()
+        self.task = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except self.queue_empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                self._write(batch)
+            except Exception:
+                # the task must outlive any error, or every later message would wait in the queue forever
+                app.logger.exception('Message writer failed on a batch of %d messages', len(batch))
+
+    def _write(self, batch):
+        with app.app_context():
+            try:
+                ids, previous_last_ids = self._persist(batch)
+            except Exception:
+                app.logger.exception('Failed to persist a batch of %d messages', len(batch))
+                if len(batch) > 1:
+                    # one bad message must not lose the others: save them one by one
+                    for item in batch:
+                        self._write([item])
+                else:
+                    wire.send('message_error', {"msg": "Message could not be saved!"}, batch[0][0])
+                return
+
+            try:
+                self._publish(batch, ids, previous_last_ids)
+            except Exception:
+                app.logger.exception('Failed to broadcast a batch of %d saved messages', len(batch))
+
+    def _persist(self, batch):
+        messages = [
+            MessageModel(message=text, user_id=user_id, chat_id=chat_id, created_at=created_at)
+            for _, user_id, chat_id, _, _, text, created_at in batch
+        ]
+
+        try:
+            db.session.add_all(messages)
+            db.session.flush()
+            search.index_many(messages)
+            ids = [message.id for message in messages]
+
+            last_messages = {message.chat_id: message for message in messages}
+            counts = {}
+            for message in messages:
+                counts[message.chat_id] = counts.get(message.chat_id, 0) + 1
+            previous_last_ids = ChatModel.get_last_message_ids(list(last_messages))
+            for chat_id, message in last_messages.items():
+                ChatModel.record_messages(message, counts[chat_id])
+            # senders have read the rooms they write to
+            for user_id, chat_id in {(message.user_id, message.chat_id) for message in messages}:
+                UserChatModel.mark_read(user_id, chat_id)
+
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+        return ids, previous_last_ids
+
+    def _publish(self, batch, ids, previous_last_ids):
+        payloads = [
+            serialize_message(message_id, username, text, created_at)
+            for (_, _, _, _, username, text, created_at), message_id in zip(batch, ids)
+        ]
+
+        by_chat = {}
+        for (_, _, chat_id, _, _, _, _), payload in zip(batch, payloads):
+            by_chat.setdefault(chat_id, []).append(payload)
+        for chat_id, chat_payloads in by_chat.items():
+            room_history.extend(chat_id, previous_last_ids.get(chat_id), chat_payloads)
+
+        # connections subscribe to several rooms, so broadcasts name theirs
+        for (_, _, _, room, _, _, _), payload in zip(batch, payloads):
+            wire.broadcast('message', dict(payload, room=room), wire.room_channel(room))
+
+message_writer = MessageWriter(app.config['MESSAGE_BATCH_SIZE'], app.config['MESSAGE_BATCH_INTERVAL_MS'])
+atexit.register(message_writer.stop)
@@ -7,7 +7,13 @@ import { useNavigate} from 'react-router-dom'
 import { useEffect, useState, useRef } from 'react'
 import io from 'socket.io-client'
 
-const socketio = io('http://127.0.0.1:5000')
+const HEARTBEAT_INTERVAL_MS = 20000
+
+// the connection is authenticated once, with the access token, when it is opened after sign-in
+const socketio = io('http://127.0.0.1:5000', {
+    autoConnect: false,
+    auth: (cb) => cb({token: localStorage.getItem('access')})
+})
 
 /**
  * Chat component handles the chat functionality of the application.
@@ -32,10 +38,12 @@ const socketio = io('http://127.0.0.1:5000')
  * - Handling user actions such as creating rooms, joining rooms, sending messages, and logging out.
  * - Managing the state of the chat, including the current user, rooms, users, selected room, messages, and search state.
  * - Communicating with the backend server to fetch and update chat data.
- * - Handling socket.io events for real-time chat functionality.
+ * - Handling socket.io events for real-time chat functionality. One connection is subscribed to every room
+ *   of the user; messages of the rooms that are not open update their preview and unread count.
  *
  * @property {string} currentUser - The current logged-in user.
  * @property {Array} rooms - The list of chat rooms.
+ * @property {object} roomPreviews - The last message and unread count of each room, by room name.
  * @property {Array} users - The list of users.
  * @property {string|null} selectedRoom - The currently selected chat room.
  * @property {boolean} searching - The state indicating if the user is searching for rooms or users.
@@ -45,7 +53,8 @@ const socketio = io('http://127.0.0.1:5000')
  * @property {object} chatEndRef - The reference to the chat window element for scrolling.
  *
  * @method handleRedirect - Redirects the user to a specified route.
- * @method getRooms - Fetches the list of chat rooms for the current user.
+ * @method getRooms - Fetches the list of chat rooms for the current user, with their last message and unread count.
+ * @method markRoomRead - Marks every message of a chat room as read and clears its unread count.
  * @method handleCreateRoom - Handles the creation of a new chat room.
  * @method handleSaveMessagesToDB - Saves messages to the database and emits socket events.
  * @method handleSearch - Handles the search functionality for rooms and users.
@@ -53,8 +62,10 @@ const socketio = io('http://127.0.0.1:5000')
  * @method refreshToken - Refreshes the JWT token if it has expired.
  * @method onJoinRoom - Adds the current user to a specified chat room.
  * @method handelJoinRoom - Joins a specified chat room and saves a message indicating the user has entered the room.
- * @method hendleSetMessagesHistory - Fetches and sets the message history for a specified chat room.
- * @method handleRoomSelect - Selects a chat room and fetches its message history.
+ * @method hendleSetMessagesHistory - Sets the latest page of message history a chat room sent back when it was joined.
+ * @method handleSyncMessages - Fetches only the messages missed while the socket was disconnected or lagging, using the room's ETag.
+ * @method handleLoadOlderMessages - Prepends the next older page of history when the chat window is scrolled to the top.
+ * @method handleRoomSelect - Selects a chat room and joins it, receiving its latest messages in the join acknowledgement.
  * @method onExitRoom - Removes the current user from a specified chat room.
  * @method handleExitChat - Exits the current chat room and saves a message indicating the user has left the room.
  * @method handleSendMessage - Sends a message in the current chat room.
@@ -63,31 +74,109 @@ const socketio = io('http://127.0.0.1:5000')
 export default function Chat(){
     const currentUser = localStorage.getItem('username')
     const [rooms, setRooms] = useState([])
+    const [roomPreviews, setRoomPreviews] = useState({})
     const [users, setUsers] = useState([])
     const [selectedRoom, setSelectedRoom] = useState(null)
     const [searching, setSearching] = useState(false)
     const [messages, setMessages] = useState([])
+    const [olderCursor, setOlderCursor] = useState(null)
     const [message, setMessage] = useState('')
     const navigate = useNavigate()
     const chatEndRef = useRef(null)
+    const selectedRoomRef = useRef(null)
+    const lastMessageIdRef = useRef(0)
+    const roomEtagsRef = useRef({})
 
     useEffect(() => {
         if (localStorage.getItem('username') !== null){
             getRooms()
 
+            // the connection is subscribed to every room of the user
             socketio.on('message', (data) => {
+                const room = data.room ?? selectedRoomRef.current
+                const isOpen = room === selectedRoomRef.current
+                setRoomPreviews((prevPreviews) => ({...prevPreviews, [room]: {
+                    last_message: data,
+                    unread: isOpen ? 0 : (prevPreviews[room]?.unread ?? 0) + (data.username === currentUser ? 0 : 1)
+                }}))
+                if (!isOpen){
+                    return
+                }
+
+                lastMessageIdRef.current = Math.max(lastMessageIdRef.current, data.id ?? 0)
                 setMessages((prevMessage) => [...prevMessage,
                     {
+                        id: data.id,
                         username: data.username,
                         text: data.text,
                         dateTime: data.dateTime
                     }
                 ])
             })
+
+            socketio.on('connect', () => {
+                if (selectedRoomRef.current !== null){
+                    socketio.emit('join', {room: selectedRoomRef.current})
+                    handleSyncMessages(selectedRoomRef.current)
+                }
+            })
+
+            // the server dropped messages while this connection was too slow to take them
+            socketio.on('resync', () => {
+                if (selectedRoomRef.current !== null){
+                    handleSyncMessages(selectedRoomRef.current)
+                }
+                getRooms()
+            })
+
+            // membership changes pushed on the user's private channel
+            socketio.on('invited', (data) => {
+                socketio.emit('subscribe', {rooms: data.rooms})
+                getRooms()
+            })
+
+            socketio.on('removed', (data) => {
+                socketio.emit('unsubscribe', {rooms: data.rooms})
+                getRooms()
+            })
+
+            socketio.on('presence', (diff) => {
+                setUsers((prevUsers) => prevUsers.map((user) => 
+                    diff[user.username] === undefined ? user : {...user, status: diff[user.username]}
+                ))
+            })
+
+            // the server refuses connections whose access token expired; refresh it and reconnect
+            socketio.on('connect_error', (error) => {
+                if (error.message === 'Invalid token!'){
+                    refreshToken({status: 401})
+                }
+            })
+
+            // reconnect so the connection is opened with the signed-in user's access token
+            socketio.disconnect().connect()
         }
 
+        const heartbeat = setInterval(() => {
+            if (socketio.connected){
+                socketio.emit('heartbeat')
+            }
+        }, HEARTBEAT_INTERVAL_MS)
+
+        socketio.on('message_error', (data) => {
+            console.log(data.msg)
+        })
+
         return () => {
+            clearInterval(heartbeat)
             socketio.off('message')
+            socketio.off('message_error')
+            socketio.off('connect')
+            socketio.off('connect_error')
+            socketio.off('presence')
+            socketio.off('resync')
+            socketio.off('invited')
+            socketio.off('removed')
         }
     }, [])
 
@@ -120,17 +209,37 @@ export default function Chat(){
             }
         }
 
-        const response = await fetch(`http://127.0.0.1:5000/chat/get_rooms?user=${localStorage.getItem('username')}`, options)
+        const response = await fetch('http://127.0.0.1:5000/chat/get_rooms', options)
         if (response.status === 200){
             const data = await response.json()
             // console.log(data.rooms)
             setRooms(data.rooms)
+            setRoomPreviews(data.previews ?? {})
         }else{
             refreshToken(response)
         }
 
     }
 
+    const markRoomRead = async (room) => {
+        setRoomPreviews((prevPreviews) => prevPreviews[room] === undefined ? prevPreviews :
+            {...prevPreviews, [room]: {...prevPreviews[room], unread: 0}})
+
+        const options = {
+            method: 'POST',
+            headers: {
+                "Content-Type": "application/json",
+                "Authorization": `Bearer ${localStorage.getItem('access')}`
+            },
+            body: JSON.stringify({username: currentUser, room})
+        }
+
+        const response = await fetch('http://127.0.0.1:5000/chat/mark_read', options)
+        if (response.status !== 200 && response.status !== 404){
+            refreshToken(response)
+        }
+    }
+
     const handleCreateRoom = async(e) => {
         e.preventDefault()
 
@@ -193,8 +302,7 @@ export default function Chat(){
         const response = await fetch(url, options)
         if (response.status === 201){
             const result = await response.json()
-            ev === 'connect_room' ? socketio.emit(ev, {message: result.message, dateTime: result.dateTime, username, room: roomName}) : 
-                                    socketio.emit(ev, {message: result.message, dateTime: result.dateTime})
+            socketio.emit(ev, {id: result.id, room: roomName})
             console.log(result.msg)
         }else{
             refreshToken(response)
@@ -217,7 +325,7 @@ export default function Chat(){
                 }
             }
             const response = await fetch(
-                `http://127.0.0.1:5000/chat/find_chats?item=${search_item}&user=${localStorage.getItem('username')}`, 
+                `http://127.0.0.1:5000/chat/find_chats?item=${search_item}`, 
                 options)
 
             if (response.status === 200){
@@ -243,7 +351,8 @@ export default function Chat(){
         const options = {
             method: "PATCH",
             headers: {
-                "Content-Type": "application/json"
+                "Content-Type": "application/json",
+                "Authorization": `Bearer ${localStorage.getItem('access')}`
             },
             body: JSON.stringify(data)
         }
@@ -261,6 +370,7 @@ export default function Chat(){
         localStorage.removeItem('username')
         localStorage.removeItem('access')
         localStorage.removeItem('refresh')
+        socketio.disconnect()
 
         setRooms([])
     }
@@ -312,14 +422,15 @@ export default function Chat(){
             const responseData = await response.json()
             console.log(responseData.msg)
             setRooms(rooms.filter((r) => r !== room))
-            // socketio.emit('connect_room', {username: currentUser, room})
+            // socketio.emit('connect_room', {room})
         }else{
             refreshToken(response)
         }
     }
 
-    const handelJoinRoom = (room) => {
-        onJoinRoom(room)
+    const handelJoinRoom = async (room) => {
+        // the announcement is only saved once the user is a member
+        await onJoinRoom(room)
         // console.log(room)
         handleSaveMessagesToDB(
             currentUser,
@@ -329,36 +440,101 @@ export default function Chat(){
         )
     }
 
-    const hendleSetMessagesHistory = async (room) => {
+    const fetchMessagesPage = async (room, cursor = '') => {
         const roomSplit = room.split('#')
-        const url = `http://127.0.0.1:5000/chat/get_messages?room=${roomSplit[0]}%23${roomSplit[1]}`
+        const url = `http://127.0.0.1:5000/chat/get_messages?room=${roomSplit[0]}%23${roomSplit[1]}${cursor}`
+        // the ETag only validates delta syncs, so it is sent with, and kept from, after_id requests only
+        const isSync = cursor.startsWith('&after_id')
+        const etag = roomEtagsRef.current[room]
         const options = {
             method: "GET",
+            cache: 'no-store',
             headers: {
                 "Content-Type": "application/json",
-                "Authorization": `Bearer ${localStorage.getItem('access')}`
+                "Authorization": `Bearer ${localStorage.getItem('access')}`,
+                ...(etag !== undefined && isSync ? {"If-None-Match": etag} : {})
             }
         }
 
         const response = await fetch(url, options)
         if (response.status === 200){
-            const responseData = await response.json()
-            setMessages(responseData.messages)
-        }else{
+            const data = await response.json()
+            if (isSync && !data.has_more){
+                roomEtagsRef.current[room] = response.headers.get('ETag')
+            }
+            return data
+        }
+        if (response.status !== 304){
             refreshToken(response)
         }
+        return null
+    }
+
+    const hendleSetMessagesHistory = (room, page) => {
+        if (selectedRoomRef.current !== room){
+            return
+        }
+        if (page.msg !== undefined){
+            console.log(page.msg)
+            return
+        }
+
+        const messagesPage = page.messages
+        const lastId = messagesPage.length === 0 ? 0 : messagesPage[messagesPage.length - 1].id
+        lastMessageIdRef.current = Math.max(lastMessageIdRef.current, lastId)
+        roomEtagsRef.current[room] = page.etag
+        // keep the messages broadcast between joining the room and receiving the page
+        const known = new Set(messagesPage.map((msg) => msg.id))
+        setMessages((prevMessages) => [...messagesPage, ...prevMessages.filter((msg) => !known.has(msg.id))])
+        setOlderCursor(page.next_before_id)
+    }
+
+    const handleSyncMessages = async (room) => {
+        let responseData = null
+        do {
+            responseData = await fetchMessagesPage(room, `&after_id=${lastMessageIdRef.current}&limit=200`)
+            if (responseData === null || selectedRoomRef.current !== room){
+                return
+            }
+
+            const missed = responseData.messages
+            if (missed.length !== 0){
+                lastMessageIdRef.current = missed[missed.length - 1].id
+                setMessages((prevMessages) => {
+                    const known = new Set(prevMessages.map((msg) => msg.id))
+                    // missed messages can be older than messages received since the gap
+                    return [...prevMessages, ...missed.filter((msg) => !known.has(msg.id))]
+                        .sort((a, b) => (a.id ?? 0) - (b.id ?? 0))
+                })
+            }
+        } while (responseData.has_more)
+    }
+
+    const handleLoadOlderMessages = async () => {
+        if (olderCursor === null || chatEndRef.current.scrollTop !== 0){
+            return
+        }
+
+        const responseData = await fetchMessagesPage(selectedRoom, `&before_id=${olderCursor}`)
+        if (responseData !== null){
+            setMessages((prevMessages) => [...responseData.messages, ...prevMessages])
+            setOlderCursor(responseData.next_before_id)
+        }
     }
 
     const handleRoomSelect = (room) => {
         if (selectedRoom !== room){
             if (selectedRoom !== null){
                 socketio.emit('leave')
+                markRoomRead(selectedRoom)
             }
+            markRoomRead(room)
             setSelectedRoom(room)
+            selectedRoomRef.current = room
             console.log(room)
-            hendleSetMessagesHistory(room)
-            // setMessages([])
-            socketio.emit('join', {username: currentUser, room})
+            lastMessageIdRef.current = 0
+            setMessages([])
+            socketio.emit('join', {room}, (page) => hendleSetMessagesHistory(room, page))
         }
     }
 
@@ -387,24 +563,23 @@ export default function Chat(){
     }
 
     const handleExitChat = async (room) => {
-        await onExitRoom(room)
+        // announce the exit while still a member, then leave
         await handleSaveMessagesToDB(
             currentUser,
             'has left the room.',
-            'exit'
+            'exit',
+            room
         )
+        await onExitRoom(room)
         setSelectedRoom(null)
+        selectedRoomRef.current = null
         await getRooms()
     }
 
     const handleSendMessage = async() => {
         if (message !== ''){
-            //save message to db
-            await handleSaveMessagesToDB(
-                currentUser,
-                message,
-                'message'
-            )
+            // the server saves the message and broadcasts it back with its id
+            socketio.emit('message', {message, room: selectedRoom})
 
             setMessage('')
             const inputValue = document.getElementById('message-input')
@@ -477,8 +652,12 @@ export default function Chat(){
                             <img className='account-img' src={publickChatIcon}></img>
                             <div className='room-info'>
                                 <h3>{room}</h3>
-                                <p>Last message</p>
+                                <p>{roomPreviews[room]?.last_message
+                                    ? `${roomPreviews[room].last_message.username}: ${roomPreviews[room].last_message.text}`
+                                    : 'No messages yet'}</p>
                             </div>
+                            {roomPreviews[room]?.unread > 0 && selectedRoom !== room &&
+                                <span className='unread-count'>{roomPreviews[room].unread}</span>}
                         </div>
                     ))}
                     </> 
@@ -490,14 +669,16 @@ export default function Chat(){
                     <>
                         <div className='chat-window-header'>
                             <img className='close-chat' src={closeChatIcon} onClick={() => {
+                                markRoomRead(selectedRoom)
                                 setSelectedRoom(null)
+                                selectedRoomRef.current = null
                                 socketio.emit('leave')
                                 }} />
                             <img className='chat-avatar' src={publickChatIcon} />
                             <h2>{selectedRoom}</h2>
                             <img className='exit-chat' src={exitChatIcon} onClick={() => handleExitChat(selectedRoom)}/>
                         </div>
-                        <div className='chat-window-body'  ref={chatEndRef}>
+                        <div className='chat-window-body'  ref={chatEndRef} onScroll={handleLoadOlderMessages}>
                             {messages.map((msg, index) => (
                                 <div className='message-text' key={index}>
                                     <h4 key={msg.username}>{`${msg.username}:`}</h4>